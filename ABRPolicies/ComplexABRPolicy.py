@@ -95,12 +95,12 @@ class PensieveMultiNN(ABRPolicy):
         kbit_rate_max = streaming_enviroment.get_encoded_bitrate(streaming_enviroment.max_quality_level) / 1000.
         next_chunk_mbyte_size = []
         for next_quality in range(streaming_enviroment.max_quality_level + 1):
-            next_chunk_mbyte_size.append(streaming_enviroment.byte_size_match.iloc[
+            next_chunk_mbyte_size.append(streaming_enviroment.byte_size_table[
                                              streaming_enviroment.video_chunk_counter, next_quality] / 1000. / 1000.)
         next_chunk_mbyte_size = np.array(next_chunk_mbyte_size)
         next_chunk_kbit_rate = []
         for next_quality in range(streaming_enviroment.max_quality_level + 1):
-            next_chunk_kbit_rate.append(streaming_enviroment.bitrate_match.iloc[
+            next_chunk_kbit_rate.append(streaming_enviroment.bitrate_table[
                                             streaming_enviroment.video_chunk_counter, next_quality] / 1000.)
         next_chunk_kbit_rate = np.array(next_chunk_mbyte_size)
 
@@ -225,7 +225,7 @@ class PensieveNN(ABRPolicy):
         kbit_rate_max = streaming_enviroment.get_encoded_bitrate(streaming_enviroment.max_quality_level) / 1000.
         next_video_chunk_sizes = []
         for next_quality in range(streaming_enviroment.max_quality_level + 1):
-            next_video_chunk_sizes.append(streaming_enviroment.byte_size_match.iloc[
+            next_video_chunk_sizes.append(streaming_enviroment.byte_size_table[
                                               streaming_enviroment.video_chunk_counter, next_quality] / 1000. / 1000.)
         next_video_chunk_sizes = np.array(next_video_chunk_sizes)
         # retrieve previous state
@@ -265,6 +265,40 @@ class PensieveNN(ABRPolicy):
         return int(next_quality)
 
 
+class LookaheadTable:
+    def __init__(self):
+        """
+        Dynamic programming table of the recursive MPC lookahead. The keys are tuples
+        (steps to go, chunk, last level, buffer key), the value is the best reward which can still be obtained from
+        that state. Values depend on the bandwidth estimate and steps to go plus chunk is the same for every state of a
+        planning step, so no key of one planning step is ever looked up in the next one. The table only holds the
+        states of one planning step and is emptied before the next one, the hit and miss counters are kept
+        """
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, state_key):
+        """
+        :param state_key:
+        :return: value of the state or None if it wasn't solved yet
+        """
+        if state_key in self.entries:
+            self.hits += 1
+            return self.entries[state_key]
+        self.misses += 1
+        return None
+
+    def put(self, state_key, value):
+        self.entries[state_key] = value
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
 class MPC(ABRPolicy):
 
     def likelihood_last_decision(self):
@@ -272,7 +306,7 @@ class MPC(ABRPolicy):
 
     def __init__(self, abr_name, upscale_factor, downscale_factor,
                  throughput_predictor: ThroughputEstimator, max_quality_change, lookahead=5
-                 , deterministic=True, approximate=False):
+                 , deterministic=True, approximate=False, buffer_quantization_s=None):
 
         """
         Slightly adapted version of the algorithm found in https://conferences.sigcomm.org/sigcomm/2015/pdf/papers/p325.pdf
@@ -284,6 +318,8 @@ class MPC(ABRPolicy):
         :param lookahead: How far do we plan ahead
         :param deterministic: not relevant here
         :param approximate: not relevant here
+        :param buffer_quantization_s: None plans on the exact buffer. Otherwise the planned buffer is rounded down to
+        multiples of this and states with the same buffer bucket are solved once, which is faster but changes decisions
         """
         super().__init__(abr_name, max_quality_change, deterministic)
         self.approximate = approximate
@@ -291,17 +327,29 @@ class MPC(ABRPolicy):
         self.downscale_factor = downscale_factor
         self.throughput_predictor = throughput_predictor
         self.lookahead = lookahead
-        self.lookahead_dict = {}
+        self.buffer_quantization_s = buffer_quantization_s
+        self.lookahead_table = LookaheadTable()
 
     def copy(self):
         return MPC(self.abr_name, self.upscale_factor, self.downscale_factor,
                    self.throughput_predictor.copy(), self.max_quality_change, self.lookahead,
-                   self.deterministic, self.approximate)
+                   self.deterministic, self.approximate, self.buffer_quantization_s)
 
     def reset(self):
         super().reset()
         self.throughput_predictor.reset()
-        self.lookahead_dict = {}
+        self.lookahead_table.clear()
+
+    def quantize_buffer(self, buffer_size_s):
+        """
+        :param buffer_size_s: scalar or array
+        :return: buffer key of the dynamic programming table, buffer rounded down to the bucket. Without quantization
+        both are the buffer itself
+        """
+        if self.buffer_quantization_s is None:
+            return buffer_size_s, buffer_size_s
+        buffer_bucket = np.floor(buffer_size_s / self.buffer_quantization_s).astype(int)
+        return buffer_bucket, buffer_bucket * self.buffer_quantization_s
 
     def next_quality(self, observation, reward):
         """
@@ -335,7 +383,87 @@ class MPC(ABRPolicy):
     def solve_lookahead(self, streaming_enviroment, lookahead_to_go, video_chunk_counter, last_level, future_bandwidth,
                         buffer_size_s, data_used_bytes_relative):
         """
-        Recursive lookahead solver for the MPC planning step
+        MPC planning step, solved with vectorized arithmetic if the reward can be tabulated and the policy is
+        deterministic, otherwise with the recursive solver. Both choose the same quality with the same likelihood
+        :param streaming_enviroment:
+        :param lookahead_to_go: how far ahead do we still have to look
+        :param video_chunk_counter: Which chunk are we looking at
+        :param last_level: What was the last abr quality level
+        :param future_bandwidth: What is the future bandwidth estimate in Mbps
+        :param buffer_size_s: Current buffer size in s
+        :param data_used_bytes_relative: relative to what we had to sue if we were to download at the highest quality how much have we used
+        :return:
+        """
+        reward_table = streaming_enviroment.get_reward_table()
+        _, buffer_size_s = self.quantize_buffer(buffer_size_s)
+        if self.deterministic and reward_table is not None:
+            return self.solve_lookahead_vectorized(streaming_enviroment, reward_table, lookahead_to_go,
+                                                   video_chunk_counter, last_level, future_bandwidth, buffer_size_s)
+        # Solved states are only reused within this planning step
+        self.lookahead_table.clear()
+        return self.solve_lookahead_tree(streaming_enviroment, lookahead_to_go, video_chunk_counter, last_level,
+                                         future_bandwidth, buffer_size_s, data_used_bytes_relative)
+
+    def solve_lookahead_vectorized(self, streaming_enviroment, reward_table, lookahead_to_go, video_chunk_counter,
+                                   last_level, future_bandwidth, buffer_size_s):
+        """
+        Dynamic programming over the lookahead window without touching the enviroment. Every depth holds the distinct
+        (last level, buffer key) states, they are expanded at once with vectorized buffer and rebuffer arithmetic
+        :param streaming_enviroment:
+        :param reward_table: see StreamingEnviroment.get_reward_table
+        :param lookahead_to_go:
+        :param video_chunk_counter:
+        :param last_level:
+        :param future_bandwidth:
+        :param buffer_size_s: see quantize_buffer
+        :return:
+        """
+        n_steps = min(lookahead_to_go, streaming_enviroment.n_video_chunk - video_chunk_counter)
+        if n_steps <= 0:
+            return 0, 0, 0
+        quality_shifts = np.arange(-self.max_quality_change, self.max_quality_change + 1)
+        # The segment length isn't part of the lookahead history, the reward is normalised with the one of the
+        # last downloaded chunk
+        segment_length_s = streaming_enviroment.get_history('segment_length_s')[-1]
+        state_level = [np.array([last_level])]
+        state_buffer = [np.array([buffer_size_s], dtype=float)]
+        child_state = []
+        child_reward = []
+        for step in range(n_steps):
+            chunk_idx = video_chunk_counter + step
+            last_level_step = np.repeat(state_level[step], len(quality_shifts))
+            next_level = np.clip(last_level_step.reshape(-1, len(quality_shifts)) + quality_shifts, a_min=0,
+                                 a_max=streaming_enviroment.max_quality_level).ravel()
+            size_mbit = 8e-6 * streaming_enviroment.byte_size_table[chunk_idx, next_level]
+            download_bandwidth = np.where(next_level > last_level_step, future_bandwidth * self.upscale_factor,
+                                          np.where(next_level == last_level_step, future_bandwidth,
+                                                   future_bandwidth * self.downscale_factor))
+            buffer_size_new = np.repeat(state_buffer[step], len(quality_shifts)) - size_mbit / download_bandwidth
+            rebuffer_level_s = np.where(buffer_size_new < 0, np.abs(buffer_size_new), 0.)
+            buffer_size_new = np.where(buffer_size_new < 0, 0., buffer_size_new)
+            buffer_size_new += streaming_enviroment.seg_len_s_arr[chunk_idx]
+            buffer_key, buffer_size_new = self.quantize_buffer(buffer_size_new)
+            child_reward.append(reward_table.return_reward(chunk_idx, next_level, last_level_step, rebuffer_level_s,
+                                                           segment_length_s).reshape(-1, len(quality_shifts)))
+
+            _, first_idx, state_idx = np.unique(np.stack([next_level, buffer_key], axis=1), axis=0,
+                                                return_index=True, return_inverse=True)
+            child_state.append(state_idx.reshape(-1, len(quality_shifts)))
+            state_level.append(next_level[first_idx])
+            state_buffer.append(buffer_size_new[first_idx])
+
+        value = np.zeros(len(state_level[n_steps]))
+        for step in range(n_steps - 1, -1, -1):
+            path_value = child_reward[step] + value[child_state[step]]
+            if step == 0:
+                root_level = np.clip(last_level + quality_shifts, a_min=0, a_max=streaming_enviroment.max_quality_level)
+                return self.select_reward_to_propagate(list(zip(root_level, path_value[0])))
+            value = path_value.max(axis=1)
+
+    def solve_lookahead_tree(self, streaming_enviroment, lookahead_to_go, video_chunk_counter, last_level,
+                             future_bandwidth, buffer_size_s, data_used_bytes_relative):
+        """
+        Recursive lookahead solver for the MPC planning step, buffer_size_s has to be rounded with quantize_buffer
         :param streaming_enviroment:
         :param lookahead_to_go: how far ahead do we still have to look
         :param video_chunk_counter: Which chunk are we looking at
@@ -345,13 +473,17 @@ class MPC(ABRPolicy):
         :param data_used_bytes_relative: relative to what we had to sue if we were to download at the highest quality how much have we used
         :return:
         """
-        dynamic_prog_key = '%d_%d_%d_%.1f_%d' % (
-            lookahead_to_go, video_chunk_counter, last_level, future_bandwidth, int(buffer_size_s))
-        if dynamic_prog_key in self.lookahead_dict:
-            return self.lookahead_dict[dynamic_prog_key]
+        buffer_key = buffer_size_s
+        if self.buffer_quantization_s is not None:
+            # buffer_size_s is a multiple of the bucket size, rounding down could land in the bucket below
+            buffer_key = int(np.round(buffer_size_s / self.buffer_quantization_s))
+        dynamic_prog_key = (lookahead_to_go, video_chunk_counter, int(last_level), buffer_key)
+        solved_value = self.lookahead_table.get(dynamic_prog_key)
+        if solved_value is not None:
+            return solved_value, 0, 0  # Only values are kept, the planning step itself is never a solved state
         if lookahead_to_go == 0:
             return 0, 0, 0
-        if video_chunk_counter >= len(streaming_enviroment.byte_size_match):
+        if video_chunk_counter >= streaming_enviroment.n_video_chunk:
             return 0, 0, 0
         # Set possible quality shifts
         quality_choices = np.arange(last_level - self.max_quality_change, last_level + self.max_quality_change + 1)
@@ -360,6 +492,11 @@ class MPC(ABRPolicy):
         reward_list = []
         single_bitrate_list = []
         level_looked_at = []
+        reward_table = streaming_enviroment.get_reward_table()
+        if reward_table is not None:
+            # The segment length isn't part of the lookahead history, the reward is normalised with the one of the
+            # last downloaded chunk
+            segment_length_s = streaming_enviroment.get_history('segment_length_s')[-1]
 
         for next_level in quality_choices:
             if next_level in level_looked_at:
@@ -369,14 +506,12 @@ class MPC(ABRPolicy):
                 continue
             level_looked_at.append(next_level)
 
-            streaming_enviroment_state_save = streaming_enviroment.save_state()
-
-            video_chunk_size_byte = streaming_enviroment.byte_size_match.iloc[
+            video_chunk_size_byte = streaming_enviroment.byte_size_table[
                 video_chunk_counter, next_level]
             encoded_mbitrate = streaming_enviroment.get_encoded_bitrate(next_level) * 1e-6
-            current_mbitrate = streaming_enviroment.bitrate_match.iloc[
+            current_mbitrate = streaming_enviroment.bitrate_table[
                                    video_chunk_counter, next_level] * 1e-6
-            vmaf = streaming_enviroment.vmaf_match.iloc[video_chunk_counter, next_level]
+            vmaf = streaming_enviroment.vmaf_table[video_chunk_counter, next_level]
             size_mbit = 8e-6 * video_chunk_size_byte
             if next_level > last_level:
                 download_time_s = size_mbit / (
@@ -392,32 +527,42 @@ class MPC(ABRPolicy):
                 rebuffer_level_s = np.abs(buffer_size_new)
                 buffer_size_new = 0
             single_bitrate_list.append(current_mbitrate)
-            buffer_size_new += streaming_enviroment.video_information_csv.seg_len_s[
+            buffer_size_new += streaming_enviroment.seg_len_s_arr[
                 video_chunk_counter]
+            _, buffer_size_new = self.quantize_buffer(buffer_size_new)
             data_used_bytes_new = data_used_bytes_relative + video_chunk_size_byte
-            ####################################################################
-            streaming_enviroment.data_used_relative.append(data_used_bytes_new)
-            streaming_enviroment.quality_arr.append(next_level)
-            streaming_enviroment.buffer_size_arr.append(buffer_size_new)
-            streaming_enviroment.encoded_mbitrate_arr.append(encoded_mbitrate)
-            streaming_enviroment.single_mbitrate_arr.append(current_mbitrate)
-            streaming_enviroment.vmaf_arr.append(vmaf)
-            streaming_enviroment.rebuffer_time_arr.append(rebuffer_level_s)
-            ####################################################################
-            observation = streaming_enviroment.generate_observation_dictionary()
-            assert observation['current_level'][-1] == next_level, "Adding to the array didn't go as planned"
-            assert observation['rebuffer_time_s'][-1] == rebuffer_level_s, "Adding to the array didn't go as planned"
-            current_reward = streaming_enviroment.reward_function.return_reward_observation(observation)
-            future_reward, _, _ = self.solve_lookahead(streaming_enviroment,
-                                                       video_chunk_counter=video_chunk_counter + 1,
-                                                       lookahead_to_go=lookahead_to_go - 1,
-                                                       last_level=next_level,
-                                                       future_bandwidth=future_bandwidth,
-                                                       buffer_size_s=buffer_size_new,
-                                                       data_used_bytes_relative=data_used_bytes_new)
+            streaming_enviroment_state_save = None
+            if reward_table is not None:
+                current_reward = reward_table.return_reward(video_chunk_counter, next_level, last_level,
+                                                            rebuffer_level_s, segment_length_s)
+            else:
+                streaming_enviroment_state_save = streaming_enviroment.save_state()
+                ####################################################################
+                streaming_enviroment.append_history('data_used_bytes_relative', data_used_bytes_new)
+                streaming_enviroment.append_history('current_level', next_level)
+                streaming_enviroment.append_history('buffer_size_s', buffer_size_new)
+                streaming_enviroment.append_history('encoded_mbitrate', encoded_mbitrate)
+                streaming_enviroment.append_history('single_mbitrate', current_mbitrate)
+                streaming_enviroment.append_history('vmaf', vmaf)
+                streaming_enviroment.append_history('rebuffer_time_s', rebuffer_level_s)
+                ####################################################################
+                observation = streaming_enviroment.generate_observation_dictionary()
+                assert observation['current_level'][-1] == next_level, "Adding to the array didn't go as planned"
+                assert observation['rebuffer_time_s'][-1] == rebuffer_level_s, \
+                    "Adding to the array didn't go as planned"
+                current_reward = streaming_enviroment.reward_function.return_reward_observation(observation)
+            future_reward, _, _ = self.solve_lookahead_tree(streaming_enviroment,
+                                                            video_chunk_counter=video_chunk_counter + 1,
+                                                            lookahead_to_go=lookahead_to_go - 1,
+                                                            last_level=next_level,
+                                                            future_bandwidth=future_bandwidth,
+                                                            buffer_size_s=buffer_size_new,
+                                                            data_used_bytes_relative=data_used_bytes_new)
             reward_list.append((next_level, current_reward + future_reward))
-            streaming_enviroment.set_state(streaming_enviroment_state_save)
-        self.lookahead_dict[dynamic_prog_key] = self.select_reward_to_propagate(reward_list)
+            if streaming_enviroment_state_save is not None:
+                streaming_enviroment.set_state(streaming_enviroment_state_save)
+        solved_lookahead = self.select_reward_to_propagate(reward_list)
+        self.lookahead_table.put(dynamic_prog_key, solved_lookahead[0])
         #print(reward_list,lookahead_to_go)
         # print('\t' * (2 - lookahead_to_go) +'last quality : %d' % last_level + 'reward list : '+ str(reward_list) + ' bitrate list ' + str(single_bitrate_list))
-        return self.lookahead_dict[dynamic_prog_key]
+        return solved_lookahead
@@ -4,6 +4,8 @@ import numpy as np
 
 from ABRPolicies.ComplexABRPolicy import MPC
 from ABRPolicies.ThroughputEstimator import StepEstimator
+from SimulationEnviroment import ChunkKernel
+from SimulationEnviroment.ChunkKernel import njit
 
 LOGGING_LEVEL = logging.INFO
 handler = logging.StreamHandler()
@@ -15,33 +17,379 @@ logger.setLevel(LOGGING_LEVEL)
 logger.addHandler(handler)
 
 
+@njit(cache=True)
+def dominated_states(level, value, deadline_value):
+    """
+    States which are dominated by an earlier state, i.e. a state with the same level and a value and deadline value
+    which are at least as large
+    :param level: per state, sorted
+    :param value: per state
+    :param deadline_value: per state
+    :return: per state
+    """
+    n_state = len(level)
+    is_dominated = np.zeros(n_state, dtype=np.bool_)
+    # Values of the non dominated states seen so far, value decreasing and deadline_value increasing
+    front_value = np.empty(n_state)
+    front_deadline_value = np.empty(n_state)
+    front_len = 0
+    for state_idx in range(n_state):
+        if state_idx == 0 or level[state_idx] != level[state_idx - 1]:
+            front_len = 0
+        # The front states with a larger value are the first ones, the last of them has the largest deadline_value
+        insert_idx = np.searchsorted(-front_value[:front_len], -value[state_idx], side='right')
+        if insert_idx > 0 and front_deadline_value[insert_idx - 1] >= deadline_value[state_idx]:
+            is_dominated[state_idx] = True
+            continue
+        end_idx = insert_idx
+        while end_idx < front_len and front_deadline_value[end_idx] <= deadline_value[state_idx]:
+            end_idx += 1
+        n_removed = end_idx - insert_idx
+        if n_removed == 0:
+            front_value[insert_idx + 1:front_len + 1] = front_value[insert_idx:front_len].copy()
+            front_deadline_value[insert_idx + 1:front_len + 1] = front_deadline_value[insert_idx:front_len].copy()
+        else:
+            front_value[insert_idx + 1:front_len - n_removed + 1] = front_value[end_idx:front_len].copy()
+            front_deadline_value[insert_idx + 1:front_len - n_removed + 1] = front_deadline_value[
+                                                                             end_idx:front_len].copy()
+        front_value[insert_idx] = value[state_idx]
+        front_deadline_value[insert_idx] = deadline_value[state_idx]
+        front_len += 1 - n_removed
+    return is_dominated
+
+
+class TraceOracle:
+    def __init__(self, max_quality_change, buffer_quantization_s=None, trace_quantization_s=None,
+                 minimize_reward=False, max_states=10 ** 7):
+        """
+        Plans a quality sequence on the real bandwidth trace of an OfflineStreaming enviroment. Every (state, level)
+        transition is simulated exactly with the prefix sum kernel. The states reached after every chunk are merged on
+        (level, buffer, trace position), a merged state continues from the arrival with the best reward so far.
+        The values of the next quality levels are solved with backward induction over the merged states, the best
+        quality sequence is the path of the best final state, its value is exact.
+        Without quantization only identical states are merged and the result is the same as the exhaustive search,
+        which grows exponentially with the number of chunks. With quantization whole videos can be planned, but the
+        sequence isn't guaranteed to be the best one, see upper_bound for how far it can be from the best one
+        :param max_quality_change:
+        :param buffer_quantization_s: Buffer bucket size, None merges only identical buffers
+        :param trace_quantization_s: Trace position bucket size, None merges only identical trace positions
+        :param minimize_reward: Plan the worst instead of the best sequence
+        :param max_states: Number of states kept for all chunks together after which planning stops with a ValueError
+        """
+        self.max_quality_change = max_quality_change
+        self.buffer_quantization_s = buffer_quantization_s
+        self.trace_quantization_s = trace_quantization_s
+        self.minimize_reward = minimize_reward
+        self.max_states = max_states
+
+    def state_key(self, level, buffer_size_ms, mahimahi_ptr, last_mahimahi_time):
+        state_key = [level]
+        if self.buffer_quantization_s is None:
+            state_key.append(buffer_size_ms)
+        else:
+            state_key.append(np.floor(buffer_size_ms / (self.buffer_quantization_s * 1000.)))
+        if self.trace_quantization_s is None:
+            state_key += [last_mahimahi_time, mahimahi_ptr]
+        else:
+            state_key.append(np.floor(last_mahimahi_time / self.trace_quantization_s))
+        return state_key
+
+    def group_states(self, state_key, order_value):
+        """
+        :param state_key: list of key columns
+        :param order_value: arrivals with the same key are sorted by this
+        :return: arrivals sorted by key and order_value, merged state of every sorted arrival, first arrival of every
+        merged state in the sorted arrivals
+        """
+        arrival_order = np.lexsort([order_value] + state_key[::-1])
+        is_first = np.ones(len(arrival_order), dtype=bool)
+        for key_column in state_key:
+            key_column = key_column[arrival_order]
+            is_first[1:] &= key_column[1:] == key_column[:-1]
+        is_first[1:] = ~is_first[1:]
+        return arrival_order, np.cumsum(is_first) - 1, is_first
+
+    def merge_states(self, state_key, forward_value):
+        """
+        :param state_key: list of key columns
+        :param forward_value: reward obtained until the state
+        :return: index of the arrival every merged state continues from, merged state of every arrival
+        """
+        arrival_order, sorted_state_idx, is_first = self.group_states(
+            state_key, forward_value if self.minimize_reward else -forward_value)
+        state_idx = np.empty(len(arrival_order), dtype=int)
+        state_idx[arrival_order] = sorted_state_idx
+        return arrival_order[is_first], state_idx
+
+    def check_state_budget(self, n_states):
+        if n_states > self.max_states:
+            raise ValueError('Planning needs more than %d states, set buffer_quantization_s and trace_quantization_s '
+                             'or raise max_states' % self.max_states)
+
+    def chunk_dynamics(self, streaming_enviroment, chunk_idx, next_level, mahimahi_ptr, last_mahimahi_time,
+                       buffer_size_ms, buffer_threshold_ms):
+        """
+        Download chunk_idx in next_level from every state with the prefix sum kernel
+        :return: see ChunkKernel.batch_chunk_dynamics
+        """
+        return ChunkKernel.batch_chunk_dynamics(
+            streaming_enviroment.cooked_time_arr[None], streaming_enviroment.cooked_bw_arr[None],
+            streaming_enviroment.cumulative_time[None], streaming_enviroment.cumulative_byte[None],
+            np.array([len(streaming_enviroment.cooked_time_arr)]), np.zeros(len(next_level), dtype=np.int64),
+            mahimahi_ptr, last_mahimahi_time, buffer_size_ms,
+            streaming_enviroment.byte_size_table[chunk_idx, next_level].astype(float),
+            np.full(len(next_level), streaming_enviroment.seg_len_s_arr[chunk_idx] * 1000.),
+            float(streaming_enviroment.packet_payload_portion), float(streaming_enviroment.link_rtt_ms),
+            float(buffer_threshold_ms), float(streaming_enviroment.drain_buffer_sleep_ms))
+
+    def solve(self, streaming_enviroment, reward_table, last_level, n_chunks):
+        """
+        Plan the next n_chunks chunks starting from the current state of the enviroment, which isn't modified
+        :param streaming_enviroment: OfflineStreaming
+        :param reward_table: see StreamingEnviroment.get_reward_table
+        :param last_level: level of the last downloaded chunk
+        :param n_chunks: planning horizon, at most the remaining chunks of the video
+        :return: level choices for the next chunk, value of each choice, best quality sequence, value of the sequence
+        """
+        assert 0 < n_chunks <= streaming_enviroment.n_video_chunk - streaming_enviroment.video_chunk_counter
+        quality_shifts = np.arange(-self.max_quality_change, self.max_quality_change + 1)
+        level = np.array([last_level])
+        mahimahi_ptr = np.array([streaming_enviroment.mahimahi_ptr], dtype=np.int64)
+        last_mahimahi_time = np.array([streaming_enviroment.last_mahimahi_time], dtype=float)
+        buffer_size_ms = np.array([streaming_enviroment.buffer_size_ms], dtype=float)
+        forward_value = np.zeros(1)
+        stage_list = []
+        n_states = 0
+        for step in range(n_chunks):
+            chunk_idx = streaming_enviroment.video_chunk_counter + step
+            n_states += len(level) * len(quality_shifts)
+            self.check_state_budget(n_states)
+            last_level_step = np.repeat(level, len(quality_shifts))
+            next_level = np.clip(level[:, None] + quality_shifts, a_min=0,
+                                 a_max=streaming_enviroment.max_quality_level).ravel()
+            (_, rebuffer_time_ms, _, buffer_size_ms, mahimahi_ptr, last_mahimahi_time) = self.chunk_dynamics(
+                streaming_enviroment, chunk_idx, next_level, np.repeat(mahimahi_ptr, len(quality_shifts)),
+                np.repeat(last_mahimahi_time, len(quality_shifts)), np.repeat(buffer_size_ms, len(quality_shifts)),
+                streaming_enviroment.buffer_threshold_ms)
+            reward = reward_table.return_reward(chunk_idx, next_level, last_level_step, rebuffer_time_ms / 1000.)
+            forward_value = np.repeat(forward_value, len(quality_shifts)) + reward
+            arrival_idx, state_idx = self.merge_states(
+                self.state_key(next_level, buffer_size_ms, mahimahi_ptr, last_mahimahi_time), forward_value)
+            stage_list.append((reward.reshape(-1, len(quality_shifts)), state_idx.reshape(-1, len(quality_shifts)),
+                               next_level, arrival_idx))
+            level, buffer_size_ms, forward_value = next_level[arrival_idx], buffer_size_ms[arrival_idx], forward_value[
+                arrival_idx]
+            mahimahi_ptr, last_mahimahi_time = mahimahi_ptr[arrival_idx], last_mahimahi_time[arrival_idx]
+
+        """
+        Backward induction over the merged states
+        """
+        value = np.zeros(len(level))
+        for reward, state_idx, _, _ in reversed(stage_list):
+            path_value = reward + value[state_idx]
+            if self.minimize_reward:
+                value = path_value.min(axis=1)
+            else:
+                value = path_value.max(axis=1)
+
+        """
+        Path of the best final state
+        """
+        current_state = forward_value.argmin() if self.minimize_reward else forward_value.argmax()
+        sequence_value = forward_value[current_state]
+        quality_sequence = []
+        for _, _, next_level, arrival_idx in reversed(stage_list):
+            quality_sequence.insert(0, int(next_level[arrival_idx[current_state]]))
+            current_state = arrival_idx[current_state] // len(quality_shifts)
+        return stage_list[0][2], path_value[0], quality_sequence, sequence_value
+
+    def upper_bound(self, streaming_enviroment, reward_table, last_level, n_chunks):
+        """
+        Upper bound of the best reward of the next n_chunks, which holds for any quantization.
+        The bound is planned on a relaxation of the enviroment which can only be better than the enviroment:
+        the buffer isn't drained by sleeping and every rebuffer second costs the least it costs for any of the chunks.
+        Let the deadline be the trace time plus the buffer. In the relaxation a state is at least as good as another
+        state with the same level if it is earlier on the trace and its reward exceeds the reward of the other state
+        by at least the rebuffer cost of its missing deadline. Dominated states are dropped and merged states continue
+        from the earliest trace time, the latest deadline and the best reward of their arrivals. This holds up to the
+        rounding of the floating point arithmetic
+        :param streaming_enviroment: OfflineStreaming, isn't modified
+        :param reward_table: see StreamingEnviroment.get_reward_table
+        :param last_level: level of the last downloaded chunk
+        :param n_chunks: planning horizon, at most the remaining chunks of the video
+        :return: upper bound of the reward of the next n_chunks
+        """
+        bound_value, _ = self.forward_search(streaming_enviroment, reward_table, last_level, n_chunks, relaxed=True)
+        return bound_value
+
+    def search_sequence(self, streaming_enviroment, reward_table, last_level, n_chunks):
+        """
+        Quality sequence for the next n_chunks found with the forward pass of upper_bound on the enviroment itself.
+        Every merged state continues from its best arrival, so the reward of the sequence is exact, but as the dropped
+        states aren't guaranteed to be dominated in the enviroment the sequence isn't guaranteed to be the best one.
+        Unlike solve it scales to whole videos
+        :param streaming_enviroment: OfflineStreaming, isn't modified
+        :param reward_table: see StreamingEnviroment.get_reward_table
+        :param last_level: level of the last downloaded chunk
+        :param n_chunks: planning horizon, at most the remaining chunks of the video
+        :return: quality sequence, value of the sequence
+        """
+        sequence_value, quality_sequence = self.forward_search(streaming_enviroment, reward_table, last_level,
+                                                               n_chunks, relaxed=False)
+        return quality_sequence, sequence_value
+
+    def forward_search(self, streaming_enviroment, reward_table, last_level, n_chunks, relaxed):
+        """
+        See upper_bound and search_sequence
+        :param relaxed: Plan on the relaxation of upper_bound instead of the enviroment
+        :return: best value of the final states, quality sequence of the best final state
+        """
+        assert not self.minimize_reward, 'Only the best sequence is searched'
+        assert 0 < n_chunks <= streaming_enviroment.n_video_chunk - streaming_enviroment.video_chunk_counter
+        assert reward_table.rebuffer_penalty >= 0, 'Rebuffering has to be penalised'
+        planned_chunks = np.arange(streaming_enviroment.video_chunk_counter,
+                                   streaming_enviroment.video_chunk_counter + n_chunks)
+        rebuffer_penalty_s = reward_table.rebuffer_penalty / reward_table.segment_length_s[planned_chunks].max()
+        buffer_threshold_ms = np.inf if relaxed else streaming_enviroment.buffer_threshold_ms
+        quality_shifts = np.arange(-self.max_quality_change, self.max_quality_change + 1)
+        level = np.array([last_level])
+        mahimahi_ptr = np.array([streaming_enviroment.mahimahi_ptr], dtype=np.int64)
+        last_mahimahi_time = np.array([streaming_enviroment.last_mahimahi_time], dtype=float)
+        buffer_size_ms = np.array([streaming_enviroment.buffer_size_ms], dtype=float)
+        trace_time_ms = np.zeros(1)  # Trace time since the start of planning, doesn't wrap around with the trace
+        forward_value = np.zeros(1)
+        stage_list = []
+        n_states = 0
+        for chunk_idx in planned_chunks:
+            last_level_step = np.repeat(level, len(quality_shifts))
+            next_level = np.clip(level[:, None] + quality_shifts, a_min=0,
+                                 a_max=streaming_enviroment.max_quality_level).ravel()
+            buffer_size_ms = np.repeat(buffer_size_ms, len(quality_shifts))
+            (downloadtime_ms, rebuffer_time_ms, _, next_buffer_size_ms, mahimahi_ptr,
+             last_mahimahi_time) = self.chunk_dynamics(
+                streaming_enviroment, chunk_idx, next_level, np.repeat(mahimahi_ptr, len(quality_shifts)),
+                np.repeat(last_mahimahi_time, len(quality_shifts)), buffer_size_ms, buffer_threshold_ms)
+            # Sleeping moves along the trace and drains the buffer by the same time, the deadline stays the same
+            deadline_ms = np.repeat(trace_time_ms, len(quality_shifts)) + downloadtime_ms - float(
+                streaming_enviroment.link_rtt_ms) + np.maximum(buffer_size_ms - downloadtime_ms, 0.) + \
+                          streaming_enviroment.seg_len_s_arr[chunk_idx] * 1000.
+            trace_time_ms, buffer_size_ms = deadline_ms - next_buffer_size_ms, next_buffer_size_ms
+            forward_value = np.repeat(forward_value, len(quality_shifts))
+            if relaxed:
+                forward_value = forward_value + reward_table.return_reward(
+                    chunk_idx, next_level, last_level_step, 0.) - rebuffer_penalty_s * rebuffer_time_ms / 1000.
+            else:
+                forward_value = forward_value + reward_table.return_reward(chunk_idx, next_level, last_level_step,
+                                                                           rebuffer_time_ms / 1000.)
+
+            """
+            Merge the arrivals of every state, the best arrival is the one the quality sequence continues from
+            """
+            arrival_order, state_idx, is_first = self.group_states(
+                self.state_key(next_level, buffer_size_ms, mahimahi_ptr, trace_time_ms / 1000.),
+                trace_time_ms if relaxed else -forward_value)
+            best_value = np.full(np.count_nonzero(is_first), -np.inf)
+            np.maximum.at(best_value, state_idx, forward_value[arrival_order])
+            best_arrival = np.empty(len(best_value), dtype=int)
+            is_best = forward_value[arrival_order] == best_value[state_idx]
+            best_arrival[state_idx[is_best]] = arrival_order[is_best]
+            if relaxed:
+                earliest_arrival = arrival_order[is_first]
+                latest_deadline_ms = np.full(len(best_value), -np.inf)
+                np.maximum.at(latest_deadline_ms, state_idx, deadline_ms[arrival_order])
+            else:
+                earliest_arrival = best_arrival
+                latest_deadline_ms = deadline_ms[best_arrival]
+
+            """
+            Drop the dominated states
+            """
+            level, trace_time_ms = next_level[earliest_arrival], trace_time_ms[earliest_arrival]
+            state_order = np.lexsort([trace_time_ms, level])
+            state_order = state_order[~dominated_states(level[state_order], best_value[state_order],
+                                                        best_value[state_order] + rebuffer_penalty_s *
+                                                        latest_deadline_ms[state_order] / 1000.)]
+            earliest_arrival, best_arrival = earliest_arrival[state_order], best_arrival[state_order]
+            n_states += len(state_order)
+            self.check_state_budget(n_states)
+            stage_list.append((level[state_order], best_arrival // len(quality_shifts)))
+            level, trace_time_ms, forward_value = level[state_order], trace_time_ms[state_order], best_value[
+                state_order]
+            mahimahi_ptr, last_mahimahi_time = mahimahi_ptr[earliest_arrival], last_mahimahi_time[earliest_arrival]
+            if relaxed:
+                buffer_size_ms = latest_deadline_ms[state_order] - trace_time_ms
+            else:
+                buffer_size_ms = buffer_size_ms[earliest_arrival]
+
+        current_state = forward_value.argmax()
+        quality_sequence = []
+        for level, parent_state in reversed(stage_list):
+            quality_sequence.insert(0, int(level[current_state]))
+            current_state = parent_state[current_state]
+        return forward_value.max(), quality_sequence
+
+
 class Optimal(MPC):
+    minimize_reward = False
 
     def __init__(self, abr_name, max_quality_change,
-                 lookahead=5, deterministic=True):
+                 lookahead=5, deterministic=True, buffer_quantization_s=None, trace_quantization_s=None):
         """
         Derivative of MPC which simulates the future with the actual bandwidth and chooses the actions which maximise the QoE
         :param abr_name:
         :param max_quality_change:
-        :param lookahead:
+        :param lookahead: None plans until the end of the video
         :param deterministic:
+        :param buffer_quantization_s: see TraceOracle
+        :param trace_quantization_s: see TraceOracle
         """
         throughput_predictor = StepEstimator(consider_last_n_steps=1,
                                              predictor_function=np.mean,
                                              robust_estimate=False)  # Dummy Value so we can use the rest of the function
         super().__init__(abr_name, 1.0, 1.0, throughput_predictor,
                          max_quality_change, lookahead, deterministic)
+        self.trace_oracle = TraceOracle(max_quality_change, buffer_quantization_s, trace_quantization_s,
+                                        self.minimize_reward)
 
     def copy(self):
-        return Optimal(self.abr_name, self.max_quality_change,
-                 self.lookahead, self.deterministic)
+        return self.__class__(self.abr_name, self.max_quality_change, self.lookahead, self.deterministic,
+                              self.trace_oracle.buffer_quantization_s, self.trace_oracle.trace_quantization_s)
+
+    def download_reward(self, streaming_enviroment, reward_table, next_level, last_level):
+        """
+        Download the next chunk in the enviroment and score it, with the reward table only the trace is simulated
+        :param streaming_enviroment:
+        :param reward_table: see StreamingEnviroment.get_reward_table
+        :param next_level:
+        :param last_level: level of the chunk before
+        :return: reward of the chunk
+        """
+        if reward_table is None:
+            observation, current_reward, end_of_video, info = streaming_enviroment.get_video_chunk(next_level)
+            return current_reward
+        chunk_idx = streaming_enviroment.video_chunk_counter
+        _, _, rebuffer_time_ms, _ = streaming_enviroment.download_chunk(next_level)
+        return reward_table.return_reward(chunk_idx, next_level, last_level, rebuffer_time_ms / 1000.)
 
     def solve_lookahead(self, streaming_enviroment, lookahead_to_go, video_chunk_counter, last_level, future_bandwidth,
                         buffer_size_s, data_used_bytes_relative):
+        """
+        Solved with the TraceOracle if the reward can be tabulated and the policy is deterministic, otherwise by
+        recursively simulating every branch
+        """
+        if lookahead_to_go is None:
+            lookahead_to_go = streaming_enviroment.n_video_chunk - video_chunk_counter
         if lookahead_to_go == 0:
             return 0, 0, 0
-        if video_chunk_counter >= len(streaming_enviroment.byte_size_match):
+        if video_chunk_counter >= streaming_enviroment.n_video_chunk:
             return 0, 0, 0
+        reward_table = streaming_enviroment.get_reward_table()
+        if self.deterministic and reward_table is not None:
+            level_choices, choice_value, _, _ = self.trace_oracle.solve(
+                streaming_enviroment, reward_table, last_level,
+                min(lookahead_to_go, streaming_enviroment.n_video_chunk - video_chunk_counter))
+            return self.select_reward_to_propagate(list(zip(level_choices, choice_value)),
+                                                   inverse=self.minimize_reward)
         # Set possible quality shifts
         quality_choices = np.arange(last_level - self.max_quality_change, last_level + self.max_quality_change + 1)
         # Limit the choices to possible quality shifts
@@ -55,8 +403,9 @@ class Optimal(MPC):
                 # three levels max 2 changes [calc,take_last,calculate,calculate,take_last]
                 reward_list.append((next_level, current_reward + future_reward))
                 continue
+            level_looked_at.append(next_level)
             streaming_enviroment_state_save = streaming_enviroment.save_state()
-            observation, current_reward, end_of_video, info = streaming_enviroment.get_video_chunk(next_level)
+            current_reward = self.download_reward(streaming_enviroment, reward_table, next_level, last_level)
             future_reward, _, _ = self.solve_lookahead(streaming_enviroment,
                                                        lookahead_to_go=lookahead_to_go - 1,
                                                        video_chunk_counter = video_chunk_counter+1,
@@ -66,45 +415,11 @@ class Optimal(MPC):
                                                        data_used_bytes_relative=None)
             reward_list.append((next_level, current_reward + future_reward))
             streaming_enviroment.set_state(streaming_enviroment_state_save)
-        return self.select_reward_to_propagate(reward_list)
+        return self.select_reward_to_propagate(reward_list, inverse=self.minimize_reward)
 
 
 class Worst(Optimal):
     """
     Derivative of MPC which simulates the future with the actual bandwidth and chooses the actions which minimise the QoE
     """
-    def copy(self):
-        return Worst(self.abr_name, self.max_quality_change,
-                 self.lookahead, self.deterministic)
-
-    def solve_lookahead(self, streaming_enviroment, lookahead_to_go, video_chunk_counter, last_level, future_bandwidth,
-                        buffer_size_s, data_used_bytes_relative):
-        if lookahead_to_go == 0:
-            return 0, 0, 0
-        if video_chunk_counter >= len(streaming_enviroment.byte_size_match):
-            return 0, 0, 0
-        # Set possible quality shifts
-        quality_choices = np.arange(last_level - self.max_quality_change, last_level + self.max_quality_change + 1)
-        # Limit the choices to possible quality shifts
-        quality_choices = np.clip(quality_choices, a_min=0, a_max=streaming_enviroment.max_quality_level)
-        reward_list = []
-        level_looked_at = []
-        for next_level in quality_choices:
-            if next_level in level_looked_at :
-                # Reuse the last calculated current_reward and future_reward
-                # three levels max 2 changes [calc,take_last,calculate,calculate,take_last]
-                reward_list.append((next_level, current_reward + future_reward))
-                continue
-            level_looked_at.append(next_level)
-            streaming_enviroment_state_save = streaming_enviroment.save_state()
-            observation, current_reward, end_of_video, info = streaming_enviroment.get_video_chunk(next_level)
-            future_reward, _, _ = self.solve_lookahead(streaming_enviroment,
-                                                       lookahead_to_go=lookahead_to_go - 1,
-                                                       video_chunk_counter = video_chunk_counter+1,
-                                                       last_level=next_level,
-                                                       future_bandwidth=None,
-                                                       buffer_size_s=None,
-                                                       data_used_bytes_relative=None)
-            reward_list.append((next_level, current_reward + future_reward))
-            streaming_enviroment.set_state(streaming_enviroment_state_save)
-        return self.select_reward_to_propagate(reward_list,inverse=True)
+    minimize_reward = True
@@ -114,7 +114,7 @@ class Rate(MPC):
                         buffer_size_s, data_used_bytes_relative):
         if lookahead_to_go == 0:
             return 0, 0, 0
-        if streaming_enviroment.video_chunk_counter >= len(streaming_enviroment.byte_size_match):
+        if streaming_enviroment.video_chunk_counter >= streaming_enviroment.n_video_chunk:
             return 0, 0, 0
         # Set possible quality shifts
         quality_choices = np.arange(last_level - self.max_quality_change, last_level + self.max_quality_change + 1)
@@ -122,7 +122,7 @@ class Rate(MPC):
         quality_choices = np.clip(quality_choices, a_min=0, a_max=streaming_enviroment.max_quality_level)
         reward_list = []
         for next_level in quality_choices:
-            bitrate_bit = streaming_enviroment.bitrate_match.iloc[streaming_enviroment.video_chunk_counter, next_level]
+            bitrate_bit = streaming_enviroment.bitrate_table[streaming_enviroment.video_chunk_counter, next_level]
             bitrate_mbit = 1e-6 * bitrate_bit
             if next_level > last_level:
                 future_bandwidth = future_bandwidth * self.upscale_factor  # Used in the Shaka Player
@@ -161,7 +161,7 @@ class BBA(ABRPolicy):
         buffer_level_available = np.linspace(self.reservoir, self.cushion, num=streaming_enviroment.max_quality_level)
         if lookahead_to_go == 0:
             return 0, 0, 0
-        if video_chunk_counter >= len(streaming_enviroment.byte_size_match):
+        if video_chunk_counter >= streaming_enviroment.n_video_chunk:
             return 0, 0, 0
         # Set possible quality shifts
         quality_choices = np.arange(last_level - self.max_quality_change, last_level + self.max_quality_change + 1)
@@ -202,7 +202,7 @@ class DownloadTime(MPC):
                         buffer_size_s, data_used_bytes_relative):
         if lookahead_to_go == 0:
             return 0, 0, 0
-        if video_chunk_counter >= len(streaming_enviroment.byte_size_match):
+        if video_chunk_counter >= streaming_enviroment.n_video_chunk:
             return 0, 0, 0
         # Set possible quality shifts
         quality_choices = np.arange(last_level - self.max_quality_change, last_level + self.max_quality_change + 1)
@@ -210,9 +210,9 @@ class DownloadTime(MPC):
         quality_choices = np.clip(quality_choices, a_min=0, a_max=streaming_enviroment.max_quality_level)
         reward_list = []
         for next_level in quality_choices:
-            bitrate_bit = streaming_enviroment.bitrate_match.iloc[streaming_enviroment.video_chunk_counter, next_level]
+            bitrate_bit = streaming_enviroment.bitrate_table[streaming_enviroment.video_chunk_counter, next_level]
             bitrate_mbit = 1e-6 * bitrate_bit
-            video_chunk_size_byte = streaming_enviroment.byte_size_match.iloc[
+            video_chunk_size_byte = streaming_enviroment.byte_size_table[
                 streaming_enviroment.video_chunk_counter, next_level]
             size_mbit = 8e-6 * video_chunk_size_byte
             if next_level > last_level:
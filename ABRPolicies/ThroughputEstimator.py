@@ -1,29 +1,215 @@
 from abc import ABC, abstractmethod
+from bisect import bisect_left, insort
+from collections import deque
 
 import numpy as np
-import pandas as pd
 
 """
 Contains throughput estimator base function and simple predictors
 """
 
 
+class RecursivePredictor(ABC):
+    """
+    Predictor which can be updated one value at a time. Calling it on an array gives the same value as adding the
+    values one by one to a new running predictor
+    """
+
+    @abstractmethod
+    def running_predictor(self):
+        pass
+
+    def __call__(self, value_arr):
+        running_predictor = self.running_predictor()
+        for value in value_arr:
+            running_predictor.add_value(value)
+        return running_predictor.value()
+
+
+class WindowPredictor(RecursivePredictor):
+    """
+    Recursive predictor whose running predictor can also drop the oldest values of a window with remove_value
+    """
+    pass
+
+
+class RunningExponentialWeightedMovingAverage:
+    def __init__(self, alpha):
+        """
+        Same recursion and floating point operations as pd.Series(value_arr).ewm(alpha=alpha, adjust=False).mean()
+        :param alpha:
+        """
+        center_of_mass = (1.0 - alpha) / alpha
+        self.alpha = 1. / (1. + center_of_mass)
+        self.old_weight_factor = 1. - self.alpha
+        self.old_weight = 1.
+        self.weighted_average = np.nan
+        self.n_values = 0
+
+    def add_value(self, value):
+        value = float(value)
+        if self.n_values == 0:
+            self.weighted_average = value
+        elif self.weighted_average == self.weighted_average:
+            self.old_weight *= self.old_weight_factor
+            if value == value:
+                # avoid numerical errors on constant series
+                if self.weighted_average != value:
+                    self.weighted_average = ((self.old_weight * self.weighted_average) + (self.alpha * value)) / (
+                            self.old_weight + self.alpha)
+                self.old_weight = 1.
+        elif value == value:
+            self.weighted_average = value
+        self.n_values += 1
+
+    def value(self):
+        if self.n_values == 0:
+            raise IndexError('No values to average')
+        return np.float64(self.weighted_average)
+
+
+class RunningMinimum:
+    def __init__(self, running_predictors):
+        self.running_predictors = running_predictors
+
+    def add_value(self, value):
+        for running_predictor in self.running_predictors:
+            running_predictor.add_value(value)
+
+    def value(self):
+        return np.min([running_predictor.value() for running_predictor in self.running_predictors])
+
+
+class RunningHarmonicMean:
+    # Every float is an integer multiple of 1 / EXACT_SUM_SCALE
+    EXACT_SUM_SCALE = 2 ** 1074
+
+    def __init__(self):
+        """
+        Harmonic mean from a running sum of the reciprocals. The sum is kept exactly as an integer multiple of
+        1 / EXACT_SUM_SCALE, so removing values doesn't accumulate rounding errors. Same value as scipy.stats.hmean up
+        to the rounding of the sum, which scipy adds up in floating point
+        """
+        self.reciprocal_sum = 0
+        self.n_values = 0
+        self.n_zero = 0
+        self.n_invalid = 0  # NaN or negative
+
+    def count_value(self, value, count):
+        value = float(value)
+        self.n_values += count
+        if not value >= 0:
+            self.n_invalid += count
+        elif value == 0 or 1.0 / value == np.inf:
+            self.n_zero += count
+        else:
+            numerator, denominator = (1.0 / value).as_integer_ratio()
+            self.reciprocal_sum += count * numerator * (self.EXACT_SUM_SCALE // denominator)
+
+    def add_value(self, value):
+        self.count_value(value, 1)
+
+    def remove_value(self, value):
+        self.count_value(value, -1)
+
+    def value(self):
+        if self.n_values == 0 or self.n_invalid > 0:
+            return np.float64(np.nan)
+        if self.n_zero > 0:
+            return np.float64(0.)
+        return np.float64(1.0 / ((self.reciprocal_sum / self.EXACT_SUM_SCALE) / self.n_values))
+
+
+class RunningPercentile:
+    def __init__(self, percentile):
+        """
+        Percentile of a sorted window, values are inserted and removed with bisection.
+        Same value and floating point operations as np.nanpercentile with linear interpolation
+        :param percentile:
+        """
+        self.quantile = np.true_divide(percentile, 100)
+        self.sorted_values = []
+        self.n_nan = 0
+
+    def add_value(self, value):
+        value = float(value)
+        if value != value:
+            self.n_nan += 1
+        else:
+            insort(self.sorted_values, value)
+
+    def remove_value(self, value):
+        value = float(value)
+        if value != value:
+            self.n_nan -= 1
+        else:
+            del self.sorted_values[bisect_left(self.sorted_values, value)]
+
+    def value(self):
+        n_values = len(self.sorted_values)
+        if n_values == 0:
+            return np.float64(np.nan)
+        virtual_index = (n_values - 1) * self.quantile
+        previous_index = int(min(max(np.floor(virtual_index), 0), n_values - 1))
+        next_index = min(previous_index + 1, n_values - 1)
+        if virtual_index < 0:
+            next_index = 0
+        gamma = virtual_index - np.floor(virtual_index)
+        previous_value = np.float64(self.sorted_values[previous_index])
+        next_value = np.float64(self.sorted_values[next_index])
+        difference = next_value - previous_value
+        if gamma >= 0.5:
+            return next_value - difference * (1 - gamma)
+        return previous_value + difference * gamma
+
+
+class ExponentialWeightedMovingAverage(RecursivePredictor):
+    def __init__(self, alpha):
+        # Common Sense
+        self.alpha = alpha
+        self.__name__ = 'exponential_weighted_moving_average_alpha_%.2f' % alpha
+
+    def running_predictor(self):
+        return RunningExponentialWeightedMovingAverage(self.alpha)
+
+
+class DoubleExponentialWeightedMovingAverage(RecursivePredictor):
+    def __init__(self, alpha, alpha_offset):
+        # Taken from the Shaka Player
+        if alpha + alpha_offset > 1:
+            alpha_offset = 1.0 - alpha
+        self.alpha = alpha
+        self.alpha_offset = alpha_offset
+        self.__name__ = 'exponential_weighted_moving_average_alpha_%.2f_alpha_offset_%.2f' % (alpha, alpha_offset)
+
+    def running_predictor(self):
+        return RunningMinimum([RunningExponentialWeightedMovingAverage(self.alpha),
+                               RunningExponentialWeightedMovingAverage(self.alpha + self.alpha_offset)])
+
+
+class HarmonicMean(WindowPredictor):
+    def __init__(self):
+        self.__name__ = 'hmean'
+
+    def running_predictor(self):
+        return RunningHarmonicMean()
+
+
+class Percentile(WindowPredictor):
+    def __init__(self, percentile):
+        self.percentile = percentile
+        self.__name__ = 'percentile_q_%.2f' % percentile
+
+    def running_predictor(self):
+        return RunningPercentile(self.percentile)
+
+
 def generate_ewma(alpha):
-    # Common Sense
-    func = lambda value_arr: pd.Series(value_arr).ewm(alpha=alpha, adjust=False).mean().values[-1]
-    func.__name__ = 'exponential_weighted_moving_average_alpha_%.2f' % alpha
-    return func
+    return ExponentialWeightedMovingAverage(alpha)
 
 
 def generate_double_ewma(alpha, alpha_offset):
-    # Taken from the Shaka Player
-    if alpha + alpha_offset > 1:
-        alpha_offset = 1.0 - alpha
-    func = lambda value_arr: np.min([pd.Series(value_arr).ewm(alpha=alpha, adjust=False).mean().values[-1],
-                                     pd.Series(value_arr).ewm(alpha=alpha + alpha_offset, adjust=False).mean().values[
-                                         -1]])
-    func.__name__ = 'exponential_weighted_moving_average_alpha_%.2f_alpha_offset_%.2f' % (alpha, alpha_offset)
-    return func
+    return DoubleExponentialWeightedMovingAverage(alpha, alpha_offset)
 
 
 def generate_weighted_moving_average():
@@ -32,30 +218,75 @@ def generate_weighted_moving_average():
     return func
 
 
+def generate_hmean():
+    return HarmonicMean()
+
+
 def generate_percentile(percentile):
     # Why not use a percentile thingy
-    func = lambda value_arr: np.nanpercentile(value_arr, q=percentile)
-    func.__name__ = 'percentile_q_%.2f' % percentile
-    return func
+    return Percentile(percentile)
 
 
 class ThroughputEstimator(ABC):
     def __init__(self, predictor_function, robust_estimate):
+        """
+        The histories only hold the (timestamp_s, value) samples which are still in the window of the estimator
+        :param predictor_function:
+        :param robust_estimate:
+        """
         self.predictor_function = predictor_function
-        self.tput_history = []
-        self.past_errors = []
         self.robust_estimate = robust_estimate
+        self.tput_history = deque()
+        self.past_errors = deque()
+        self.max_error_candidates = deque()
+        self.n_errors = 0
+        self.n_nan_errors = 0
+        self.running_predictor = None
+        self.reset()
 
     def reset(self):
-        self.tput_history = []
-        self.past_errors = []
+        self.tput_history = deque()
+        self.past_errors = deque()
+        self.max_error_candidates = deque()  # (error_idx, error) decreasing, the first one is the max of the window
+        self.n_errors = 0
+        self.n_nan_errors = 0
+        self.running_predictor = None
 
     def add_sample(self, tput_estimate, timestamp_s):
         if len(self.tput_history) > 0:
             my_estimate = self.__obtain_robust_estimate()
             curr_error = abs(my_estimate - tput_estimate) / float(tput_estimate)
-            self.past_errors.append((timestamp_s, curr_error))
+            self.add_error(curr_error, timestamp_s)
         self.tput_history.append((timestamp_s, tput_estimate))
+        if self.running_predictor is not None:
+            self.running_predictor.add_value(tput_estimate)
+        self.drop_expired()
+
+    def add_error(self, curr_error, timestamp_s):
+        self.past_errors.append((timestamp_s, curr_error))
+        if curr_error != curr_error:
+            self.n_nan_errors += 1
+        else:
+            while len(self.max_error_candidates) > 0 and self.max_error_candidates[-1][1] <= curr_error:
+                self.max_error_candidates.pop()
+            self.max_error_candidates.append((self.n_errors, curr_error))
+        self.n_errors += 1
+
+    def drop_oldest_error(self):
+        error_idx = self.n_errors - len(self.past_errors)
+        _, curr_error = self.past_errors.popleft()
+        if curr_error != curr_error:
+            self.n_nan_errors -= 1
+        elif self.max_error_candidates[0][0] == error_idx:
+            self.max_error_candidates.popleft()
+
+    def max_past_error(self):
+        """
+        :return: Same value as np.max over the errors in the window
+        """
+        if self.n_nan_errors > 0:
+            return np.nan
+        return np.float64(self.max_error_candidates[0][1])
 
     def predict_future_bandwidth(self):
         if self.robust_estimate:
@@ -65,17 +296,26 @@ class ThroughputEstimator(ABC):
 
     def __obtain_estimate(self):
         assert len(self.tput_history) > 0, 'No recorded values no estimate'
+        if self.running_predictor is not None:
+            return self.running_predictor.value()
         return self.predictor_function(self.select_valid(self.tput_history))
 
     def __obtain_robust_estimate(self):
         if len(self.past_errors) == 0:
             return self.__obtain_estimate()
-        max_error = np.max(self.select_valid(self.past_errors))
+        max_error = self.max_past_error()
         future_bandwidth = self.__obtain_estimate() / (1 + max_error)
         return future_bandwidth
 
-    @abstractmethod
     def select_valid(self, value_arr):
+        return [value for time, value in value_arr]
+
+    @abstractmethod
+    def drop_expired(self):
+        """
+        Drop the samples and errors which left the window after the last sample
+        :return:
+        """
         pass
 
     @abstractmethod
@@ -89,12 +329,18 @@ class GlobalEstimator(ThroughputEstimator):
         return GlobalEstimator(self.predictor_function,
                                self.robust_estimate)
 
+    def drop_expired(self):
+        pass
+
     def select_valid(self, value_arr):
         value_arr = []
         for time, value in value_arr:
             value_arr.append(value)
         return value_arr
 
+    def max_past_error(self):
+        return np.max(self.select_valid(self.past_errors))
+
 
 class StepEstimator(ThroughputEstimator):
 
@@ -107,19 +353,25 @@ class StepEstimator(ThroughputEstimator):
         :param predictor_function:
         :param robust_estimate:
         """
-        super().__init__(predictor_function, robust_estimate)
         self.consider_last_n_steps = consider_last_n_steps
+        super().__init__(predictor_function, robust_estimate)
 
     def copy(self):
         return StepEstimator(self.consider_last_n_steps, self.predictor_function,
                              self.robust_estimate)
 
-    def select_valid(self, value_arr):
-        considered_steps = min([self.consider_last_n_steps, len(value_arr)])
-        selected_value_arr = []
-        for time, value in value_arr[-considered_steps:]:
-            selected_value_arr.append(value)
-        return selected_value_arr
+    def reset(self):
+        super().reset()
+        if isinstance(self.predictor_function, WindowPredictor):
+            self.running_predictor = self.predictor_function.running_predictor()
+
+    def drop_expired(self):
+        while len(self.tput_history) > self.consider_last_n_steps:
+            _, tput = self.tput_history.popleft()
+            if self.running_predictor is not None:
+                self.running_predictor.remove_value(tput)
+        while len(self.past_errors) > self.consider_last_n_steps:
+            self.drop_oldest_error()
 
 
 class TimeEstimator(ThroughputEstimator):
@@ -132,13 +384,17 @@ class TimeEstimator(ThroughputEstimator):
         :param predictor_function:
         :param robust_estimate:
         """
-        super().__init__(predictor_function, robust_estimate)
         self.consider_last_t_seconds = consider_last_t_seconds
+        super().__init__(predictor_function, robust_estimate)
 
     def copy(self):
         return TimeEstimator(self.consider_last_t_seconds, self.predictor_function,
                              self.robust_estimate)
 
+    def drop_expired(self):
+        # The selection isn't monotonic in time, the samples are filtered on every estimate
+        pass
+
     def select_valid(self, value_arr):
         _, most_recent = self.tput_history[-1]
         selected_value_arr = []
@@ -146,3 +402,6 @@ class TimeEstimator(ThroughputEstimator):
             if (most_recent - time) < self.consider_last_t_seconds:
                 selected_value_arr.append(tput)
         return selected_value_arr
+
+    def max_past_error(self):
+        return np.max(self.select_valid(self.past_errors))
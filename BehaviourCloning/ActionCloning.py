@@ -24,6 +24,7 @@ from xgboost import XGBRegressor
 
 from ABRPolicies.ABRPolicy import ABRPolicy
 from BehaviourCloning.MLABRPolicy import ABRPolicyLearner, ABRPolicyValueFunctionLearner
+from BehaviourCloning.TrajectorySequence import TrajectorySequence
 from SimulationEnviroment.SimulatorEnviroment import TrajectoryVideoStreaming, Trajectory
 
 LOGGING_LEVEL = logging.DEBUG
@@ -367,17 +368,8 @@ class BehavioralCloningIterative(ABRPolicy):
     def next_quality(self, observation, reward):
         current_level = observation['current_level'][-1]
         streaming_enviroment = observation['streaming_environment']
-        observation = self.trajectory_dummy.scale_observation(
-            observation)  # This is important as the learned representation is also scaled
-        state_t = [v for k, v in sorted(
-            observation.items()) if 'streaming_environment' != k and 'future' not in k]
-        state_t = np.array(state_t).T
-        state_t = np.expand_dims(state_t, axis=0)
-
-        state_t_future = [v for k, v in sorted(
-            observation.items()) if 'streaming_environment' != k and 'future' in k]
-        state_t_future = np.array(state_t_future).T
-        state_t_future = np.expand_dims(state_t_future, axis=0)
+        state_t, state_t_future = self.trajectory_dummy.scale_observation_batch(
+            [observation])  # This is important as the learned representation is also scaled
 
         action_prob = self.policy_network.model.predict([state_t, state_t_future])
         self.likelihood_last_decision_val = max(action_prob)
@@ -444,9 +436,9 @@ class BehavioralCloningIterative(ABRPolicy):
             keras_class_weighting = class_weight.compute_class_weight('balanced',
                                                                       np.unique(action_training.argmax(1)),
                                                                       action_training.argmax(1))
+        training_sequence = TrajectorySequence([[state_t_training, state_t_future_training, action_training]])
         for cloning_iteration in tqdm(range(self.cloning_epochs), desc='Cloning Epochs'):
-            history = self.policy_network.model.fit([state_t_training, state_t_future_training],
-                                                    action_training,
+            history = self.policy_network.model.fit(training_sequence,
                                                     validation_data=validation_data, epochs=1,
                                                     verbose=0, class_weight=keras_class_weighting).history
             if self.policy_history is None:
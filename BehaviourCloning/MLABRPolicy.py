@@ -9,7 +9,8 @@ from sklearn.metrics import accuracy_score
 from xgboost import XGBClassifier
 
 from ABRPolicies.ABRPolicy import ABRPolicy
-from ABRPolicies.ThroughputEstimator import generate_ewma, generate_percentile, ThroughputEstimator, StepEstimator
+from ABRPolicies.ThroughputEstimator import generate_ewma, generate_percentile, generate_hmean, ThroughputEstimator, \
+    StepEstimator
 from BehaviourCloning.GeneticFeatureEngineering import GeneticFeatureGenerator, projection_generator_function
 
 MIN_DIFFERENCE_QUALITY = 2
@@ -221,7 +222,7 @@ class ABRPolicyClassifierSimple(ABRPolicyLearner):
         self.feature_names_learned = []
         self.rate_correction = rate_correction
         self.throughput_predictor = StepEstimator(consider_last_n_steps=5,
-                                                  predictor_function=hmean,
+                                                  predictor_function=generate_hmean(),
                                                   robust_estimate=False)
 
     def rate_correct_prediction(self, observation):
@@ -13,6 +13,7 @@ from tqdm import tqdm
 
 from ABRPolicies.ABRPolicy import ABRPolicy
 from BehaviourCloning.ActionCloning import KerasPolicy
+from BehaviourCloning.TrajectorySequence import TrajectorySequence
 from SimulationEnviroment.SimulatorEnviroment import Trajectory, TrajectoryVideoStreaming
 
 LOGGING_LEVEL = logging.DEBUG
@@ -184,17 +185,8 @@ class RandomExpertDistillation(ABRPolicy):
     def next_quality(self, observation, reward):
         current_level = observation['current_level'][-1]
         streaming_enviroment = observation['streaming_environment']
-        observation = self.trajectory_dummy.scale_observation(
-            observation)  # This is important as the learned representation is also scaled
-        state_t = [v for k, v in sorted(
-            observation.items()) if 'streaming_environment' != k and 'future' not in k]
-        state_t = np.array(state_t).T
-        state_t = np.expand_dims(state_t, axis=0)
-
-        state_t_future = [v for k, v in sorted(
-            observation.items()) if 'streaming_environment' != k and 'future' in k]
-        state_t_future = np.array(state_t_future).T
-        state_t_future = np.expand_dims(state_t_future, axis=0)
+        state_t, state_t_future = self.trajectory_dummy.scale_observation_batch(
+            [observation])  # This is important as the learned representation is also scaled
         action_prob = self.policy_network.policy_model.model.predict([state_t, state_t_future])
         self.likelihood_last_decision_val = action_prob
         if self.deterministic:
@@ -341,10 +333,9 @@ class RandomExpertDistillation(ABRPolicy):
 
         testing_data = ([state_t_testing, state_t_future_testing], random_prediction_testing)
         self.pretrain_distill_history = self.bc_cloning_network.model.fit(
-            [state_t_training, state_t_future_training],
-            random_prediction_training,
+            TrajectorySequence([[state_t_training, state_t_future_training, random_prediction_training]]),
             validation_data=testing_data,
-            epochs=self.rde_distill_epochs, verbose=0, shuffle=True,
+            epochs=self.rde_distill_epochs, verbose=0,
             callbacks=self.early_stopping).history
         trained_prediction_training = self.bc_cloning_network.model.predict([state_t_training, state_t_future_training])
 
@@ -366,8 +357,7 @@ class RandomExpertDistillation(ABRPolicy):
         weight_filepaths = []
         if self.pretrain:
             self.pretrain_bc_history = self.policy_network.policy_model.model.fit(
-                [state_t_training, state_t_future_training],
-                action_training,
+                TrajectorySequence([[state_t_training, state_t_future_training, action_training]]),
                 validation_data=([state_t_testing, state_t_future_testing], action_testing),
                 epochs=self.rde_distill_epochs, verbose=0,
                 callbacks=self.early_stopping, class_weight=keras_class_weighting).history
@@ -407,11 +397,11 @@ class RandomExpertDistillation(ABRPolicy):
             future_reward_obtained = np.array(future_reward_obtained).reshape((-1, 1))
             future_reward_predicted = self.value_model.model.predict(
                 [state_t_training_sampled, state_t_future_training_sampled])
-            history = self.value_model.model.fit([state_t_training_sampled, state_t_future_training_sampled],
-                                                 future_reward_obtained,
-                                                 validation_split=0.2, epochs=self.model_iterations,
-                                                 verbose=0,
-                                                 shuffle=True).history  # Repeated early stopping callback introduce errors
+            value_training, value_validation = TrajectorySequence(
+                [[state_t_training_sampled, state_t_future_training_sampled, future_reward_obtained]]).split(0.2)
+            history = self.value_model.model.fit(value_training,
+                                                 validation_data=value_validation, epochs=self.model_iterations,
+                                                 verbose=0).history  # Repeated early stopping callback introduce errors
             self.value_history_last = history.copy()
             history = self.keep_last_entry(history)
 
@@ -424,12 +414,13 @@ class RandomExpertDistillation(ABRPolicy):
             estimated_advantage = future_reward_obtained - future_reward_predicted
             estimated_advantage = estimated_advantage
 
+            policy_training, policy_validation = TrajectorySequence(
+                [[state_t_training_sampled, state_t_future_training_sampled, estimated_advantage,
+                  action_likelihood_sampled, action_sampled]]).split(self.validation_split)
             history = self.policy_network.gail_training_model.fit(
-                [state_t_training_sampled, state_t_future_training_sampled,
-                 estimated_advantage, action_likelihood_sampled],
-                action_sampled,
-                validation_split=self.validation_split, epochs=self.model_iterations,
-                verbose=0, shuffle=True).history
+                policy_training,
+                validation_data=policy_validation, epochs=self.model_iterations,
+                verbose=0).history
             self.policy_history_last = history.copy()
             history = self.keep_last_entry(history)
 
@@ -609,17 +600,8 @@ class GAILPPO(ABRPolicy):
     def next_quality(self, observation, reward):
         current_level = observation['current_level'][-1]
         streaming_enviroment = observation['streaming_environment']
-        observation = self.trajectory_dummy.scale_observation(
-            observation)  # This is important as the learned representation is also scaled
-        state_t = [v for k, v in sorted(
-            observation.items()) if 'streaming_environment' != k and 'future' not in k]
-        state_t = np.array(state_t).T
-        state_t = np.expand_dims(state_t, axis=0)
-
-        state_t_future = [v for k, v in sorted(
-            observation.items()) if 'streaming_environment' != k and 'future' in k]
-        state_t_future = np.array(state_t_future).T
-        state_t_future = np.expand_dims(state_t_future, axis=0)
+        state_t, state_t_future = self.trajectory_dummy.scale_observation_batch(
+            [observation])  # This is important as the learned representation is also scaled
         action_prob = self.gail_model.policy_model.model.predict([state_t, state_t_future])
         self.likelihood_last_decision_val = action_prob
         if self.deterministic:
@@ -699,8 +681,7 @@ class GAILPPO(ABRPolicy):
 
         if self.pretrain:
             history = self.gail_model.policy_model.model.fit(
-                [state_t_training, state_t_future_training],
-                action_training,
+                TrajectorySequence([[state_t_training, state_t_future_training, action_training]]),
                 validation_data=([state_t_testing, state_t_future_testing], action_testing),
                 epochs=self.pretrain_max_epochs, verbose=0,
                 callbacks=self.early_stopping, class_weight=keras_class_weighting).history
@@ -724,27 +705,22 @@ class GAILPPO(ABRPolicy):
 
             behavioral_action = to_categorical(behavioural_action, num_classes=self.n_actions)
 
-            state_t_train = np.vstack([training_trajectory_state_t[train_idx_clone], state_t_training])
-            state_t_future_train = np.vstack(
-                [training_trajectory_state_t_future[train_idx_clone], state_t_future_training])
-            action_train = np.vstack([behavioral_action[train_idx_clone], action_training])
-            target_label_train = to_categorical(np.vstack([0] * len(train_idx_clone) + [1] * len(action_training)),
-                                                num_classes=2)
-
-            state_t_validation = np.vstack([training_trajectory_state_t[test_idx_clone], state_t_testing])
-            state_t_future_validation = np.vstack(
-                [training_trajectory_state_t_future[test_idx_clone], state_t_future_testing])
-            action_validation = np.vstack([behavioral_action[test_idx_clone], action_testing])
-            target_label_validation = to_categorical(np.vstack([0] * len(test_idx_clone) + [1] * len(action_testing)),
-                                                     num_classes=2)
-
-            validation_data_discriminator = (
-                [state_t_validation, state_t_future_validation, action_validation], target_label_validation)
-
-            data_train = [state_t_train, state_t_future_train, action_train]
-
-            history = self.discriminator.model.fit(data_train, target_label_train,
-                                                   validation_data=validation_data_discriminator,
+            # The generated samples are labeled 0, the expert samples 1
+            discriminator_train = TrajectorySequence(
+                [[training_trajectory_state_t, training_trajectory_state_t_future, behavioral_action,
+                  to_categorical(np.zeros(len(behavioral_action)), num_classes=2)],
+                 [state_t_training, state_t_future_training, action_training,
+                  to_categorical(np.ones(len(action_training)), num_classes=2)]],
+                source_indices=[train_idx_clone, np.arange(len(action_training))])
+            discriminator_validation = TrajectorySequence(
+                [[training_trajectory_state_t, training_trajectory_state_t_future, behavioral_action,
+                  to_categorical(np.zeros(len(behavioral_action)), num_classes=2)],
+                 [state_t_testing, state_t_future_testing, action_testing,
+                  to_categorical(np.ones(len(action_testing)), num_classes=2)]],
+                source_indices=[test_idx_clone, np.arange(len(action_testing))], shuffle=False)
+
+            history = self.discriminator.model.fit(discriminator_train,
+                                                   validation_data=discriminator_validation,
                                                    epochs=self.adverserial_max_epochs,
                                                    verbose=0).history  # Repeated early stopping callback introduce errors
             self.discriminator_history_last = history.copy()
@@ -778,9 +754,11 @@ class GAILPPO(ABRPolicy):
             future_reward_obtained = np.array(future_reward_obtained).reshape((-1, 1))
             future_reward_predicted = self.value_model.model.predict(
                 [training_trajectory_state_t, training_trajectory_state_t_future])
-            history = self.value_model.model.fit([training_trajectory_state_t, training_trajectory_state_t_future],
-                                                 future_reward_obtained,
-                                                 validation_split=0.2, epochs=self.adverserial_max_epochs,
+            value_training, value_validation = TrajectorySequence(
+                [[training_trajectory_state_t, training_trajectory_state_t_future, future_reward_obtained]]).split(0.2)
+            history = self.value_model.model.fit(value_training,
+                                                 validation_data=value_validation,
+                                                 epochs=self.adverserial_max_epochs,
                                                  verbose=0).history
             self.value_history_last = history.copy()
             history = self.keep_last_entry(history)
@@ -799,12 +777,13 @@ class GAILPPO(ABRPolicy):
             # print('---------' * 10)
             # print('---------' * 10)
 
+            policy_training, policy_validation = TrajectorySequence(
+                [[training_trajectory_state_t, training_trajectory_state_t_future, estimated_advantage,
+                  behavioural_action_likelihood, behavioral_action]]).split(self.validation_split)
             history = self.gail_model.gail_training_model.fit(
-                [training_trajectory_state_t, training_trajectory_state_t_future,
-                 estimated_advantage, behavioural_action_likelihood],
-                behavioral_action,
-                validation_split=self.validation_split, epochs=self.adverserial_max_epochs,
-                verbose=0, shuffle=True).history
+                policy_training,
+                validation_data=policy_validation, epochs=self.adverserial_max_epochs,
+                verbose=0).history
             # print(np.mean(self.gail_model.policy_model.concatenate_informations.get_weights()))
             # print('=========' * 10)
             # print('=========' * 10)
@@ -0,0 +1,120 @@
+import numpy as np
+from tensorflow.python.keras.utils import Sequence
+
+
+class StratifiedSampler:
+    def __init__(self, class_association):
+        """
+        Draws the same number of samples from every class. Within a class the samples are drawn without replacement,
+        the class is reshuffled once all of its samples have been drawn.
+        :param class_association: dictionary class -> sample indices
+        """
+        self.class_indices = [np.asarray(sample_indices, dtype=int) for sample_indices in class_association.values()
+                              if len(sample_indices) > 0]
+        self.class_permutation = [np.random.permutation(sample_indices) for sample_indices in self.class_indices]
+        self.class_position = [0] * len(self.class_indices)
+
+    def draw_class(self, class_idx, size):
+        drawn_indices = [np.zeros(0, dtype=int)]
+        while size > 0:
+            if self.class_position[class_idx] == len(self.class_permutation[class_idx]):
+                self.class_permutation[class_idx] = np.random.permutation(self.class_indices[class_idx])
+                self.class_position[class_idx] = 0
+            class_position = self.class_position[class_idx]
+            n_drawn = min(size, len(self.class_permutation[class_idx]) - class_position)
+            drawn_indices.append(self.class_permutation[class_idx][class_position:class_position + n_drawn])
+            self.class_position[class_idx] += n_drawn
+            size -= n_drawn
+        return np.concatenate(drawn_indices)
+
+    def sample(self, size):
+        """
+        :param size:
+        :return: size shuffled sample indices, the classes differ by at most one sample
+        """
+        n_classes = len(self.class_indices)
+        samples_per_class = np.full(n_classes, size // n_classes)
+        samples_per_class[np.random.choice(n_classes, size=size % n_classes, replace=False)] += 1
+        return np.random.permutation(np.concatenate(
+            [self.draw_class(class_idx, n_samples) for class_idx, n_samples in enumerate(samples_per_class)]))
+
+
+class TrajectorySequence(Sequence):
+    def __init__(self, sources, source_indices=None, batch_size=32, shuffle=True, balanced=False):
+        """
+        Minibatches for model.fit over one or more sources without concatenating them. Only the samples of a batch are
+        copied out of the sources, e.g. the (memory mapped) converted arrays of a trajectory
+        :param sources: list of sources, every source is a list [input_1, ..., input_n, target] of arrays with the same
+        number of samples
+        :param source_indices: per source the samples which are used, defaults to all samples of the source
+        :param batch_size:
+        :param shuffle: reshuffle the samples after every epoch
+        :param balanced: every batch contains the same number of samples per class, the class is the argmax of the
+        target
+        """
+        self.sources = sources
+        if source_indices is None:
+            source_indices = [np.arange(len(source[0])) for source in sources]
+        self.source_indices = [np.asarray(sample_indices, dtype=int) for sample_indices in source_indices]
+        self.sample_source = np.concatenate([np.full(len(sample_indices), source_idx, dtype=int) for
+                                             source_idx, sample_indices in enumerate(self.source_indices)])
+        self.sample_idx = np.concatenate(self.source_indices)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.stratified_sampler = None
+        if balanced:
+            sample_class = np.concatenate([self.sample_class(source[-1][sample_indices]) for source, sample_indices in
+                                           zip(self.sources, self.source_indices)])
+            self.stratified_sampler = StratifiedSampler(
+                {sample_class_value: np.flatnonzero(sample_class == sample_class_value) for sample_class_value in
+                 np.unique(sample_class)})
+        self.sample_order = None
+        self.on_epoch_end()
+
+    def sample_class(self, target):
+        if target.ndim > 1 and target.shape[-1] > 1:
+            return target.argmax(-1)
+        return target.ravel()
+
+    def __len__(self):
+        return int(np.ceil(len(self.sample_idx) / float(self.batch_size)))
+
+    def __getitem__(self, batch_idx):
+        batch_order = self.sample_order[batch_idx * self.batch_size:(batch_idx + 1) * self.batch_size]
+        batch_source = self.sample_source[batch_order]
+        batch_sample_idx = self.sample_idx[batch_order]
+        batch = []
+        for array_idx in range(len(self.sources[0])):
+            dtype = np.result_type(*[source[array_idx].dtype for source in self.sources])
+            batch_array = np.empty((len(batch_order),) + self.sources[0][array_idx].shape[1:], dtype=dtype)
+            for source_idx, source in enumerate(self.sources):
+                in_source = batch_source == source_idx
+                if in_source.any():
+                    batch_array[in_source] = source[array_idx][batch_sample_idx[in_source]]
+            batch.append(batch_array)
+        return batch[:-1], batch[-1]
+
+    def on_epoch_end(self):
+        if self.stratified_sampler is not None:
+            self.sample_order = self.stratified_sampler.sample(len(self.sample_idx))
+        elif self.shuffle:
+            self.sample_order = np.random.permutation(len(self.sample_idx))
+        else:
+            self.sample_order = np.arange(len(self.sample_idx))
+
+    def split(self, validation_split):
+        """
+        Split off the last samples as validation data, in the same way as validation_split of model.fit
+        :param validation_split: fraction of the samples used for validation
+        :return: training sequence, validation sequence which isn't shuffled
+        """
+        split_at = int(len(self.sample_idx) * (1. - validation_split))
+        training_indices = []
+        validation_indices = []
+        for source_idx in range(len(self.sources)):
+            training_indices.append(self.sample_idx[:split_at][self.sample_source[:split_at] == source_idx])
+            validation_indices.append(self.sample_idx[split_at:][self.sample_source[split_at:] == source_idx])
+        training_sequence = TrajectorySequence(self.sources, training_indices, self.batch_size, self.shuffle,
+                                               self.stratified_sampler is not None)
+        validation_sequence = TrajectorySequence(self.sources, validation_indices, self.batch_size, shuffle=False)
+        return training_sequence, validation_sequence
@@ -0,0 +1,228 @@
+"""
+Bounds of the offline optimal QoE of whole streaming sessions.
+For every (trace, video) pair the TraceOracle plans on the real bandwidth trace under the reward function of the
+streaming enviroment. The lower bound is the QoE of the quality sequence found with TraceOracle.search_sequence
+replayed in the simulator, the upper bound the QoE found with TraceOracle.upper_bound. Both hold for any quantization,
+finer buckets only make them tighter. If they meet the optimal QoE is written to optimal_qoe. The bounds are used to
+normalise the QoE of the provider sessions.
+Sessions which need more than max_states planning states fail with an error instead of exhausting the memory.
+
+Results layout:
+    <results_path> csv with one row per session | <results_path>.json with the settings of the run
+The table is rewritten after every block of sessions, a run which was interrupted resumes with the sessions which
+aren't in the table yet. Resuming with different settings raises an error.
+"""
+import argparse
+import json
+import logging
+import os
+from itertools import product
+from time import time
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from tqdm import tqdm
+
+from ABRPolicies.OptimalABRPolicy import TraceOracle
+from SimulationEnviroment.Rewards import ClassicPerceptualReward
+from SimulationEnviroment.SimulatorEnviroment import OfflineStreaming
+
+LOGGING_LEVEL = logging.INFO
+handler = logging.StreamHandler()
+handler.setLevel(LOGGING_LEVEL)
+logger = logging.getLogger(__name__)
+logger.setLevel(LOGGING_LEVEL)
+logger.addHandler(handler)
+
+RESULT_COLUMNS = ['trace', 'video', 'n_video_chunk', 'qoe_lower_bound', 'qoe_upper_bound', 'optimal_qoe',
+                  'rebuffering_seconds', 'mean_level', 'n_switches', 'solve_time_s', 'quality_sequence', 'error']
+BOUND_TOLERANCE = 1e-6  # Bounds which are closer than this are considered equal
+
+
+def bound_settings(streaming_enviroment, trace_oracle):
+    """
+    Everything which changes the optimal QoE of a session
+    :param streaming_enviroment:
+    :param trace_oracle:
+    :return: json serializable dictionary
+    """
+    settings = {'reward_function': streaming_enviroment.reward_function.__class__.__name__,
+                'reward_table_key': streaming_enviroment.reward_function.reward_table_key(),
+                'max_quality_change': trace_oracle.max_quality_change,
+                'buffer_quantization_s': trace_oracle.buffer_quantization_s,
+                'trace_quantization_s': trace_oracle.trace_quantization_s,
+                'max_states': trace_oracle.max_states,
+                'buffer_threshold_ms': streaming_enviroment.buffer_threshold_ms,
+                'drain_buffer_sleep_ms': streaming_enviroment.drain_buffer_sleep_ms,
+                'packet_payload_portion': streaming_enviroment.packet_payload_portion,
+                'link_rtt_ms': streaming_enviroment.link_rtt_ms}
+    return json.loads(json.dumps(settings))
+
+
+def optimal_session(streaming_enviroment, trace_oracle, bw_trace_path, video_information_path):
+    """
+    Bound the optimal QoE of one session, the lower bound is the QoE of the replayed quality sequence
+    :param streaming_enviroment: OfflineStreaming, isn't modified
+    :param trace_oracle:
+    :param bw_trace_path:
+    :param video_information_path:
+    :return: row of the results table
+    """
+    session_result = {'trace': bw_trace_path, 'video': video_information_path}
+    try:
+        streaming_enviroment = streaming_enviroment.copy()
+        streaming_enviroment.set_new_enviroment(bw_trace_path, video_information_path)
+        reward_table = streaming_enviroment.get_reward_table()
+        if reward_table is None:
+            raise ValueError('%s can not be tabulated' % streaming_enviroment.reward_function.__class__.__name__)
+        """
+        The first chunk is downloaded in the lowest quality as in TrajectoryVideoStreaming.run_experiment
+        """
+        session_start = streaming_enviroment.save_state()
+        quality_sequence = [0]
+        upper_bound = 0.
+        solve_start = time()
+        if streaming_enviroment.n_video_chunk > 1:
+            streaming_enviroment.replay(quality_sequence, activate_logging=False)
+            n_planned_chunks = streaming_enviroment.n_video_chunk - 1
+            upper_bound = trace_oracle.upper_bound(streaming_enviroment, reward_table, 0, n_planned_chunks)
+            planned_sequence, _ = trace_oracle.search_sequence(streaming_enviroment, reward_table, 0,
+                                                               n_planned_chunks)
+            quality_sequence += planned_sequence
+        solve_time_s = time() - solve_start
+        streaming_enviroment.set_state(session_start)
+        streaming_enviroment.replay(quality_sequence)
+        session_log = pd.DataFrame(streaming_enviroment.return_log_state(),
+                                   columns=streaming_enviroment.get_logging_columns())
+        lower_bound = session_log['reward'].sum()
+        upper_bound += session_log['reward'].iloc[0]
+    except Exception as error:
+        # A broken trace or video must not abort the other sessions of the run
+        logger.warning('No bound for %s and %s: %s' % (bw_trace_path, video_information_path, repr(error)))
+        session_result['error'] = repr(error)
+        return session_result
+    session_result.update({'n_video_chunk': streaming_enviroment.n_video_chunk,
+                           'qoe_lower_bound': lower_bound,
+                           'qoe_upper_bound': upper_bound,
+                           'optimal_qoe': lower_bound if upper_bound - lower_bound <= BOUND_TOLERANCE else np.nan,
+                           'rebuffering_seconds': session_log['rebuffering_seconds'].sum(),
+                           'mean_level': np.mean(quality_sequence),
+                           'n_switches': int(np.count_nonzero(np.diff(quality_sequence))),
+                           'solve_time_s': solve_time_s,
+                           'quality_sequence': ' '.join(map(str, quality_sequence)),
+                           'error': ''})
+    return session_result
+
+
+def load_bound_results(results_path, settings):
+    """
+    :param results_path:
+    :param settings: see bound_settings
+    :return: results table of an earlier run with the same settings, empty if there is none
+    """
+    settings_path = results_path + '.json'
+    if not os.path.exists(results_path) or not os.path.exists(settings_path):
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    with open(settings_path, 'r') as settings_file:
+        stored_settings = json.load(settings_file)
+    if stored_settings != settings:
+        raise ValueError('%s was computed with the settings %s, expected %s' % (results_path, stored_settings,
+                                                                               settings))
+    return pd.read_csv(results_path, dtype={'quality_sequence': str, 'error': str}).fillna(
+        {'quality_sequence': '', 'error': ''})
+
+
+def save_bound_results(results_path, settings, bound_results):
+    """
+    Replace the table at once, so that an interrupted write doesn't destroy the checkpoint
+    :param results_path:
+    :param settings: see bound_settings
+    :param bound_results:
+    :return:
+    """
+    with open(results_path + '.json', 'w') as settings_file:
+        json.dump(settings, settings_file)
+    bound_results.to_csv(results_path + '.tmp', index=False)
+    os.replace(results_path + '.tmp', results_path)
+
+
+def compute_optimal_bounds(results_path, streaming_enviroment, trace_list, video_csv_list, max_quality_change,
+                           buffer_quantization_s=0.5, trace_quantization_s=0.5, max_states=10 ** 7, cores_avail=1,
+                           checkpoint_every=100, tqdm_activated=False):
+    """
+    Lower and upper bound of the optimal QoE for every (trace, video) pair
+    :param results_path: csv which holds the results, an existing table is resumed
+    :param streaming_enviroment: OfflineStreaming with the reward function and the network parameters
+    :param trace_list:
+    :param video_csv_list: video of every trace
+    :param max_quality_change:
+    :param buffer_quantization_s: see TraceOracle, smaller buckets give tighter bounds
+    :param trace_quantization_s: see TraceOracle, smaller buckets give tighter bounds
+    :param max_states: see TraceOracle
+    :param cores_avail:
+    :param checkpoint_every: Number of sessions between two checkpoints
+    :param tqdm_activated:
+    :return: results table
+    """
+    trace_oracle = TraceOracle(max_quality_change, buffer_quantization_s, trace_quantization_s,
+                               max_states=max_states)
+    settings = bound_settings(streaming_enviroment, trace_oracle)
+    bound_results = load_bound_results(results_path, settings)
+    solved_pairs = set(zip(bound_results['trace'], bound_results['video']))
+    session_zip = [(bw_trace_path, video_information_path) for bw_trace_path, video_information_path in
+                   zip(trace_list, video_csv_list) if (bw_trace_path, video_information_path) not in solved_pairs]
+    logger.info('%d sessions solved, %d to go' % (len(solved_pairs), len(session_zip)))
+    checkpoint_starts = range(0, len(session_zip), checkpoint_every)
+    if tqdm_activated:
+        checkpoint_starts = tqdm(checkpoint_starts, desc='Checkpoint Counter : ')
+    for checkpoint_start in checkpoint_starts:
+        session_block = session_zip[checkpoint_start:checkpoint_start + checkpoint_every]
+        if cores_avail == 1:
+            block_results = [optimal_session(streaming_enviroment, trace_oracle, bw_trace_path, video_information_path)
+                             for bw_trace_path, video_information_path in session_block]
+        else:
+            block_results = Parallel(n_jobs=cores_avail)(
+                delayed(optimal_session)(streaming_enviroment, trace_oracle, bw_trace_path, video_information_path)
+                for bw_trace_path, video_information_path in session_block)
+        bound_results = pd.concat([bound_results, pd.DataFrame(block_results, columns=RESULT_COLUMNS)],
+                                  ignore_index=True)
+        save_bound_results(results_path, settings, bound_results)
+    return bound_results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bounds of the optimal QoE of every trace and video combination')
+    parser.add_argument('results_path')
+    parser.add_argument('--trace_folder', default='../Data/Traces')
+    parser.add_argument('--video_folder', default='../Data/Video_Info')
+    parser.add_argument('--max_quality_change', type=int, default=2)
+    parser.add_argument('--buffer_quantization_s', type=float, default=0.5,
+                        help='Buffer bucket size of the TraceOracle, smaller buckets give tighter bounds')
+    parser.add_argument('--trace_quantization_s', type=float, default=0.5,
+                        help='Trace position bucket size of the TraceOracle, smaller buckets give tighter bounds')
+    parser.add_argument('--max_states', type=int, default=10 ** 7,
+                        help='Sessions which need more planning states fail instead of exhausting the memory')
+    parser.add_argument('--cores_avail', type=int, default=1)
+    parser.add_argument('--checkpoint_every', type=int, default=100)
+    args = parser.parse_args()
+    trace_files = []
+    for root, dirs, files in os.walk(args.trace_folder):
+        for name in files:
+            trace_files.append(os.path.join(root, name))
+    video_info_files = []
+    for root, dirs, files in os.walk(args.video_folder):
+        for name in files:
+            if name.endswith('_video_info'):
+                video_info_files.append(os.path.join(root, name))
+    trace_list, video_csv_list = zip(*product(sorted(trace_files), sorted(video_info_files)))
+    streaming_enviroment = OfflineStreaming(bw_trace_file=trace_list[0], video_information_csv_path=video_csv_list[0],
+                                            reward_function=ClassicPerceptualReward(), max_lookback=10,
+                                            max_lookahead=3, max_switch_allowed=args.max_quality_change)
+    bound_results = compute_optimal_bounds(args.results_path, streaming_enviroment, trace_list, video_csv_list,
+                                           args.max_quality_change, args.buffer_quantization_s,
+                                           args.trace_quantization_s, args.max_states, args.cores_avail,
+                                           args.checkpoint_every, tqdm_activated=True)
+    print('Bounded %d sessions, mean lower bound %.3f, mean upper bound %.3f, %d optimal' % (
+        len(bound_results), bound_results['qoe_lower_bound'].mean(), bound_results['qoe_upper_bound'].mean(),
+        bound_results['optimal_qoe'].notna().sum()))
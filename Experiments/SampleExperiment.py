@@ -15,6 +15,7 @@ from BehaviourCloning.MLABRPolicy import ABRPolicyValueFunctionLearner, \
 from BehaviourCloning.RewardShapingCloning import GAILPPO, RandomExpertDistillation
 from SimulationEnviroment.Rewards import ClassicPerceptualReward
 from SimulationEnviroment.SimulatorEnviroment import OfflineStreaming
+from SimulationEnviroment.TrajectoryStore import open_trajectory_store
 
 """
 Runs pipeline on the algorithm for one provider and one algorithm
@@ -113,9 +114,13 @@ if __name__ == "__main__":
         video_selection = video_selection_dataframe.loc[provider.replace('_Phone', '').lower()]
     training_videos = video_selection[video_selection['Data Type'] != 'validation']['Video Url'].values
     training_videos = list(training_videos)
-    expert_trajectory = os.path.join(parsed_results_folder, 'trajectory_list')
-    with open(expert_trajectory, 'rb') as expert_trajectory:
-        expert_trajectory = pickle.load(expert_trajectory)
+    expert_trajectory_store = os.path.join(parsed_results_folder, 'trajectory_store')
+    if os.path.exists(expert_trajectory_store):
+        expert_trajectory = open_trajectory_store(expert_trajectory_store).load_trajectory()
+    else:
+        expert_trajectory = os.path.join(parsed_results_folder, 'trajectory_list')
+        with open(expert_trajectory, 'rb') as expert_trajectory:
+            expert_trajectory = pickle.load(expert_trajectory)
     expert_evaluation = os.path.join(parsed_results_folder, 'evaluation_list')
     with open(expert_evaluation, 'rb') as expert_evaluation:
         expert_evaluation = pickle.load(expert_evaluation)
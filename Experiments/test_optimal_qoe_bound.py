@@ -0,0 +1,122 @@
+"""
+Bounds of the optimal QoE computed by the QoE bound job on synthetic sessions.
+On a short video the bounds are checked against the exhaustive search of the TraceOracle, on a full-length video the
+job has to finish with the default settings.
+"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from ABRPolicies.OptimalABRPolicy import TraceOracle
+from Experiments.OptimalQoEBound import compute_optimal_bounds
+from SimulationEnviroment.Rewards import ClassicPerceptualReward
+from SimulationEnviroment.SimulatorEnviroment import OfflineStreaming
+
+RESOLUTIONS = ['256x144', '426x240', '640x360', '854x480', '1280x720', '1920x1080']
+MAX_QUALITY_CHANGE = 2
+
+
+def write_video(video_path, n_video_chunk, seed):
+    """
+    Video information csv with segments of different length and a bitrate ladder from 0.3 to 6 Mbit/s
+    """
+    random_state = np.random.RandomState(seed)
+    video_information = {'seg_len_s': random_state.choice([2., 4., 5.005], size=n_video_chunk)}
+    for level, resolution in enumerate(RESOLUTIONS):
+        bitrate = 300e3 * (level + 1) ** 1.6 * random_state.uniform(0.6, 1.4, size=n_video_chunk)
+        video_information[resolution + '_bitrate'] = bitrate
+        video_information[resolution + '_byte'] = bitrate * video_information['seg_len_s'] / 8.
+        video_information[resolution + '_vmaf'] = np.clip(30 + 12 * level + random_state.normal(0, 5, n_video_chunk),
+                                                          0, 100)
+    pd.DataFrame(video_information).to_csv(video_path)
+
+
+def write_trace(trace_path, n_sample, seed):
+    """
+    Mahimahi style trace with samples every 0.2 to 1.5 seconds and a bandwidth between 0.3 and 5 Mbit/s
+    """
+    random_state = np.random.RandomState(seed)
+    sample_time_s = np.cumsum(random_state.uniform(0.2, 1.5, size=n_sample))
+    sample_time_s[0] = 0.
+    bandwidth_mbit = random_state.uniform(0.3, 5., size=n_sample)
+    with open(trace_path, 'w') as trace_file:
+        for time_s, mbit in zip(sample_time_s, bandwidth_mbit):
+            trace_file.write('%.6f %.6f\n' % (time_s, mbit))
+
+
+class OptimalQoEBoundTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_folder = tempfile.TemporaryDirectory()
+        self.trace_path = os.path.join(self.data_folder.name, 'trace')
+        self.short_video_path = os.path.join(self.data_folder.name, 'short_video_info')
+        self.full_video_path = os.path.join(self.data_folder.name, 'full_video_info')
+        write_trace(self.trace_path, 120, seed=0)
+        write_video(self.short_video_path, 8, seed=1)
+        write_video(self.full_video_path, 150, seed=2)
+        self.streaming_enviroment = OfflineStreaming(self.trace_path, self.short_video_path, ClassicPerceptualReward(),
+                                                     max_lookback=10, max_lookahead=3,
+                                                     max_switch_allowed=MAX_QUALITY_CHANGE,
+                                                     buffer_threshold_ms=15000.)
+
+    def tearDown(self):
+        self.data_folder.cleanup()
+
+    def bound_session(self, video_path, **bound_parameters):
+        results_path = os.path.join(self.data_folder.name, 'bounds.csv')
+        if os.path.exists(results_path):
+            os.remove(results_path)
+        bound_results = compute_optimal_bounds(results_path, self.streaming_enviroment, [self.trace_path],
+                                               [video_path], MAX_QUALITY_CHANGE, **bound_parameters)
+        self.assertEqual(len(bound_results), 1)
+        return bound_results.iloc[0]
+
+    def exact_qoe(self, video_path):
+        """
+        QoE of the sequence of the exhaustive search, the first chunk is downloaded in the lowest quality
+        """
+        streaming_enviroment = self.streaming_enviroment.copy()
+        streaming_enviroment.set_new_enviroment(self.trace_path, video_path)
+        session_start = streaming_enviroment.save_state()
+        streaming_enviroment.replay([0], activate_logging=False)
+        _, _, quality_sequence, _ = TraceOracle(MAX_QUALITY_CHANGE).solve(
+            streaming_enviroment, streaming_enviroment.get_reward_table(), 0, streaming_enviroment.n_video_chunk - 1)
+        streaming_enviroment.set_state(session_start)
+        streaming_enviroment.replay([0] + quality_sequence)
+        session_log = pd.DataFrame(streaming_enviroment.return_log_state(),
+                                   columns=streaming_enviroment.get_logging_columns())
+        return session_log['reward'].sum()
+
+    def test_bounds_enclose_exact_qoe(self):
+        exact_qoe = self.exact_qoe(self.short_video_path)
+        for quantization_s in [0.1, 0.5, 2., 10.]:
+            session_result = self.bound_session(self.short_video_path, buffer_quantization_s=quantization_s,
+                                                trace_quantization_s=quantization_s)
+            self.assertEqual(session_result['error'], '')
+            self.assertLessEqual(session_result['qoe_lower_bound'], exact_qoe + 1e-9)
+            self.assertLessEqual(exact_qoe, session_result['qoe_upper_bound'] + 1e-9)
+            self.assertEqual(len(session_result['quality_sequence'].split()), 8)
+
+    def test_full_length_video(self):
+        session_result = self.bound_session(self.full_video_path)
+        self.assertEqual(session_result['error'], '')
+        self.assertEqual(session_result['n_video_chunk'], 150)
+        self.assertLessEqual(session_result['qoe_lower_bound'], session_result['qoe_upper_bound'] + 1e-9)
+        self.assertEqual(len(session_result['quality_sequence'].split()), 150)
+
+    def test_state_budget(self):
+        session_result = self.bound_session(self.full_video_path, max_states=1000)
+        self.assertIn('max_states', session_result['error'])
+        self.assertTrue(np.isnan(session_result['qoe_lower_bound']))
+        streaming_enviroment = self.streaming_enviroment.copy()
+        streaming_enviroment.set_new_enviroment(self.trace_path, self.full_video_path)
+        with self.assertRaisesRegex(ValueError, 'max_states'):
+            TraceOracle(MAX_QUALITY_CHANGE).solve(streaming_enviroment, streaming_enviroment.get_reward_table(), 0,
+                                                  streaming_enviroment.n_video_chunk)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+"""
+Chunk download and buffer dynamics of OfflineStreaming as plain functions over the trace arrays.
+If numba is installed the functions are compiled, otherwise the same code runs as python.
+"""
+import numpy as np
+
+try:
+    from numba import njit
+
+    COMPILED_KERNEL = True
+except ImportError:
+    COMPILED_KERNEL = False
+
+
+    def njit(*args, **kwargs):
+        def decorator(function):
+            return function
+
+        return decorator
+
+MILLISECONDS_IN_SECOND = 1000.0
+B_IN_MB = 1000000.0
+BITS_IN_BYTE = 8.0
+
+
+@njit(cache=True)
+def next_trace_sample(trace_length, mahimahi_ptr):
+    mahimahi_ptr += 1
+    if mahimahi_ptr >= trace_length:
+        # loop back in the beginning
+        # note: trace file starts with time 0
+        mahimahi_ptr = 1
+    return mahimahi_ptr
+
+
+@njit(cache=True)
+def download_trace(cooked_time, cooked_bw, cumulative_time, cumulative_byte, mahimahi_ptr, last_mahimahi_time,
+                   video_chunk_size, packet_payload_portion):
+    """
+    Download a chunk over the mahimahi trace starting at mahimahi_ptr. The sample in which the download
+    finishes is found with a binary search on the cumulative trace, the time spent in it is interpolated
+    :param cooked_time:
+    :param cooked_bw:
+    :param cumulative_time: see StreamingEnviroment.build_cumulative_trace
+    :param cumulative_byte: see StreamingEnviroment.build_cumulative_trace
+    :param mahimahi_ptr:
+    :param last_mahimahi_time:
+    :param video_chunk_size: in bytes
+    :param packet_payload_portion:
+    :return: download time in s, new mahimahi_ptr, new last_mahimahi_time
+    """
+    throughput = cooked_bw[mahimahi_ptr] * B_IN_MB / BITS_IN_BYTE
+    duration = cooked_time[mahimahi_ptr] - last_mahimahi_time
+    packet_payload = throughput * duration * packet_payload_portion
+    if packet_payload > video_chunk_size:
+        fractional_time = video_chunk_size / throughput / packet_payload_portion
+        return fractional_time, mahimahi_ptr, last_mahimahi_time + fractional_time
+    downloadtime_s = duration
+    remaining_byte = (video_chunk_size - packet_payload) / packet_payload_portion
+    loop_start = next_trace_sample(len(cooked_time), mahimahi_ptr) - 1
+    while remaining_byte >= cumulative_byte[-1] - cumulative_byte[loop_start]:
+        # The chunk doesn't finish before we reach the end of the trace
+        if cumulative_byte[-1] <= 0:
+            raise ValueError('Trace has no bandwidth, chunk can not be downloaded')
+        remaining_byte -= cumulative_byte[-1] - cumulative_byte[loop_start]
+        downloadtime_s += cumulative_time[-1] - cumulative_time[loop_start]
+        loop_start = 0
+    mahimahi_ptr = np.searchsorted(cumulative_byte, cumulative_byte[loop_start] + remaining_byte, side='right')
+    remaining_byte -= cumulative_byte[mahimahi_ptr - 1] - cumulative_byte[loop_start]
+    fractional_time = remaining_byte / (cooked_bw[mahimahi_ptr] * B_IN_MB / BITS_IN_BYTE)
+    downloadtime_s += cumulative_time[mahimahi_ptr - 1] - cumulative_time[loop_start]
+    downloadtime_s += fractional_time
+    return downloadtime_s, mahimahi_ptr, cumulative_time[mahimahi_ptr - 1] + fractional_time
+
+
+@njit(cache=True)
+def sleep_trace(cooked_time, cumulative_time, mahimahi_ptr, last_mahimahi_time, sleep_time_ms):
+    """
+    Skip sleep_time_ms of the mahimahi trace starting at mahimahi_ptr with a binary search on the cumulative trace
+    :param cooked_time:
+    :param cumulative_time: see StreamingEnviroment.build_cumulative_trace
+    :param mahimahi_ptr:
+    :param last_mahimahi_time:
+    :param sleep_time_ms:
+    :return: sleep time which was spent in the last trace sample in ms, new mahimahi_ptr, new last_mahimahi_time
+    """
+    duration = cooked_time[mahimahi_ptr] - last_mahimahi_time
+    if duration > sleep_time_ms / MILLISECONDS_IN_SECOND:
+        return sleep_time_ms, mahimahi_ptr, last_mahimahi_time + sleep_time_ms / MILLISECONDS_IN_SECOND
+    sleep_time_ms -= duration * MILLISECONDS_IN_SECOND
+    loop_start = next_trace_sample(len(cooked_time), mahimahi_ptr) - 1
+    while sleep_time_ms / MILLISECONDS_IN_SECOND >= cumulative_time[-1] - cumulative_time[loop_start]:
+        if cumulative_time[-1] <= 0:
+            raise ValueError('Trace has no duration')
+        sleep_time_ms -= (cumulative_time[-1] - cumulative_time[loop_start]) * MILLISECONDS_IN_SECOND
+        loop_start = 0
+    mahimahi_ptr = np.searchsorted(cumulative_time, cumulative_time[loop_start] + sleep_time_ms / MILLISECONDS_IN_SECOND,
+                                   side='right')
+    sleep_time_ms -= (cumulative_time[mahimahi_ptr - 1] - cumulative_time[loop_start]) * MILLISECONDS_IN_SECOND
+    return sleep_time_ms, mahimahi_ptr, cumulative_time[mahimahi_ptr - 1] + sleep_time_ms / MILLISECONDS_IN_SECOND
+
+
+@njit(cache=True)
+def chunk_dynamics(cooked_time, cooked_bw, cumulative_time, cumulative_byte, mahimahi_ptr, last_mahimahi_time,
+                   buffer_size_ms, video_chunk_size, segment_length_ms, packet_payload_portion, link_rtt_ms,
+                   buffer_threshold_ms, drain_buffer_sleep_ms):
+    """
+    Download one chunk, update the buffer and sleep if the buffer exceeds the threshold
+    :return: download time in ms, rebuffer time in ms, sleep time in ms (spent in the last trace sample),
+    new buffer size in ms, new mahimahi_ptr, new last_mahimahi_time
+    """
+    downloadtime_s, mahimahi_ptr, last_mahimahi_time = download_trace(cooked_time, cooked_bw, cumulative_time,
+                                                                      cumulative_byte, mahimahi_ptr,
+                                                                      last_mahimahi_time, video_chunk_size,
+                                                                      packet_payload_portion)
+    downloadtime_ms = downloadtime_s * MILLISECONDS_IN_SECOND
+    downloadtime_ms += link_rtt_ms
+
+    # rebuffer time
+    rebuffer_time_ms = max(downloadtime_ms - buffer_size_ms, 0.0)
+
+    # update the buffer
+    buffer_size_ms = max(buffer_size_ms - downloadtime_ms, 0.0)
+
+    # add in the new chunk
+    buffer_size_ms += segment_length_ms  # buffer size is in ms
+
+    # sleep if buffer gets too large
+    sleep_time_ms = 0.0
+    if buffer_size_ms > buffer_threshold_ms:
+        # exceed the buffer limit
+        # we need to skip some network bandwidth here
+        # but do not add up the download_time_s
+        drain_buffer_time = buffer_size_ms - buffer_threshold_ms
+        sleep_time_ms = np.ceil(drain_buffer_time / drain_buffer_sleep_ms) * drain_buffer_sleep_ms
+        buffer_size_ms -= sleep_time_ms
+        sleep_time_ms, mahimahi_ptr, last_mahimahi_time = sleep_trace(cooked_time, cumulative_time, mahimahi_ptr,
+                                                                      last_mahimahi_time, sleep_time_ms)
+    return downloadtime_ms, rebuffer_time_ms, sleep_time_ms, buffer_size_ms, mahimahi_ptr, last_mahimahi_time
+
+
+@njit(cache=True)
+def session_dynamics(cooked_time, cooked_bw, cumulative_time, cumulative_byte, mahimahi_ptr, last_mahimahi_time,
+                     buffer_size_ms, video_chunk_size, segment_length_ms, packet_payload_portion, link_rtt_ms,
+                     buffer_threshold_ms, drain_buffer_sleep_ms):
+    """
+    chunk_dynamics for a whole sequence of chunks
+    :param video_chunk_size: size of each chunk in bytes
+    :param segment_length_ms: length of each chunk in ms
+    :return: download time, rebuffer time, sleep time and buffer size per chunk in ms, new mahimahi_ptr,
+    new last_mahimahi_time
+    """
+    n_chunk = len(video_chunk_size)
+    downloadtime_ms = np.zeros(n_chunk)
+    rebuffer_time_ms = np.zeros(n_chunk)
+    sleep_time_ms = np.zeros(n_chunk)
+    buffer_size_arr_ms = np.zeros(n_chunk)
+    for chunk_idx in range(n_chunk):
+        (downloadtime_ms[chunk_idx], rebuffer_time_ms[chunk_idx], sleep_time_ms[chunk_idx], buffer_size_ms,
+         mahimahi_ptr, last_mahimahi_time) = chunk_dynamics(cooked_time, cooked_bw, cumulative_time, cumulative_byte,
+                                                            mahimahi_ptr, last_mahimahi_time, buffer_size_ms,
+                                                            video_chunk_size[chunk_idx],
+                                                            segment_length_ms[chunk_idx], packet_payload_portion,
+                                                            link_rtt_ms, buffer_threshold_ms, drain_buffer_sleep_ms)
+        buffer_size_arr_ms[chunk_idx] = buffer_size_ms
+    return downloadtime_ms, rebuffer_time_ms, sleep_time_ms, buffer_size_arr_ms, mahimahi_ptr, last_mahimahi_time
+
+
+@njit(cache=True)
+def batch_chunk_dynamics(cooked_time, cooked_bw, cumulative_time, cumulative_byte, trace_len, trace_idx,
+                         mahimahi_ptr, last_mahimahi_time, buffer_size_ms, video_chunk_size, segment_length_ms,
+                         packet_payload_portion, link_rtt_ms, buffer_threshold_ms, drain_buffer_sleep_ms):
+    """
+    chunk_dynamics for many independent states, e.g. all branches of a planning step or sessions streamed in lockstep
+    :param cooked_time: [trace, trace sample], traces shorter than the table are padded at the end
+    :param cooked_bw: [trace, trace sample]
+    :param cumulative_time: [trace, trace sample]
+    :param cumulative_byte: [trace, trace sample]
+    :param trace_len: number of samples per trace
+    :param trace_idx: trace per state
+    :param mahimahi_ptr: per state
+    :param last_mahimahi_time: per state
+    :param buffer_size_ms: per state
+    :param video_chunk_size: per state
+    :param segment_length_ms: per state
+    :return: download time, rebuffer time, sleep time, new buffer size in ms, new mahimahi_ptr and new
+    last_mahimahi_time per state
+    """
+    n_state = len(mahimahi_ptr)
+    downloadtime_ms = np.zeros(n_state)
+    rebuffer_time_ms = np.zeros(n_state)
+    sleep_time_ms = np.zeros(n_state)
+    buffer_size_new_ms = np.zeros(n_state)
+    mahimahi_ptr_new = np.zeros(n_state, dtype=np.int64)
+    last_mahimahi_time_new = np.zeros(n_state)
+    for state_idx in range(n_state):
+        trace = trace_idx[state_idx]
+        n_sample = trace_len[trace]
+        (downloadtime_ms[state_idx], rebuffer_time_ms[state_idx], sleep_time_ms[state_idx],
+         buffer_size_new_ms[state_idx], mahimahi_ptr_new[state_idx],
+         last_mahimahi_time_new[state_idx]) = chunk_dynamics(cooked_time[trace, :n_sample], cooked_bw[trace, :n_sample],
+                                                             cumulative_time[trace, :n_sample],
+                                                             cumulative_byte[trace, :n_sample],
+                                                             mahimahi_ptr[state_idx], last_mahimahi_time[state_idx],
+                                                             buffer_size_ms[state_idx], video_chunk_size[state_idx],
+                                                             segment_length_ms[state_idx], packet_payload_portion,
+                                                             link_rtt_ms, buffer_threshold_ms, drain_buffer_sleep_ms)
+    return (downloadtime_ms, rebuffer_time_ms, sleep_time_ms, buffer_size_new_ms, mahimahi_ptr_new,
+            last_mahimahi_time_new)
@@ -0,0 +1,222 @@
+"""
+Binary corpus of bandwidth traces and video information.
+All traces and video ladders are packed into a single file which is memory mapped, so that experiments can open any
+trace or video by id without walking the data folders and parsing text files again.
+
+File layout:
+    8 byte magic | 8 byte little endian header length | json header | padding | float64 data
+The data section is columnar: the time and bandwidth values of all traces are stored as two concatenated columns,
+each video is stored column after column. The header contains the offsets (in float64 values) into the data section.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+CORPUS_MAGIC = b'ABRCORP1'
+CORPUS_VERSION = 1
+CORPUS_ALIGNMENT = 64
+CORPUS_SEPARATOR = '::'
+
+opened_corpora = {}
+
+
+def corpus_reference(corpus_path, entry_id):
+    """
+    Reference which can be handed to the streaming enviroment instead of a trace or video path
+    :param corpus_path:
+    :param entry_id:
+    :return:
+    """
+    return corpus_path + CORPUS_SEPARATOR + entry_id
+
+
+def split_corpus_reference(file_path):
+    """
+    :param file_path: trace or video path, or a reference created with corpus_reference
+    :return: (path of the file on disk, entry id or None if file_path isn't a corpus reference)
+    """
+    if CORPUS_SEPARATOR not in file_path:
+        return file_path, None
+    corpus_path, entry_id = file_path.split(CORPUS_SEPARATOR, 1)
+    return corpus_path, entry_id
+
+
+def file_name(file_path):
+    """
+    Name of the trace or video file, e.g. for the session names. A corpus reference has the name of the file the entry
+    was created from
+    :param file_path: trace or video path, or a reference created with corpus_reference
+    :return:
+    """
+    disk_path, entry_id = split_corpus_reference(file_path)
+    if entry_id is None:
+        return os.path.basename(disk_path)
+    return entry_id.split('/')[-1]
+
+
+def open_corpus(corpus_path):
+    """
+    Memory map the corpus once per process
+    :param corpus_path:
+    :return:
+    """
+    corpus_key = (os.path.abspath(corpus_path), os.path.getmtime(corpus_path))
+    if corpus_key not in opened_corpora:
+        opened_corpora[corpus_key] = StreamingCorpus(corpus_path)
+    return opened_corpora[corpus_key]
+
+
+def parse_bw_trace_text(bw_trace_file):
+    cooked_time = []
+    cooked_bw = []
+    with open(bw_trace_file, 'rb') as f:
+        for line in f:
+            parse = line.split()
+            cooked_time.append(float(parse[0]))
+            cooked_bw.append(float(parse[1]))
+    return np.array(cooked_time, dtype=float), np.array(cooked_bw, dtype=float)
+
+
+def create_corpus(corpus_path, bw_trace_file_list, video_information_csv_path_list, root_path=None):
+    """
+    Converts the trace and video files into a single binary corpus
+    :param corpus_path: Where to write the corpus
+    :param bw_trace_file_list:
+    :param video_information_csv_path_list:
+    :param root_path: The entry ids are the file paths relative to this folder, defaults to the common folder
+    :return: StreamingCorpus opened on the new file
+    """
+    if root_path is None:
+        root_path = os.path.commonpath([os.path.abspath(os.path.dirname(p)) for p in
+                                        bw_trace_file_list + video_information_csv_path_list])
+
+    def entry_id(file_path):
+        return os.path.relpath(os.path.abspath(file_path), root_path).replace(os.sep, '/')
+
+    header = {'version': CORPUS_VERSION, 'traces': {}, 'videos': {}}
+    trace_time_column = []
+    trace_bw_column = []
+    trace_offset = 0
+    for bw_trace_file in bw_trace_file_list:
+        cooked_time, cooked_bw = parse_bw_trace_text(bw_trace_file)
+        header['traces'][entry_id(bw_trace_file)] = {'offset': trace_offset, 'length': len(cooked_time)}
+        trace_time_column.append(cooked_time)
+        trace_bw_column.append(cooked_bw)
+        trace_offset += len(cooked_time)
+    header['trace_time_offset'] = 0
+    header['trace_bw_offset'] = trace_offset
+    data = trace_time_column + trace_bw_column
+    data_offset = 2 * trace_offset
+    for video_information_csv_path in video_information_csv_path_list:
+        video_information_csv = pd.read_csv(video_information_csv_path, index_col=0)
+        non_numeric = [c for c, dtype in video_information_csv.dtypes.items() if not np.issubdtype(dtype, np.number)]
+        if non_numeric:
+            raise ValueError('%s contains non numeric columns %s' % (video_information_csv_path, non_numeric))
+        video_block = video_information_csv.to_numpy(dtype=float).T.ravel()  # Column after column
+        header['videos'][entry_id(video_information_csv_path)] = {
+            'offset': data_offset,
+            'n_chunk': len(video_information_csv),
+            'columns': list(video_information_csv.columns),
+            'dtypes': [str(dtype) for dtype in video_information_csv.dtypes],
+            'index': video_information_csv.index.tolist(),
+            'index_name': video_information_csv.index.name}
+        data.append(video_block)
+        data_offset += len(video_block)
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = len(CORPUS_MAGIC) + 8 + len(header_bytes)
+    padding = -data_start % CORPUS_ALIGNMENT
+    with open(corpus_path, 'wb') as f:
+        f.write(CORPUS_MAGIC)
+        f.write(np.array([len(header_bytes) + padding], dtype='<u8').tobytes())
+        f.write(header_bytes + b' ' * padding)
+        for data_column in data:
+            f.write(np.asarray(data_column, dtype='<f8').tobytes())
+    return open_corpus(corpus_path)
+
+
+class StreamingCorpus:
+    def __init__(self, corpus_path):
+        """
+        Read only view on a corpus written by create_corpus
+        :param corpus_path:
+        """
+        self.corpus_path = corpus_path
+        with open(corpus_path, 'rb') as f:
+            if f.read(len(CORPUS_MAGIC)) != CORPUS_MAGIC:
+                raise ValueError('%s is not a streaming corpus' % corpus_path)
+            header_length = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            self.header = json.loads(f.read(header_length).decode('utf-8'))
+        if self.header['version'] != CORPUS_VERSION:
+            raise ValueError('%s has corpus version %d, expected %d' % (corpus_path, self.header['version'],
+                                                                        CORPUS_VERSION))
+        data_start = len(CORPUS_MAGIC) + 8 + header_length
+        if os.path.getsize(corpus_path) > data_start:
+            self.data = np.memmap(corpus_path, dtype='<f8', mode='r', offset=data_start)
+        else:
+            self.data = np.zeros(0)
+
+    def trace_ids(self):
+        return list(self.header['traces'].keys())
+
+    def video_ids(self):
+        return list(self.header['videos'].keys())
+
+    def trace_references(self):
+        return [corpus_reference(self.corpus_path, trace_id) for trace_id in self.trace_ids()]
+
+    def video_references(self):
+        return [corpus_reference(self.corpus_path, video_id) for video_id in self.video_ids()]
+
+    def get_trace(self, trace_id):
+        """
+        :param trace_id:
+        :return: (time, bandwidth) as read only views on the mapped file
+        """
+        trace_entry = self.header['traces'][trace_id]
+        trace_start = trace_entry['offset']
+        trace_end = trace_start + trace_entry['length']
+        cooked_time = self.data[self.header['trace_time_offset'] + trace_start:
+                                self.header['trace_time_offset'] + trace_end]
+        cooked_bw = self.data[self.header['trace_bw_offset'] + trace_start:
+                              self.header['trace_bw_offset'] + trace_end]
+        return cooked_time, cooked_bw
+
+    def get_video_information(self, video_id):
+        """
+        :param video_id:
+        :return: Dataframe as returned by pd.read_csv(video_information_csv_path, index_col=0)
+        """
+        video_entry = self.header['videos'][video_id]
+        n_columns = len(video_entry['columns'])
+        video_start = video_entry['offset']
+        video_block = self.data[video_start:video_start + n_columns * video_entry['n_chunk']]
+        video_block = video_block.reshape(n_columns, video_entry['n_chunk'])
+        video_information_csv = pd.DataFrame(
+            {column: video_block[column_idx].astype(dtype) for column_idx, (column, dtype) in
+             enumerate(zip(video_entry['columns'], video_entry['dtypes']))},
+            index=pd.Index(video_entry['index'], name=video_entry['index_name']))
+        return video_information_csv
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack bandwidth traces and video information into one corpus')
+    parser.add_argument('corpus_path')
+    parser.add_argument('--trace_folder', default='../Data/Traces')
+    parser.add_argument('--video_folder', default='../Data/Video_Info')
+    args = parser.parse_args()
+    trace_files = []
+    for root, dirs, files in os.walk(args.trace_folder):
+        for name in files:
+            trace_files.append(os.path.join(root, name))
+    video_info_files = []
+    for root, dirs, files in os.walk(args.video_folder):
+        for name in files:
+            if name.endswith('_video_info'):
+                video_info_files.append(os.path.join(root, name))
+    corpus = create_corpus(args.corpus_path, sorted(trace_files), sorted(video_info_files))
+    print('Packed %d traces and %d videos into %s' % (len(corpus.trace_ids()), len(corpus.video_ids()),
+                                                      args.corpus_path))
@@ -1,6 +1,7 @@
 from abc import abstractmethod
 
 import numpy as np
+import pandas as pd
 from pulp import LpVariable
 
 ALLOWED_POLICIES = ['Approximation', 'Expert']
@@ -11,15 +12,79 @@ class ConvergenceException(Exception):
     pass
 
 
+class RewardTable:
+    def __init__(self, perceptual_gain, smoothing_penalty, rebuffer_penalty, segment_length_s):
+        """
+        Lookup table of a linear reward function for one video, only the rebuffer time depends on the trace.
+        The reward is (perceptual_gain - rebuffer_penalty * rebuffer_time_s - smoothing_penalty) / segment_length_s,
+        which is evaluated in the same order as return_reward_batch of the reward function
+        :param perceptual_gain: [n_video_chunk, n_levels]
+        :param smoothing_penalty: [n_video_chunk, n_levels, n_levels] penalty of switching from the level of the chunk
+        before (last axis), the first chunk is compared to the zero padding of the history
+        :param rebuffer_penalty:
+        :param segment_length_s: [n_video_chunk] as it is written into the history
+        """
+        self.perceptual_gain = perceptual_gain
+        self.smoothing_penalty = smoothing_penalty
+        self.rebuffer_penalty = rebuffer_penalty
+        self.segment_length_s = segment_length_s
+        for table_value in [self.perceptual_gain, self.smoothing_penalty, self.segment_length_s]:
+            table_value.setflags(write=False)
+
+    def return_reward(self, chunk_idx, level, previous_level, rebuffer_time_s, segment_length_s=None):
+        """
+        Works on scalars and on arrays of chunks
+        :param chunk_idx:
+        :param level:
+        :param previous_level: level of the chunk before
+        :param rebuffer_time_s:
+        :param segment_length_s: defaults to the length of the chunk
+        :return:
+        """
+        if segment_length_s is None:
+            segment_length_s = self.segment_length_s[chunk_idx]
+        reward = self.perceptual_gain[chunk_idx, level] - self.rebuffer_penalty * rebuffer_time_s - \
+                 self.smoothing_penalty[chunk_idx, level, previous_level]
+        return reward / segment_length_s
+
+
 class RewardFunction:
+    perceptual_key = None  # Measurement which is passed to return_reward_batch
 
     @abstractmethod
     def return_reward_observation(self, enviroment_state):
         pass
 
+    def return_reward_batch(self, perceptual_value, perceptual_value_previous, rebuffer_time_s, segment_length_s):
+        """
+        Reward of many chunks in one call, e.g. of a whole session
+        :param perceptual_value: perceptual value of every chunk
+        :param perceptual_value_previous: perceptual value of the chunk before
+        :param rebuffer_time_s:
+        :param segment_length_s:
+        :return: reward per chunk or None if the reward function can't score chunks in batch, the enviroments then
+        score every chunk with return_reward_observation
+        """
+        return None
+
     def return_objective_dataframe(self, enviroment_state):
         return self.return_reward_observation(enviroment_state)
 
+    def reward_table_key(self):
+        """
+        :return: hashable parameters which determine the reward table of a video, None if the reward function can't
+        be tabulated
+        """
+        return None
+
+    def compile_reward_table(self, streaming_enviroment):
+        """
+        Precompute the trace independent part of the reward for every chunk of the loaded video
+        :param streaming_enviroment:
+        :return: RewardTable or None if the reward function can't be tabulated
+        """
+        return None
+
     @abstractmethod
     def extract_coefficients_dictionary(self, evaluation_dictionary):
         pass
@@ -62,17 +127,8 @@ class FunctionReward(RewardFunction):
         assert np.abs(current_level - last_level) <= streaming_enviroment.max_switch_allowed,observation['current_level']
 
 
-        observation = self.trajectory_dummy.scale_observation(
-            observation)  # This is important as the learned representation is also scaled
-        state_t = [v for k, v in sorted(
-            observation.items()) if 'streaming_environment' != k and 'future' not in k]
-        state_t = np.array(state_t).T
-        state_t = np.expand_dims(state_t, axis=0)
-
-        state_t_future = [v for k, v in sorted(
-            observation.items()) if 'streaming_environment' != k and 'future' in k]
-        state_t_future = np.array(state_t_future).T
-        state_t_future = np.expand_dims(state_t_future, axis=0)
+        state_t, state_t_future = self.trajectory_dummy.scale_observation_batch(
+            [observation])  # This is important as the learned representation is also scaled
         current_level_switch = to_categorical([switch_mapper.index(current_level - last_level)],num_classes=streaming_enviroment.max_switch_allowed * 2 + 1)
         action_prob = self.observation_transformer.predict([state_t, state_t_future,current_level_switch])
         action_prob = action_prob.flatten()
@@ -168,14 +224,20 @@ class ClassicPerceptualReward(RewardFunction):
         return lp_variables_same
 
     def extract_lp_objective(self, evaluation_dataframe, lp_variables):
+        """
+        The objective is linear in the weights, so the coefficients are summed over all chunks before the LP
+        expression is built. The expression has one term per weight regardless of the number of chunks
+        :param evaluation_dataframe:
+        :param lp_variables:
+        :return:
+        """
         coefficients = self.extract_coefficients_dataframe(evaluation_dataframe)
         perceptual_weight = lp_variables[self.perceptual_key + '_weight']
         rebuffer_penalty = lp_variables['rebuffer_penalty']
         smoothing_penality = lp_variables['smoothing_penality']
-        return sum(
-            [perceptual_weight * perceptual_gain + rebuffer_penalty * (
-                    rebuffering + 1e-10) + smoothing_penality * smoothing for
-             perceptual_gain, rebuffering, smoothing in coefficients.to_numpy()])
+        perceptual_gain, rebuffering, smoothing = (coefficients.to_numpy() + [0., 1e-10, 0.]).sum(axis=0)
+        return perceptual_weight * float(perceptual_gain) + rebuffer_penalty * float(
+            rebuffering) + smoothing_penality * float(smoothing)
 
     def extract_lp_variables(self):
         lp_variables = {
@@ -197,21 +259,43 @@ class ClassicPerceptualReward(RewardFunction):
         self.rebuffer_penalty = rebuffer_penalty
         self.perceptual_key = perceptual_key
 
+    def return_reward_batch(self, perceptual_value, perceptual_value_previous, rebuffer_time_s, segment_length_s):
+        reward = self.perceptual_weight * perceptual_value - self.rebuffer_penalty * rebuffer_time_s - \
+                 self.smoothing_penality * np.abs(perceptual_value - perceptual_value_previous)
+        return reward / segment_length_s
+
+    def reward_table_key(self):
+        return self.perceptual_key, self.perceptual_weight, self.rebuffer_penalty, self.smoothing_penality
+
+    def compile_reward_table(self, streaming_enviroment):
+        perceptual_table = streaming_enviroment.get_perceptual_table(self.perceptual_key)
+        perceptual_table_previous = np.concatenate([np.zeros((1, perceptual_table.shape[1])), perceptual_table[:-1]])
+        smoothing_penalty = self.smoothing_penality * np.abs(
+            perceptual_table[:, :, None] - perceptual_table_previous[:, None, :])
+        segment_length_s = streaming_enviroment.seg_len_s_arr * 1000. / 1000.  # Same rounding as the history
+        return RewardTable(self.perceptual_weight * perceptual_table, smoothing_penalty, self.rebuffer_penalty,
+                           segment_length_s)
+
+    def return_coefficients_batch(self, perceptual_value, perceptual_value_previous, rebuffer_time_s,
+                                  segment_length_s):
+        """
+        :return: [n_chunks, 3] coefficients of the reward weights in the order of coefficient_names
+        """
+        coefficients = np.column_stack([perceptual_value, -rebuffer_time_s,
+                                        -np.abs(perceptual_value_previous - perceptual_value)])
+        return coefficients / np.reshape(segment_length_s, (-1, 1))
+
     def return_reward_observation(self, enviroment_descriptor):
-        reward = self.perceptual_weight * enviroment_descriptor[self.perceptual_key][-1] - self.rebuffer_penalty * \
-                 enviroment_descriptor[
-                     'rebuffer_time_s'][-1] - self.smoothing_penality * np.abs(
-            enviroment_descriptor[self.perceptual_key][-1] - enviroment_descriptor[self.perceptual_key][-2])
-        reward /= enviroment_descriptor['segment_length_s'][-1]
-        return reward
+        return self.return_reward_batch(enviroment_descriptor[self.perceptual_key][-1],
+                                        enviroment_descriptor[self.perceptual_key][-2],
+                                        enviroment_descriptor['rebuffer_time_s'][-1],
+                                        enviroment_descriptor['segment_length_s'][-1])
 
     def return_reward_dataframe(self, enviroment_descriptor):
-        reward = self.perceptual_weight * enviroment_descriptor[self.perceptual_key] - self.rebuffer_penalty * \
-                 enviroment_descriptor[
-                     'rebuffering_seconds'] - self.smoothing_penality * np.abs(
-            enviroment_descriptor[self.perceptual_key] - enviroment_descriptor[self.perceptual_key].shift(1))
-        reward /= enviroment_descriptor['segment_length_s']
-        return reward
+        return self.return_reward_batch(enviroment_descriptor[self.perceptual_key],
+                                        enviroment_descriptor[self.perceptual_key].shift(1),
+                                        enviroment_descriptor['rebuffering_seconds'],
+                                        enviroment_descriptor['segment_length_s'])
 
     def extract_coefficients_dictionary(self, evaluation_dictionary):
         reward_coefficient_list = []
@@ -223,11 +307,12 @@ class ClassicPerceptualReward(RewardFunction):
         return reward_coefficient_list
 
     def extract_coefficients_dataframe(self, evaluation_dataframe):
-        reward_matrix_dataframe = evaluation_dataframe[[self.perceptual_key]].copy()
-        reward_matrix_dataframe['rebuffering_seconds'] = -evaluation_dataframe['rebuffering_seconds'].values
-        reward_matrix_dataframe[self.perceptual_key + '_shift'] = -np.abs(
-            evaluation_dataframe[self.perceptual_key].shift(1) - evaluation_dataframe[self.perceptual_key])
-        reward_matrix_dataframe /= evaluation_dataframe[['segment_length_s']].values
+        reward_matrix = self.return_coefficients_batch(evaluation_dataframe[self.perceptual_key].values,
+                                                       evaluation_dataframe[self.perceptual_key].shift(1).values,
+                                                       evaluation_dataframe['rebuffering_seconds'].values,
+                                                       evaluation_dataframe['segment_length_s'].values)
+        reward_matrix_dataframe = pd.DataFrame(reward_matrix, index=evaluation_dataframe.index,
+                                               columns=self.coefficient_names())
         return reward_matrix_dataframe.dropna()
 
     def coefficient_names(self):
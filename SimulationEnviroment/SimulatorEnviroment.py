@@ -6,6 +6,8 @@ https://github.com/hongzimao/pensieve
 import logging
 import os
 from abc import abstractmethod
+from collections import OrderedDict
+from collections.abc import MutableMapping, MutableSequence
 
 import numpy as np
 import pandas as pd
@@ -13,12 +15,16 @@ from joblib import Parallel, delayed
 from tqdm import tqdm
 
 from ABRPolicies.ABRPolicy import ABRPolicy
+from BehaviourCloning.TrajectorySequence import StratifiedSampler
+from SimulationEnviroment import ChunkKernel
+from SimulationEnviroment.Corpus import file_name, open_corpus, parse_bw_trace_text, split_corpus_reference
 
 MILLISECONDS_IN_SECOND = 1000.0
 B_IN_MB = 1000000.0
 BITS_IN_BYTE = 8.0
 LOGGING_TYPES = ['physical', 'virtual']
 M_IN_K = 1000.0
+FUTURE_KEY_PREFIXES = ['future_chunk_size_byte', 'future_chunk_bitrate', 'future_chunk_vmaf']
 
 LOGGING_LEVEL = logging.DEBUG
 handler = logging.StreamHandler()
@@ -30,6 +36,171 @@ logger.setLevel(LOGGING_LEVEL)
 logger.addHandler(handler)
 
 
+
+class EnviromentCatalog:
+    def __init__(self, max_entries=256):
+        """
+        Process wide cache of parsed traces and videos, keyed by path and modification time so that copies of an
+        enviroment and set_new_enviroment don't parse the same files again. The cached values are shared between
+        all enviroments and must not be modified. Least recently used entries are evicted first
+        :param max_entries:
+        """
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, file_path, parse_function, *parse_params):
+        """
+        :param file_path: path or corpus reference
+        :param parse_function: called as parse_function(file_path, *parse_params) if the entry isn't cached
+        :param parse_params: additional parameters the parsed value depends on
+        :return: cached result of parse_function
+        """
+        disk_path, entry_id = split_corpus_reference(file_path)
+        catalog_key = (os.path.abspath(disk_path), os.path.getmtime(disk_path), entry_id,
+                       parse_function.__name__) + parse_params
+        if catalog_key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(catalog_key)
+            return self.entries[catalog_key]
+        self.misses += 1
+        catalog_value = parse_function(file_path, *parse_params)
+        self.entries[catalog_key] = catalog_value
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return catalog_value
+
+    def clear(self):
+        self.entries.clear()
+
+
+enviroment_catalog = EnviromentCatalog()
+
+
+class Observation(MutableMapping):
+    def __init__(self, obs_names, past_observation, future_observation, max_switch_allowed, streaming_environment):
+        """
+        Observation of a streaming session with the same keys as get_obs_names. The past measurements are views on
+        the history buffers of the enviroment, the future chunk values are only split into their keys on first access.
+        :param obs_names: Order of the keys
+        :param past_observation: dictionary with the past measurements
+        :param future_observation: slice [n_switches, max_lookahead, 3] of the future tensor of the video
+        :param max_switch_allowed:
+        :param streaming_environment:
+        """
+        self.obs_names = obs_names
+        self.observation = dict(past_observation)
+        self.observation['streaming_environment'] = streaming_environment
+        self.future_observation = future_observation
+        self.max_switch_allowed = max_switch_allowed
+        self.future_generated = False
+
+    def is_future_key(self, obs_key):
+        return not self.future_generated and 'future' in obs_key and obs_key in self.obs_names
+
+    def generate_future(self):
+        """
+        Split the future tensor slice into one view per key
+        :return:
+        """
+        self.future_generated = True
+        future_observation = {}
+        for feature_idx, key_prefix in enumerate(FUTURE_KEY_PREFIXES):
+            for switch_idx, switch in enumerate(range(-self.max_switch_allowed, self.max_switch_allowed + 1)):
+                future_observation['%s_switch_%d' % (key_prefix, switch)] = self.future_observation[
+                    switch_idx, :, feature_idx]
+        observation = {}
+        for obs_key in self.obs_names:
+            if obs_key in future_observation:
+                observation[obs_key] = future_observation[obs_key]
+            elif obs_key in self.observation:
+                observation[obs_key] = self.observation[obs_key]
+        for obs_key, obs_value in self.observation.items():
+            if obs_key not in observation:
+                observation[obs_key] = obs_value
+        self.observation = observation
+
+    def __getitem__(self, obs_key):
+        if self.is_future_key(obs_key):
+            self.generate_future()
+        return self.observation[obs_key]
+
+    def __setitem__(self, obs_key, obs_value):
+        if self.is_future_key(obs_key):
+            self.generate_future()
+        self.observation[obs_key] = obs_value
+
+    def __delitem__(self, obs_key):
+        if self.is_future_key(obs_key):
+            self.generate_future()
+        del self.observation[obs_key]
+
+    def __contains__(self, obs_key):
+        return obs_key in self.observation or self.is_future_key(obs_key)
+
+    def __iter__(self):
+        if not self.future_generated:
+            self.generate_future()
+        return iter(self.observation)
+
+    def __len__(self):
+        if not self.future_generated:
+            self.generate_future()
+        return len(self.observation)
+
+    def __repr__(self):
+        return repr(self.copy())
+
+    def __reduce__(self):
+        return dict, (self.copy(),)
+
+    def copy(self):
+        return dict(self.items())
+
+
+class LazySampleList(MutableSequence):
+    def __init__(self, sample_function, sample_indices):
+        """
+        List of trajectory samples which are only created on access, e.g. from a trajectory store. The first mutation
+        materializes the samples into a normal list.
+        :param sample_function: returns the sample for an index
+        :param sample_indices: indices handed to sample_function
+        """
+        self.sample_function = sample_function
+        self.sample_indices = sample_indices
+        self.materialized = None
+
+    def materialize(self):
+        if self.materialized is None:
+            self.materialized = [self.sample_function(sample_idx) for sample_idx in self.sample_indices]
+        return self.materialized
+
+    def __getitem__(self, idx):
+        if self.materialized is not None:
+            return self.materialized[idx]
+        if isinstance(idx, slice):
+            return [self.sample_function(sample_idx) for sample_idx in self.sample_indices[idx]]
+        return self.sample_function(self.sample_indices[idx])
+
+    def __setitem__(self, idx, sample):
+        self.materialize()[idx] = sample
+
+    def __delitem__(self, idx):
+        del self.materialize()[idx]
+
+    def insert(self, idx, sample):
+        self.materialize().insert(idx, sample)
+
+    def __len__(self):
+        if self.materialized is not None:
+            return len(self.materialized)
+        return len(self.sample_indices)
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
 class StreamingEnviroment:
     def __init__(self, bw_trace_file,
                  video_information_csv_path,
@@ -40,8 +211,8 @@ class StreamingEnviroment:
                  buffer_threshold_ms=60.0 * MILLISECONDS_IN_SECOND):
         """
         Streaming Environment inspired by the code found in https://github.com/hongzimao/pensieve
-        :param bw_trace_file:
-        :param video_information_csv_path:
+        :param bw_trace_file: path or corpus reference, see SimulationEnviroment.Corpus
+        :param video_information_csv_path: path or corpus reference, see SimulationEnviroment.Corpus
         :param reward_function:
         :param max_lookback:
         :param max_lookahead:
@@ -78,16 +249,41 @@ class StreamingEnviroment:
         self.timestamp_s = 0
 
     def load_bw_trace(self, bw_trace_file):
-        self.cooked_time = []
-        self.cooked_bw = []
-        with open(self.bw_trace_file, 'rb') as f:
-            for line in f:
-                parse = line.split()
-                self.cooked_time.append(float(parse[0]))
-                self.cooked_bw.append(float(parse[1]))
+        bw_trace = enviroment_catalog.get(bw_trace_file, self.parse_bw_trace)
+        for trace_key, trace_value in bw_trace.items():
+            setattr(self, trace_key, trace_value)
         self.mahimahi_ptr = 1
         self.last_mahimahi_time = self.cooked_time[self.mahimahi_ptr - 1]
 
+    def parse_bw_trace(self, bw_trace_file):
+        corpus_path, trace_id = split_corpus_reference(bw_trace_file)
+        if trace_id is None:
+            cooked_time_arr, cooked_bw_arr = parse_bw_trace_text(bw_trace_file)
+        else:
+            cooked_time_arr, cooked_bw_arr = open_corpus(corpus_path).get_trace(trace_id)
+        bw_trace = self.build_cumulative_trace(cooked_time_arr, cooked_bw_arr)
+        for trace_value in bw_trace.values():
+            trace_value.setflags(write=False)
+        return bw_trace
+
+    def build_cumulative_trace(self, cooked_time_arr, cooked_bw_arr):
+        """
+        Prefix sums over one loop of the trace. After looping back the trace restarts at time 0 with pointer 1,
+        so cumulative_time[k] is the time at which sample k ends and cumulative_byte[k] the bytes which can be sent
+        (before the payload portion) from the start of the loop until then. Index 0 is the start of the loop.
+        :return:
+        """
+        cumulative_time = cooked_time_arr.copy()
+        cumulative_time[0] = 0
+        sample_byte = cooked_bw_arr * B_IN_MB / BITS_IN_BYTE * np.diff(cumulative_time, prepend=0.)
+        sample_byte[0] = 0
+        return {'cooked_time': cooked_time_arr,
+                'cooked_bw': cooked_bw_arr,
+                'cooked_time_arr': cooked_time_arr,
+                'cooked_bw_arr': cooked_bw_arr,
+                'cumulative_time': cumulative_time,
+                'cumulative_byte': np.cumsum(sample_byte)}
+
     def copy(self):
         return StreamingEnviroment(self.bw_trace_file,
                                    self.video_information_csv_path,
@@ -103,6 +299,14 @@ class StreamingEnviroment:
             dataframe.fillna(dataframe.mean(), inplace=True)
 
     def load_video_information_csv(self, video_information_csv_path):
+        self.video_information_csv_path = video_information_csv_path
+        video_information = enviroment_catalog.get(video_information_csv_path, self.parse_video_information_csv)
+        for video_key, video_value in video_information.items():
+            setattr(self, video_key, video_value)
+        self.future_tensor = enviroment_catalog.get(video_information_csv_path, self.build_future_tensor,
+                                                    self.max_lookahead, self.max_switch_allowed)
+
+    def parse_video_information_csv(self, video_information_csv_path):
         def extract_sorted(key_str, column):
             column = list(filter(lambda c: key_str in c, column))
             column = sorted(column,
@@ -110,27 +314,99 @@ class StreamingEnviroment:
                             )
             return column
 
-        self.video_information_csv = pd.read_csv(video_information_csv_path, index_col=0)
-        self.impute_NaN_inplace(self.video_information_csv)
-        self.video_information_csv['time_s'] = self.video_information_csv.seg_len_s.cumsum()
-        self.byte_size_match = extract_sorted('byte', self.video_information_csv.columns)
-        self.byte_size_match = self.video_information_csv[self.byte_size_match]
-        self.vmaf_match = extract_sorted('vmaf', self.video_information_csv.columns)
-        self.vmaf_match = self.video_information_csv[self.vmaf_match]
-        self.bitrate_match = extract_sorted('bitrate', self.video_information_csv.columns)
-        self.bitrate_match = self.video_information_csv[self.bitrate_match]
-        self.max_quality_level = self.byte_size_match.shape[1] - 1
-        self.video_duration = self.video_information_csv.seg_len_s.sum()
-        self.n_video_chunk = len(self.bitrate_match)
-        self.max_data_used = self.byte_size_match.sum().max()
-        self.max_rate_encoded = self.bitrate_match.mean().max()
-        self.n_pixel_arr = np.array(
-            sorted([np.array(c.split('_')[0].split('x')).astype(float).prod() for c in self.byte_size_match.columns]))
-        if len(self.byte_size_match.columns[0].split('_')[0].split('x')) > 2:  # There's fps information
-            self.fps_avail_arr = np.array(
-                sorted([np.array(c.split('_')[0].split('x')).astype(float)[-1] for c in self.byte_size_match.columns]))
+        corpus_path, video_id = split_corpus_reference(video_information_csv_path)
+        if video_id is None:
+            video_information_csv = pd.read_csv(video_information_csv_path, index_col=0)
         else:
-            self.fps_avail_arr = np.array([1])
+            video_information_csv = open_corpus(corpus_path).get_video_information(video_id)
+        self.impute_NaN_inplace(video_information_csv)
+        video_information_csv['time_s'] = video_information_csv.seg_len_s.cumsum()
+        byte_size_match = video_information_csv[extract_sorted('byte', video_information_csv.columns)]
+        vmaf_match = video_information_csv[extract_sorted('vmaf', video_information_csv.columns)]
+        bitrate_match = video_information_csv[extract_sorted('bitrate', video_information_csv.columns)]
+        video_information = {'video_information_csv': video_information_csv,
+                             'byte_size_match': byte_size_match,
+                             'vmaf_match': vmaf_match,
+                             'bitrate_match': bitrate_match,
+                             'max_quality_level': byte_size_match.shape[1] - 1,
+                             'video_duration': video_information_csv.seg_len_s.sum(),
+                             'n_video_chunk': len(bitrate_match),
+                             'max_data_used': byte_size_match.sum().max(),
+                             'max_rate_encoded': bitrate_match.mean().max()}
+        video_information['n_pixel_arr'] = np.array(
+            sorted([np.array(c.split('_')[0].split('x')).astype(float).prod() for c in byte_size_match.columns]))
+        if len(byte_size_match.columns[0].split('_')[0].split('x')) > 2:  # There's fps information
+            video_information['fps_avail_arr'] = np.array(
+                sorted([np.array(c.split('_')[0].split('x')).astype(float)[-1] for c in byte_size_match.columns]))
+        else:
+            video_information['fps_avail_arr'] = np.array([1])
+
+        """
+        Contiguous chunk x level tables used by the simulation hot paths, pandas indexing is too slow per chunk
+        """
+        video_information['byte_size_table'] = np.ascontiguousarray(byte_size_match.to_numpy(dtype=float))
+        video_information['bitrate_table'] = np.ascontiguousarray(bitrate_match.to_numpy(dtype=float))
+        video_information['vmaf_table'] = np.ascontiguousarray(vmaf_match.to_numpy(dtype=float))
+        video_information['seg_len_s_arr'] = video_information_csv.seg_len_s.to_numpy(dtype=float)
+        video_information['encoded_bitrate_arr'] = bitrate_match.mean().to_numpy(dtype=float)
+        for video_value in video_information.values():
+            if isinstance(video_value, np.ndarray):
+                video_value.setflags(write=False)
+        return video_information
+
+    def build_future_tensor(self, video_information_csv_path, max_lookahead, max_switch_allowed):
+        """
+        Future chunk values for every (chunk, current level) pair, shape
+        [n_video_chunk + 1, n_levels, n_switches, max_lookahead, 3] with byte size, bitrate and vmaf in the last axis.
+        Chunks past the end of the video are zero, the extra chunk row is the observation after the last download.
+        The tensor is read only as it is shared between all enviroments streaming the same video
+        :param video_information_csv_path: video whose tables are currently loaded
+        :param max_lookahead:
+        :param max_switch_allowed:
+        :return:
+        """
+        switches = np.arange(-max_switch_allowed, max_switch_allowed + 1)
+        level_idx = np.clip(np.arange(self.max_quality_level + 1)[:, None] + switches, a_min=0,
+                            a_max=self.max_quality_level)
+        chunk_idx = np.arange(self.n_video_chunk + 1)[:, None] + np.arange(max_lookahead)
+        chunk_idx[chunk_idx > self.n_video_chunk] = self.n_video_chunk
+        chunk_table = np.stack([self.byte_size_table, self.bitrate_table, self.vmaf_table], axis=-1)
+        chunk_table = np.concatenate([chunk_table, np.zeros((1,) + chunk_table.shape[1:])])  # Zero padding chunk
+        future_tensor = chunk_table[chunk_idx[:, None, None, :], level_idx[None, :, :, None]]
+        future_tensor.setflags(write=False)
+        return future_tensor
+
+    def get_perceptual_table(self, perceptual_key):
+        """
+        Perceptual value of every (chunk, level) pair as it is written into the history
+        :param perceptual_key: encoded_mbitrate, single_mbitrate or vmaf
+        :return: [n_video_chunk, n_levels]
+        """
+        if perceptual_key == 'encoded_mbitrate':
+            return np.tile(self.encoded_bitrate_arr * 1e-6, (self.n_video_chunk, 1))
+        if perceptual_key == 'single_mbitrate':
+            return self.bitrate_table * 1e-6
+        if perceptual_key == 'vmaf':
+            return self.vmaf_table.copy()
+        raise ValueError('%s is not a perceptual measurement' % perceptual_key)
+
+    def get_reward_table(self):
+        """
+        Lookup table of the reward function for the loaded video, compiled once per video and reward parameters
+        :return: RewardTable or None if the reward function can't be tabulated
+        """
+        reward_table_key = self.reward_function.reward_table_key()
+        if reward_table_key is None:
+            return None
+        return enviroment_catalog.get(self.video_information_csv_path, self.build_reward_table, reward_table_key)
+
+    def build_reward_table(self, video_information_csv_path, reward_table_key):
+        """
+        :param video_information_csv_path: video whose tables are currently loaded
+        :param reward_table_key: only used to key the catalog entry
+        :return:
+        """
+        return self.reward_function.compile_reward_table(self)
 
     def set_new_enviroment(self, bw_trace_file, video_information_csv_path):
         self.bw_trace_file = bw_trace_file
@@ -139,15 +415,15 @@ class StreamingEnviroment:
         self.reset()
 
     def get_encoded_bitrate(self, quality):
-        return self.bitrate_match.iloc[:, quality].mean()
+        return self.encoded_bitrate_arr[quality]
 
     def get_vmaf(self, index, quality):
-        assert len(self.vmaf_match) > index, 'Index is to big %d %d' % (len(self.vmaf_match), index)
-        return self.vmaf_match.iloc[index, quality]
+        assert self.n_video_chunk > index, 'Index is to big %d %d' % (self.n_video_chunk, index)
+        return self.vmaf_table[index, quality]
 
     def get_bitrate(self, index, quality):
-        assert len(self.bitrate_match) > index, 'Index is to big'
-        return self.bitrate_match.iloc[index, quality]
+        assert self.n_video_chunk > index, 'Index is to big'
+        return self.bitrate_table[index, quality]
 
     @abstractmethod
     def reset(self):
@@ -175,7 +451,7 @@ class StreamingEnviroment:
                                   self.buffer_size_ms / MILLISECONDS_IN_SECOND,
                                   rebuffering_seconds,
                                   video_chunk_size_byte,
-                                  self.video_information_csv.iloc[current_iterator].seg_len_s,
+                                  self.seg_len_s_arr[current_iterator],
                                   download_time_s,
                                   estimated_bandwidth_mbit,
                                   current_level,
@@ -216,7 +492,7 @@ class StreamingEnviroment:
             'rebuffering_seconds': rebuffering_seconds,
             'buffer_size_s': self.buffer_size_ms / MILLISECONDS_IN_SECOND,
             'download_time_s': download_time_s,
-            'segment_length_s': self.video_information_csv.iloc[current_iterator].seg_len_s,
+            'segment_length_s': self.seg_len_s_arr[current_iterator],
             'data_used_bytes_relative': self.data_used_bytes,
         }
 
@@ -235,20 +511,12 @@ class OfflineStreaming(StreamingEnviroment):
         """
         Initialise the values as zeros
         """
-        self.timestamp_arr = [0] * self.max_lookback
-        self.data_used_relative = [0] * self.max_lookback
-        self.quality_arr = [0] * self.max_lookback
-        self.downloadtime_arr = [0] * self.max_lookback
-        self.sleep_time_arr = [0] * self.max_lookback
-        self.buffer_size_arr = [0] * self.max_lookback
-        self.rebuffer_time_arr = [0] * self.max_lookback
-        self.video_chunk_remain_arr_relative = [0] * self.max_lookback
-        self.video_chunk_size_arr = [0] * self.max_lookback
-        self.rate_played_relative_arr = [0] * self.max_lookback
-        self.segment_length_arr = [0] * self.max_lookback
-        self.encoded_mbitrate_arr = [0] * self.max_lookback
-        self.single_mbitrate_arr = [0] * self.max_lookback
-        self.vmaf_arr = [0] * self.max_lookback
+        self.obs_names = self.get_obs_names()
+        self.history_names = self.get_history_names()
+        self.history_idx = {obs_key: field_idx for field_idx, obs_key in enumerate(self.history_names)}
+        self.history = []
+        self.history_ptr = []
+        self.reset_history()
 
     def copy(self):
         return OfflineStreaming(self.bw_trace_file, self.video_information_csv_path, self.reward_function,
@@ -259,57 +527,87 @@ class OfflineStreaming(StreamingEnviroment):
 
     def set_state(self, state):
         """
-        Set state from an observation
+        Set state from a snapshot taken with save_state. The history buffers are only rewound, nothing is copied
         :param state:
         :return:
         """
-        self.video_chunk_counter = state['video_chunk_counter']
-        self.mahimahi_ptr = state['mahimahi_ptr']
-        self.buffer_size_ms = state['buffer_size_ms']
-        self.last_mahimahi_time = state['last_mahimahi_time']
-        self.last_quality = state['last_quality']
-        self.timestamp_s = state['timestamp_s']
-        self.data_used_bytes = state['data_used_bytes_relative']
-        self.timestamp_arr = self.timestamp_arr[:state['timestamp_s_arr_ptr']]
-        self.data_used_relative = self.data_used_relative[:state['data_used_bytes_arr_ptr']]
-        self.quality_arr = self.quality_arr[:state['quality_arr_ptr']]
-        self.downloadtime_arr = self.downloadtime_arr[:state['downloadtime_arr_ptr']]
-        self.sleep_time_arr = self.sleep_time_arr[:state['sleep_time_arr_ptr']]
-        self.buffer_size_arr = self.buffer_size_arr[:state['buffer_size_arr_ptr']]
-        self.rebuffer_time_arr = self.rebuffer_time_arr[:state['rebuffer_time_arr_ptr']]
-        self.video_chunk_remain_arr_relative = self.video_chunk_remain_arr_relative[:state['video_chunk_ptr']]
-        self.video_chunk_size_arr = self.video_chunk_size_arr[:state['video_chunk_size_ptr']]
-        self.rate_played_relative_arr = self.rate_played_relative_arr[:state['rate_played_relative_ptr']]
-        self.segment_length_arr = self.segment_length_arr[:state['segment_length_ptr']]
-        self.encoded_mbitrate_arr = self.encoded_mbitrate_arr[:state['encoded_mbitrate_ptr']]
-        self.single_mbitrate_arr = self.single_mbitrate_arr[:state['single_mbitrate_ptr']]
-        self.vmaf_arr = self.vmaf_arr[:state['vmaf_ptr']]
-        assert len(self.logging_file) >= state['logging_file_ptr'], 'We somehow lost logging data on the way'
-        self.logging_file = self.logging_file[:state['logging_file_ptr']]
+        (self.video_chunk_counter, self.mahimahi_ptr, self.buffer_size_ms, self.last_mahimahi_time,
+         self.last_quality, self.timestamp_s, self.data_used_bytes, logging_file_ptr, history_ptr) = state
+        self.history_ptr = list(history_ptr)
+        assert len(self.logging_file) >= logging_file_ptr, 'We somehow lost logging data on the way'
+        del self.logging_file[logging_file_ptr:]
 
     def save_state(self):
-        return {'mahimahi_ptr': self.mahimahi_ptr,
-                'buffer_size_ms': self.buffer_size_ms,
-                'last_mahimahi_time': self.last_mahimahi_time,
-                'last_quality': self.last_quality,
-                'video_chunk_counter': self.video_chunk_counter,
-                'timestamp_s': self.timestamp_s,
-                'data_used_bytes_relative': self.data_used_bytes,
-                'video_chunk_size_ptr': len(self.video_chunk_size_arr),
-                'timestamp_s_arr_ptr': len(self.timestamp_arr),
-                'data_used_bytes_arr_ptr': len(self.data_used_relative),
-                'quality_arr_ptr': len(self.quality_arr),
-                'downloadtime_arr_ptr': len(self.downloadtime_arr),
-                'sleep_time_arr_ptr': len(self.sleep_time_arr),
-                'buffer_size_arr_ptr': len(self.buffer_size_arr),
-                'rebuffer_time_arr_ptr': len(self.rebuffer_time_arr),
-                'video_chunk_ptr': len(self.video_chunk_remain_arr_relative),
-                'logging_file_ptr': len(self.logging_file),
-                'rate_played_relative_ptr': len(self.rate_played_relative_arr),
-                'segment_length_ptr': len(self.segment_length_arr),
-                'encoded_mbitrate_ptr': len(self.encoded_mbitrate_arr),
-                'single_mbitrate_ptr': len(self.single_mbitrate_arr),
-                'vmaf_ptr': len(self.vmaf_arr)}
+        return (self.video_chunk_counter,
+                self.mahimahi_ptr,
+                self.buffer_size_ms,
+                self.last_mahimahi_time,
+                self.last_quality,
+                self.timestamp_s,
+                self.data_used_bytes,
+                len(self.logging_file),
+                tuple(self.history_ptr))
+
+    def reset_history(self):
+        """
+        Preallocate one buffer per past measurement. A session never appends more than one value per chunk on any
+        path of the lookahead tree, so the buffers don't have to be reallocated during the session.
+        The first max_lookback entries are the zero padding
+        :return:
+        """
+        capacity = self.max_lookback + self.n_video_chunk + 1
+        self.history = [np.zeros(capacity, dtype=int if obs_key == 'current_level' else float) for obs_key in
+                        self.history_names]
+        self.history_ptr = [self.max_lookback] * len(self.history_names)
+
+    def append_history(self, obs_key, value):
+        field_idx = self.history_idx[obs_key]
+        history_ptr = self.history_ptr[field_idx]
+        if history_ptr >= len(self.history[field_idx]):
+            self.history[field_idx] = np.concatenate([self.history[field_idx], np.zeros_like(self.history[field_idx])])
+        self.history[field_idx][history_ptr] = value
+        self.history_ptr[field_idx] = history_ptr + 1
+
+    def get_history(self, obs_key):
+        """
+        :param obs_key:
+        :return: view on the last max_lookback values of the measurement
+        """
+        field_idx = self.history_idx[obs_key]
+        history_ptr = self.history_ptr[field_idx]
+        return self.history[field_idx][history_ptr - self.max_lookback:history_ptr]
+
+    def download_chunk(self, quality):
+        """
+        Advance the trace, the buffer and the chunk counter by one chunk without writing the history or the log,
+        e.g. for planners which score the chunk with the reward table
+        :param quality:
+        :return: chunk size in bytes, download time in ms, rebuffer time in ms, sleep time in ms
+        """
+        video_chunk_size = self.byte_size_table[self.video_chunk_counter, quality]
+        segment_length_ms = self.seg_len_s_arr[self.video_chunk_counter] * 1000.
+
+        (downloadtime_ms, rebuffer_time_ms, sleep_time_ms, self.buffer_size_ms, mahimahi_ptr,
+         self.last_mahimahi_time) = ChunkKernel.chunk_dynamics(self.cooked_time_arr, self.cooked_bw_arr,
+                                                               self.cumulative_time, self.cumulative_byte,
+                                                               self.mahimahi_ptr, float(self.last_mahimahi_time),
+                                                               float(self.buffer_size_ms), float(video_chunk_size),
+                                                               float(segment_length_ms),
+                                                               float(self.packet_payload_portion),
+                                                               float(self.link_rtt_ms),
+                                                               float(self.buffer_threshold_ms),
+                                                               float(self.drain_buffer_sleep_ms))
+        self.mahimahi_ptr = int(mahimahi_ptr)
+
+        # the "last buffer size" return to the controller
+        # Note: in old version of dash the lowest buffer is 0.
+        # In the new version the buffer always have at least
+        # one chunk of video
+
+        self.video_chunk_counter += 1
+        self.data_used_bytes += video_chunk_size
+        self.timestamp_s += downloadtime_ms / MILLISECONDS_IN_SECOND + sleep_time_ms / MILLISECONDS_IN_SECOND
+        return video_chunk_size, downloadtime_ms, rebuffer_time_ms, sleep_time_ms
 
     def get_video_chunk(self, quality, activate_logging=True):
         """
@@ -321,111 +619,33 @@ class OfflineStreaming(StreamingEnviroment):
 
         assert quality >= 0
 
-        video_chunk_size = self.byte_size_match.iloc[self.video_chunk_counter, quality]
         relative_encoded_bitrate = self.get_encoded_bitrate(quality) / self.get_encoded_bitrate(-1)
-        segment_length_ms = self.video_information_csv.iloc[
-                                self.video_chunk_counter].seg_len_s * 1000.
+        segment_length_ms = self.seg_len_s_arr[self.video_chunk_counter] * 1000.
         encoded_mbitrate = self.get_encoded_bitrate(quality) * 1e-6
-        current_mbitrate = self.bitrate_match.iloc[self.video_chunk_counter, quality] * 1e-6
-        vmaf = self.vmaf_match.iloc[self.video_chunk_counter, quality]
-
-        downloadtime_ms = 0.0  # in ms
-        video_chunk_counter_sent = 0  # in bytes
-
-        while True:  # download video chunk over mahimahi
-            throughput = self.cooked_bw[self.mahimahi_ptr] \
-                         * B_IN_MB / BITS_IN_BYTE
-            duration = self.cooked_time[self.mahimahi_ptr] \
-                       - self.last_mahimahi_time
+        current_mbitrate = self.bitrate_table[self.video_chunk_counter, quality] * 1e-6
+        vmaf = self.vmaf_table[self.video_chunk_counter, quality]
 
-            packet_payload = throughput * duration * self.packet_payload_portion
-
-            if video_chunk_counter_sent + packet_payload > video_chunk_size:
-                fractional_time = (video_chunk_size - video_chunk_counter_sent) / \
-                                  throughput / self.packet_payload_portion
-                downloadtime_ms += fractional_time
-                self.last_mahimahi_time += fractional_time
-                break
-
-            video_chunk_counter_sent += packet_payload
-            downloadtime_ms += duration
-            self.last_mahimahi_time = self.cooked_time[self.mahimahi_ptr]
-            self.mahimahi_ptr += 1
-
-            if self.mahimahi_ptr >= len(self.cooked_bw):
-                # loop back in the beginning
-                # note: trace file starts with time 0
-                self.mahimahi_ptr = 1
-                self.last_mahimahi_time = 0
-
-        downloadtime_ms *= MILLISECONDS_IN_SECOND
-        downloadtime_ms += self.link_rtt_ms
-
-        # rebuffer time
-        rebuffer_time_ms = np.maximum(downloadtime_ms - self.buffer_size_ms, 0.0)
-
-        # update the buffer
-        self.buffer_size_ms = np.maximum(self.buffer_size_ms - downloadtime_ms, 0.0)
-
-        # add in the new chunk
-
-        self.buffer_size_ms += segment_length_ms  # buffer size is in ms
-        # sleep if buffer gets too large
-        sleep_time_ms = 0
-        if self.buffer_size_ms > self.buffer_threshold_ms:
-            # exceed the buffer limit
-            # we need to skip some network bandwidth here
-            # but do not add up the download_time_s
-            drain_buffer_time = self.buffer_size_ms - self.buffer_threshold_ms
-            sleep_time_ms = np.ceil(drain_buffer_time / self.drain_buffer_sleep_ms) * \
-                            self.drain_buffer_sleep_ms
-            self.buffer_size_ms -= sleep_time_ms
-
-            while True:
-                duration = self.cooked_time[self.mahimahi_ptr] \
-                           - self.last_mahimahi_time
-                if duration > sleep_time_ms / MILLISECONDS_IN_SECOND:
-                    self.last_mahimahi_time += sleep_time_ms / MILLISECONDS_IN_SECOND
-                    break
-                sleep_time_ms -= duration * MILLISECONDS_IN_SECOND
-                self.last_mahimahi_time = self.cooked_time[self.mahimahi_ptr]
-                self.mahimahi_ptr += 1
-
-                if self.mahimahi_ptr >= len(self.cooked_bw):
-                    # loop back in the beginning
-                    # note: trace file starts with time 0
-                    self.mahimahi_ptr = 1
-                    self.last_mahimahi_time = 0
-
-        # the "last buffer size" return to the controller
-        # Note: in old version of dash the lowest buffer is 0.
-        # In the new version the buffer always have at least
-        # one chunk of video
-
-        self.video_chunk_counter += 1
+        video_chunk_size, downloadtime_ms, rebuffer_time_ms, sleep_time_ms = self.download_chunk(quality)
         video_chunk_remain = self.n_video_chunk - self.video_chunk_counter
 
         end_of_video = False
         if self.video_chunk_counter >= self.n_video_chunk:
             end_of_video = True
 
-        self.data_used_bytes += video_chunk_size
-        self.timestamp_s += downloadtime_ms / MILLISECONDS_IN_SECOND + sleep_time_ms / MILLISECONDS_IN_SECOND
-
-        self.timestamp_arr.append(self.timestamp_s)
-        self.data_used_relative.append(self.data_used_bytes / self.max_data_used)
-        self.quality_arr.append(quality)
-        self.downloadtime_arr.append(downloadtime_ms / MILLISECONDS_IN_SECOND)
-        self.sleep_time_arr.append(sleep_time_ms / MILLISECONDS_IN_SECOND)
-        self.buffer_size_arr.append(self.buffer_size_ms / MILLISECONDS_IN_SECOND)
-        self.rebuffer_time_arr.append(rebuffer_time_ms / MILLISECONDS_IN_SECOND)
-        self.video_chunk_size_arr.append(video_chunk_size)
-        self.video_chunk_remain_arr_relative.append(video_chunk_remain / float(self.n_video_chunk))
-        self.rate_played_relative_arr.append(relative_encoded_bitrate)
-        self.segment_length_arr.append(segment_length_ms / 1000.)
-        self.encoded_mbitrate_arr.append(encoded_mbitrate)
-        self.single_mbitrate_arr.append(current_mbitrate)
-        self.vmaf_arr.append(vmaf)
+        self.append_history('timestamp_s', self.timestamp_s)
+        self.append_history('data_used_bytes_relative', self.data_used_bytes / self.max_data_used)
+        self.append_history('current_level', quality)
+        self.append_history('download_time_s', downloadtime_ms / MILLISECONDS_IN_SECOND)
+        self.append_history('sleep_time_s', sleep_time_ms / MILLISECONDS_IN_SECOND)
+        self.append_history('buffer_size_s', self.buffer_size_ms / MILLISECONDS_IN_SECOND)
+        self.append_history('rebuffer_time_s', rebuffer_time_ms / MILLISECONDS_IN_SECOND)
+        self.append_history('video_chunk_size_byte', video_chunk_size)
+        self.append_history('relative_chunk_remain', video_chunk_remain / float(self.n_video_chunk))
+        self.append_history('relative_rate_played', relative_encoded_bitrate)
+        self.append_history('segment_length_s', segment_length_ms / 1000.)
+        self.append_history('encoded_mbitrate', encoded_mbitrate)
+        self.append_history('single_mbitrate', current_mbitrate)
+        self.append_history('vmaf', vmaf)
 
         observation = self.generate_observation_dictionary()
 
@@ -442,64 +662,137 @@ class OfflineStreaming(StreamingEnviroment):
         self.last_quality = quality
         return observation, reward, end_of_video, info
 
+    def extend_history(self, obs_key, values):
+        """
+        append_history for several values at once
+        :param obs_key:
+        :param values:
+        :return:
+        """
+        field_idx = self.history_idx[obs_key]
+        history_ptr = self.history_ptr[field_idx]
+        while history_ptr + len(values) > len(self.history[field_idx]):
+            self.history[field_idx] = np.concatenate([self.history[field_idx], np.zeros_like(self.history[field_idx])])
+        self.history[field_idx][history_ptr:history_ptr + len(values)] = values
+        self.history_ptr[field_idx] = history_ptr + len(values)
+
+    def replay(self, quality_sequence, activate_logging=True):
+        """
+        Download a known sequence of quality levels starting from the current state. Gives the same result as calling
+        get_video_chunk for every quality, but the download dynamics run in one kernel call and all measurements
+        are written into the history buffers at once
+        :param quality_sequence: quality level for each of the next chunks
+        :param activate_logging:
+        :return: observation before the first chunk followed by the observation after every chunk, reward per chunk
+        """
+        quality_sequence = np.asarray(quality_sequence, dtype=int)
+        n_replay = len(quality_sequence)
+        assert (quality_sequence >= 0).all()
+        assert n_replay <= self.n_video_chunk - self.video_chunk_counter, 'Sequence is longer than the remaining video'
+        history_start = self.history_ptr[self.history_idx['current_level']]
+        observation_list = [self.generate_observation_dictionary()]
+        if n_replay == 0:
+            return observation_list, np.zeros(0)
+        chunk_idx = self.video_chunk_counter + np.arange(n_replay)
+        video_chunk_size = self.byte_size_table[chunk_idx, quality_sequence]
+        segment_length_ms = self.seg_len_s_arr[chunk_idx] * 1000.
+        (downloadtime_ms, rebuffer_time_ms, sleep_time_ms, buffer_size_ms, mahimahi_ptr,
+         self.last_mahimahi_time) = ChunkKernel.session_dynamics(self.cooked_time_arr, self.cooked_bw_arr,
+                                                                 self.cumulative_time, self.cumulative_byte,
+                                                                 self.mahimahi_ptr, float(self.last_mahimahi_time),
+                                                                 float(self.buffer_size_ms),
+                                                                 video_chunk_size.astype(float), segment_length_ms,
+                                                                 float(self.packet_payload_portion),
+                                                                 float(self.link_rtt_ms),
+                                                                 float(self.buffer_threshold_ms),
+                                                                 float(self.drain_buffer_sleep_ms))
+        self.mahimahi_ptr = int(mahimahi_ptr)
+        # Same summation order as the step wise updates
+        timestamp_s = np.cumsum(np.concatenate([[self.timestamp_s], downloadtime_ms / MILLISECONDS_IN_SECOND +
+                                                sleep_time_ms / MILLISECONDS_IN_SECOND]))[1:]
+        data_used_bytes = np.cumsum(np.concatenate([[self.data_used_bytes], video_chunk_size]))[1:]
+        video_chunk_counter = chunk_idx + 1
+        encoded_bitrate = self.encoded_bitrate_arr[quality_sequence]
+        current_mbitrate = self.bitrate_table[chunk_idx, quality_sequence] * 1e-6
+
+        self.extend_history('timestamp_s', timestamp_s)
+        self.extend_history('data_used_bytes_relative', data_used_bytes / self.max_data_used)
+        self.extend_history('current_level', quality_sequence)
+        self.extend_history('download_time_s', downloadtime_ms / MILLISECONDS_IN_SECOND)
+        self.extend_history('sleep_time_s', sleep_time_ms / MILLISECONDS_IN_SECOND)
+        self.extend_history('buffer_size_s', buffer_size_ms / MILLISECONDS_IN_SECOND)
+        self.extend_history('rebuffer_time_s', rebuffer_time_ms / MILLISECONDS_IN_SECOND)
+        self.extend_history('video_chunk_size_byte', video_chunk_size)
+        self.extend_history('relative_chunk_remain', (self.n_video_chunk - video_chunk_counter) / float(
+            self.n_video_chunk))
+        self.extend_history('relative_rate_played', encoded_bitrate / self.get_encoded_bitrate(-1))
+        self.extend_history('segment_length_s', segment_length_ms / 1000.)
+        self.extend_history('encoded_mbitrate', encoded_bitrate * 1e-6)
+        self.extend_history('single_mbitrate', current_mbitrate)
+        self.extend_history('vmaf', self.vmaf_table[chunk_idx, quality_sequence])
+
+        """
+        Observations are views on the history buffers as in generate_observation_dictionary
+        """
+        reward_arr = None
+        if self.reward_function.perceptual_key is not None:
+            perceptual_history = self.history[self.history_idx[self.reward_function.perceptual_key]]
+            reward_arr = self.reward_function.return_reward_batch(
+                perceptual_history[history_start:history_start + n_replay],
+                perceptual_history[history_start - 1:history_start + n_replay - 1],
+                rebuffer_time_ms / MILLISECONDS_IN_SECOND, segment_length_ms / 1000.)
+        future_chunk_idx = np.minimum(video_chunk_counter, self.n_video_chunk)
+        for replay_idx in range(n_replay):
+            history_ptr = history_start + replay_idx + 1
+            past_observation = {obs_key: self.history[self.history_idx[obs_key]][
+                                         history_ptr - self.max_lookback:history_ptr] for obs_key in
+                                self.history_names}
+            observation = Observation(self.obs_names, past_observation,
+                                      self.future_tensor[future_chunk_idx[replay_idx], quality_sequence[replay_idx]],
+                                      self.max_switch_allowed, self)
+            observation_list.append(observation)
+        if reward_arr is None:
+            # The reward function can't score chunks in batch
+            reward_arr = np.array([self.reward_function.return_reward_observation(observation) for observation in
+                                   observation_list[1:]])
+
+        if activate_logging:
+            logging_idx = np.minimum(video_chunk_counter, self.n_video_chunk - 1)
+            download_time_s = downloadtime_ms / MILLISECONDS_IN_SECOND
+            self.logging_file += np.column_stack([timestamp_s,
+                                                  encoded_bitrate * 1e-6,
+                                                  self.bitrate_table[logging_idx, quality_sequence] * 1e-6,
+                                                  self.vmaf_table[logging_idx, quality_sequence],
+                                                  buffer_size_ms / MILLISECONDS_IN_SECOND,
+                                                  rebuffer_time_ms / MILLISECONDS_IN_SECOND,
+                                                  video_chunk_size,
+                                                  self.seg_len_s_arr[logging_idx],
+                                                  download_time_s,
+                                                  (8e-6 * video_chunk_size) / download_time_s,
+                                                  quality_sequence,
+                                                  data_used_bytes,
+                                                  reward_arr]).tolist()
+
+        self.video_chunk_counter += n_replay
+        self.buffer_size_ms = buffer_size_ms[-1]
+        self.last_quality = int(quality_sequence[-1])
+        self.timestamp_s = timestamp_s[-1]
+        self.data_used_bytes = data_used_bytes[-1]
+        return observation_list, reward_arr
+
     def generate_observation_dictionary(self):
         """
         Generate observation from the different measurements
         :return:
         """
-        quality = self.quality_arr[-1]
-        observation = []
-        observation.append(self.timestamp_arr[-self.max_lookback:])
-        observation.append(self.data_used_relative[-self.max_lookback:])
-        observation.append(self.quality_arr[-self.max_lookback:])
-        observation.append(self.downloadtime_arr[-self.max_lookback:])
-        observation.append(self.sleep_time_arr[-self.max_lookback:])
-        observation.append(self.buffer_size_arr[-self.max_lookback:])
-        observation.append(self.rebuffer_time_arr[-self.max_lookback:])
-        observation.append(self.video_chunk_size_arr[-self.max_lookback:])
-        observation.append(self.video_chunk_remain_arr_relative[-self.max_lookback:])
-        observation.append(self.rate_played_relative_arr[-self.max_lookback:])
-        observation.append(self.segment_length_arr[-self.max_lookback:])
-        observation.append(self.encoded_mbitrate_arr[-self.max_lookback:])
-        observation.append(self.single_mbitrate_arr[-self.max_lookback:])
-        observation.append(self.vmaf_arr[-self.max_lookback:])
-        for switch in np.arange(quality - self.max_switch_allowed, quality + self.max_switch_allowed + 1):
-            switch = np.clip(switch, a_min=0, a_max=self.max_quality_level)
-            switch = int(switch)
-            future_chunk_size_arr = []
-            for lookahead in range(0, self.max_lookahead):
-                if self.video_chunk_counter + lookahead < self.n_video_chunk:
-                    future_chunk_size = self.byte_size_match.iloc[self.video_chunk_counter + lookahead, switch]
-                else:
-                    future_chunk_size = 0
-                future_chunk_size_arr.append(future_chunk_size)
-            observation.append(future_chunk_size_arr)
-        for switch in np.arange(quality - self.max_switch_allowed, quality + self.max_switch_allowed + 1):
-            switch = np.clip(switch, a_min=0, a_max=self.max_quality_level)
-            switch = int(switch)
-            future_chunk_size_arr = []
-            for lookahead in range(0, self.max_lookahead):
-                if self.video_chunk_counter + lookahead < self.n_video_chunk:
-                    future_chunk_size = self.bitrate_match.iloc[self.video_chunk_counter + lookahead, switch]
-                else:
-                    future_chunk_size = 0
-                future_chunk_size_arr.append(future_chunk_size)
-            observation.append(future_chunk_size_arr)
-        for switch in np.arange(quality - self.max_switch_allowed, quality + self.max_switch_allowed + 1):
-            switch = np.clip(switch, a_min=0, a_max=self.max_quality_level)
-            switch = int(switch)
-            future_chunk_size_arr = []
-            for lookahead in range(0, self.max_lookahead):
-                if self.video_chunk_counter + lookahead < self.n_video_chunk:
-                    future_chunk_size = self.vmaf_match.iloc[self.video_chunk_counter + lookahead, switch]
-                else:
-                    future_chunk_size = 0
-                future_chunk_size_arr.append(future_chunk_size)
-            observation.append(future_chunk_size_arr)
+        past_observation = {obs_key: self.get_history(obs_key) for obs_key in self.history_names}
+        future_observation = self.future_tensor[min(self.video_chunk_counter, self.n_video_chunk),
+                                                past_observation['current_level'][-1]]
+        return Observation(self.obs_names, past_observation, future_observation, self.max_switch_allowed, self)
 
-        observation.append(self)
-        observation = {obs_key: obs_value for obs_key, obs_value in zip(self.get_obs_names(), observation)}
-        return observation
+    def get_history_names(self):
+        return [obs_key for obs_key in self.get_obs_names() if 'future' not in obs_key and
+                'streaming_environment' != obs_key]
 
     def get_past_dims(self):
         return len([v for v in self.get_obs_names() if 'future' not in v]) - 1
@@ -533,20 +826,250 @@ class OfflineStreaming(StreamingEnviroment):
         """
         Padding and stuff
         """
-        self.timestamp_arr = [0] * self.max_lookback
-        self.data_used_relative = [0] * self.max_lookback
-        self.quality_arr = [0] * self.max_lookback
-        self.downloadtime_arr = [0] * self.max_lookback
-        self.sleep_time_arr = [0] * self.max_lookback
-        self.buffer_size_arr = [0] * self.max_lookback
-        self.rebuffer_time_arr = [0] * self.max_lookback
-        self.video_chunk_remain_arr_relative = [0] * self.max_lookback
-        self.video_chunk_size_arr = [0] * self.max_lookback
-        self.rate_played_relative_arr = [0] * self.max_lookback
-        self.segment_length_arr = [0] * self.max_lookback
-        self.encoded_mbitrate_arr = [0] * self.max_lookback
-        self.single_mbitrate_arr = [0] * self.max_lookback
-        self.vmaf_arr = [0] * self.max_lookback
+        self.reset_history()
+
+
+class BatchOfflineStreaming:
+    def __init__(self, bw_trace_file_list, video_information_csv_path_list, reward_function, max_lookback: int,
+                 max_lookahead: int, max_switch_allowed: int, buffer_threshold_ms=60 * MILLISECONDS_IN_SECOND,
+                 drain_buffer_sleep_ms=500.0, packet_payload_portion=0.95, link_rtt_ms=200, packet_size_byte=1500):
+        """
+        Simulates N (trace,video) sessions of OfflineStreaming in lockstep. Every call to get_video_chunk advances
+        all unfinished sessions by one chunk, the state of the sessions is kept in arrays with the session on the last axis
+        :param bw_trace_file_list: bandwidth trace per session
+        :param video_information_csv_path_list: video information per session
+        :param reward_function: reward function, the active sessions are scored with return_reward_batch if the reward
+        function supports it
+        :param max_lookback:
+        :param max_lookahead:
+        :param max_switch_allowed:
+        :param buffer_threshold_ms:
+        :param drain_buffer_sleep_ms:
+        :param packet_payload_portion:
+        :param link_rtt_ms:
+        :param packet_size_byte:
+        """
+        assert len(bw_trace_file_list) == len(video_information_csv_path_list), 'We need one trace per video'
+        assert max_lookback >= 2, 'We need at least the current and the last measurement for the reward'
+        self.bw_trace_file_list = list(bw_trace_file_list)
+        self.video_information_csv_path_list = list(video_information_csv_path_list)
+        self.reward_function = reward_function
+        self.max_lookback = max_lookback
+        self.max_lookahead = max_lookahead
+        self.max_switch_allowed = max_switch_allowed
+        self.buffer_threshold_ms = buffer_threshold_ms
+        self.drain_buffer_sleep_ms = drain_buffer_sleep_ms
+        self.packet_payload_portion = packet_payload_portion
+        self.link_rtt_ms = link_rtt_ms
+        self.packet_size_byte = packet_size_byte
+        self.n_sessions = len(self.bw_trace_file_list)
+        self.session_enviroments = [
+            OfflineStreaming(bw_trace_file, video_information_csv_path, reward_function, max_lookback, max_lookahead,
+                             max_switch_allowed, buffer_threshold_ms, drain_buffer_sleep_ms, packet_payload_portion,
+                             link_rtt_ms, packet_size_byte) for bw_trace_file, video_information_csv_path in
+            zip(self.bw_trace_file_list, self.video_information_csv_path_list)]
+        self.stack_sessions()
+        self.reset()
+
+    def stack_sessions(self):
+        """
+        Pad the per session traces and chunk tables into [session, ...] arrays
+        :return:
+        """
+        self.trace_len = np.array([len(env.cooked_time) for env in self.session_enviroments], dtype=np.int64)
+        self.cooked_time = np.zeros((self.n_sessions, self.trace_len.max()))
+        self.cooked_bw = np.zeros((self.n_sessions, self.trace_len.max()))
+        self.cumulative_time = np.zeros((self.n_sessions, self.trace_len.max()))
+        self.cumulative_byte = np.zeros((self.n_sessions, self.trace_len.max()))
+        self.n_video_chunk = np.array([env.n_video_chunk for env in self.session_enviroments])
+        self.max_quality_level = np.array([env.max_quality_level for env in self.session_enviroments])
+        table_shape = (self.n_sessions, self.n_video_chunk.max(), self.max_quality_level.max() + 1)
+        self.byte_size_table = np.zeros(table_shape)
+        self.bitrate_table = np.zeros(table_shape)
+        self.vmaf_table = np.zeros(table_shape)
+        self.seg_len_s_arr = np.zeros(table_shape[:2])
+        self.encoded_bitrate_arr = np.zeros((self.n_sessions, table_shape[2]))
+        self.max_data_used = np.array([env.max_data_used for env in self.session_enviroments], dtype=float)
+        for session_idx, env in enumerate(self.session_enviroments):
+            self.cooked_time[session_idx, :self.trace_len[session_idx]] = env.cooked_time
+            self.cooked_bw[session_idx, :self.trace_len[session_idx]] = env.cooked_bw
+            self.cumulative_time[session_idx, :self.trace_len[session_idx]] = env.cumulative_time
+            self.cumulative_byte[session_idx, :self.trace_len[session_idx]] = env.cumulative_byte
+            n_chunk, n_level = env.byte_size_table.shape
+            self.byte_size_table[session_idx, :n_chunk, :n_level] = env.byte_size_table
+            self.bitrate_table[session_idx, :n_chunk, :n_level] = env.bitrate_table
+            self.vmaf_table[session_idx, :n_chunk, :n_level] = env.vmaf_table
+            self.seg_len_s_arr[session_idx, :n_chunk] = env.seg_len_s_arr
+            self.encoded_bitrate_arr[session_idx, :n_level] = env.encoded_bitrate_arr
+        self.session_idx_arr = np.arange(self.n_sessions)
+        self.max_encoded_bitrate = self.encoded_bitrate_arr[self.session_idx_arr, self.max_quality_level]
+
+    def reset(self):
+        self.video_chunk_counter = np.zeros(self.n_sessions, dtype=int)
+        self.buffer_size_ms = np.zeros(self.n_sessions)
+        self.mahimahi_ptr = np.ones(self.n_sessions, dtype=np.int64)
+        self.last_mahimahi_time = self.cooked_time[:, 0].copy()
+        self.last_quality = np.zeros(self.n_sessions, dtype=int)
+        self.timestamp_s = np.zeros(self.n_sessions)
+        self.data_used_bytes = np.zeros(self.n_sessions)
+        self.logging_file = []
+        """
+        Padding and stuff, past measurements are kept as [max_lookback, session]
+        """
+        self.past_history = {
+            obs_key: np.zeros((self.max_lookback, self.n_sessions), dtype=int if obs_key == 'current_level' else float)
+            for obs_key in self.get_history_names()}
+
+    def copy(self):
+        return BatchOfflineStreaming(self.bw_trace_file_list, self.video_information_csv_path_list,
+                                     self.reward_function, self.max_lookback, self.max_lookahead,
+                                     self.max_switch_allowed, self.buffer_threshold_ms, self.drain_buffer_sleep_ms,
+                                     self.packet_payload_portion, self.link_rtt_ms, self.packet_size_byte)
+
+    def get_obs_names(self):
+        return self.session_enviroments[0].get_obs_names()
+
+    def get_history_names(self):
+        return self.session_enviroments[0].get_history_names()
+
+    def get_logging_columns(self):
+        return self.session_enviroments[0].get_logging_columns()
+
+    def active_sessions(self):
+        return self.video_chunk_counter < self.n_video_chunk
+
+    def get_video_chunk(self, quality, activate_logging=True):
+        """
+        Simulation routine for all sessions which haven't finished yet
+        :param quality: quality level per session, ignored for finished sessions
+        :param activate_logging:
+        :return: observation, reward and end_of_video per session, reward is NaN for already finished sessions
+        """
+        quality = np.asarray(quality, dtype=int)
+        assert quality.shape == (self.n_sessions,), 'We need one quality level per session'
+        session_idx = np.where(self.active_sessions())[0]
+        assert len(session_idx) > 0, 'All sessions have already finished'
+        quality_active = quality[session_idx]
+        assert np.all(quality_active >= 0) and np.all(quality_active <= self.max_quality_level[session_idx])
+        chunk_idx = self.video_chunk_counter[session_idx]
+
+        video_chunk_size = self.byte_size_table[session_idx, chunk_idx, quality_active]
+        encoded_bitrate = self.encoded_bitrate_arr[session_idx, quality_active]
+        relative_encoded_bitrate = encoded_bitrate / self.max_encoded_bitrate[session_idx]
+        segment_length_ms = self.seg_len_s_arr[session_idx, chunk_idx] * 1000.
+        encoded_mbitrate = encoded_bitrate * 1e-6
+        current_mbitrate = self.bitrate_table[session_idx, chunk_idx, quality_active] * 1e-6
+        vmaf = self.vmaf_table[session_idx, chunk_idx, quality_active]
+
+        (downloadtime_ms, rebuffer_time_ms, sleep_time_ms, buffer_size_ms, self.mahimahi_ptr[session_idx],
+         self.last_mahimahi_time[session_idx]) = ChunkKernel.batch_chunk_dynamics(
+            self.cooked_time, self.cooked_bw, self.cumulative_time, self.cumulative_byte, self.trace_len, session_idx,
+            self.mahimahi_ptr[session_idx], self.last_mahimahi_time[session_idx], self.buffer_size_ms[session_idx],
+            video_chunk_size, segment_length_ms, float(self.packet_payload_portion), float(self.link_rtt_ms),
+            float(self.buffer_threshold_ms), float(self.drain_buffer_sleep_ms))
+        self.buffer_size_ms[session_idx] = buffer_size_ms
+
+        self.video_chunk_counter[session_idx] += 1
+        video_chunk_remain = self.n_video_chunk[session_idx] - self.video_chunk_counter[session_idx]
+        end_of_video = ~self.active_sessions()
+
+        self.data_used_bytes[session_idx] += video_chunk_size
+        self.timestamp_s[session_idx] += downloadtime_ms / MILLISECONDS_IN_SECOND + \
+                                         sleep_time_ms / MILLISECONDS_IN_SECOND
+
+        measurements = {'timestamp_s': self.timestamp_s[session_idx],
+                        'data_used_bytes_relative': self.data_used_bytes[session_idx] / self.max_data_used[
+                            session_idx],
+                        'current_level': quality_active,
+                        'download_time_s': downloadtime_ms / MILLISECONDS_IN_SECOND,
+                        'sleep_time_s': sleep_time_ms / MILLISECONDS_IN_SECOND,
+                        'buffer_size_s': buffer_size_ms / MILLISECONDS_IN_SECOND,
+                        'rebuffer_time_s': rebuffer_time_ms / MILLISECONDS_IN_SECOND,
+                        'video_chunk_size_byte': video_chunk_size,
+                        'relative_chunk_remain': video_chunk_remain / self.n_video_chunk[session_idx].astype(float),
+                        'relative_rate_played': relative_encoded_bitrate,
+                        'segment_length_s': segment_length_ms / 1000.,
+                        'encoded_mbitrate': encoded_mbitrate,
+                        'single_mbitrate': current_mbitrate,
+                        'vmaf': vmaf}
+        for obs_key, measurement in measurements.items():
+            history = self.past_history[obs_key]
+            history[:-1, session_idx] = history[1:, session_idx]
+            history[-1, session_idx] = measurement
+
+        observation = self.generate_observation_dictionary()
+        info = {}
+        reward = np.full(self.n_sessions, np.nan)
+        session_reward = None
+        if self.reward_function.perceptual_key is not None:
+            perceptual_history = self.past_history[self.reward_function.perceptual_key]
+            session_reward = self.reward_function.return_reward_batch(
+                perceptual_history[-1, session_idx], perceptual_history[-2, session_idx],
+                self.past_history['rebuffer_time_s'][-1, session_idx],
+                self.past_history['segment_length_s'][-1, session_idx])
+        if session_reward is None:
+            # The reward function can't score chunks in batch, every session is scored on its own measurements
+            session_reward = [self.reward_function.return_reward_observation(
+                {obs_key: value if obs_key == 'streaming_environment' else value[:, session] for obs_key, value in
+                 observation.items()}) for session in session_idx]
+        reward[session_idx] = session_reward
+
+        if activate_logging:
+            self.log_state(session_idx, quality_active, rebuffer_time_ms / MILLISECONDS_IN_SECOND,
+                           video_chunk_size, downloadtime_ms / MILLISECONDS_IN_SECOND, reward[session_idx])
+
+        self.last_quality[session_idx] = quality_active
+        return observation, reward, end_of_video, info
+
+    def log_state(self, session_idx, current_level, rebuffering_seconds, video_chunk_size_byte, download_time_s,
+                  reward):
+        estimated_bandwidth_mbit = (8e-6 * video_chunk_size_byte) / download_time_s
+        current_iterator = np.minimum(self.video_chunk_counter[session_idx], self.n_video_chunk[session_idx] - 1)
+        logging_step = np.column_stack([self.timestamp_s[session_idx],
+                                        self.encoded_bitrate_arr[session_idx, current_level] * 1e-6,
+                                        self.bitrate_table[session_idx, current_iterator, current_level] * 1e-6,
+                                        self.vmaf_table[session_idx, current_iterator, current_level],
+                                        self.buffer_size_ms[session_idx] / MILLISECONDS_IN_SECOND,
+                                        rebuffering_seconds,
+                                        video_chunk_size_byte,
+                                        self.seg_len_s_arr[session_idx, current_iterator],
+                                        download_time_s,
+                                        estimated_bandwidth_mbit,
+                                        current_level,
+                                        self.data_used_bytes[session_idx],
+                                        reward])
+        self.logging_file.append((session_idx, logging_step))
+
+    def return_log_state(self):
+        """
+        :return: list with the logging rows of every session, same format as OfflineStreaming.return_log_state
+        """
+        session_logging = [[] for _ in range(self.n_sessions)]
+        for session_idx, logging_step in self.logging_file:
+            for session, logging_row in zip(session_idx, logging_step.tolist()):
+                session_logging[session].append(logging_row)
+        return session_logging
+
+    def generate_observation_dictionary(self):
+        """
+        Generate observation from the different measurements, past measurements have the shape [max_lookback, session]
+        and future measurements [max_lookahead, session]
+        :return:
+        """
+        observation = {obs_key: history.copy() for obs_key, history in self.past_history.items()}
+        quality = self.past_history['current_level'][-1]
+        future_chunk_idx = self.video_chunk_counter[:, None] + np.arange(self.max_lookahead)
+        future_chunk_valid = future_chunk_idx < self.n_video_chunk[:, None]
+        future_chunk_idx = np.minimum(future_chunk_idx, self.n_video_chunk[:, None] - 1)
+        session_idx = self.session_idx_arr[:, None]
+        for table, table_name in zip([self.byte_size_table, self.bitrate_table, self.vmaf_table],
+                                     ['size_byte', 'bitrate', 'vmaf']):
+            for switch in np.arange(-self.max_switch_allowed, self.max_switch_allowed + 1):
+                switch_level = np.clip(quality + switch, a_min=0, a_max=self.max_quality_level)[:, None]
+                future_value = np.where(future_chunk_valid, table[session_idx, future_chunk_idx, switch_level], 0)
+                observation['future_chunk_%s_switch_%d' % (table_name, switch)] = future_value.T
+        observation['streaming_environment'] = self
+        return observation
 
 
 class StreamingSessionEvaluation:
@@ -569,6 +1092,16 @@ class StreamingSessionEvaluation:
 
 
 class Trajectory:
+    TRAJECTORY_ARRAYS = ['trajectory_state_t_arr', 'trajectory_state_t_future', 'trajectory_state_t_1_arr',
+                         'trajectory_state_t_1_future', 'trajectory_action_t_arr', 'trajectory_likelihood']
+    # Scaling of the observation features, features which aren't listed are left as they are
+    PAST_SCALE_MULTIPLIER = {'video_chunk_size_byte': 1e-6}  # in mbyte
+    PAST_SCALE_DIVISOR = {'encoded_mbitrate': 8.0,  # encode that in mbyte to have the same scaling for all features
+                          'single_mbitrate': 8.0,
+                          'vmaf': 100.}
+    TIME_NORMALIZED_FEATURES = ['download_time_s', 'sleep_time_s', 'rebuffer_time_s', 'segment_length_s']
+    FUTURE_SCALE_MULTIPLIER = {'future_chunk_size_byte': 1e-6, 'future_chunk_bitrate': 1.25e-7}
+    CONVERT_BLOCK_SIZE = 4096  # Number of samples which are scaled at once in convert_list
 
     def __init__(self):
         """
@@ -584,50 +1117,168 @@ class Trajectory:
         self.trajectory_action_t_arr = None
         self.trajectory_likelihood = None
         self.trajectory_column = None
+        self.trajectory_buffers = {}  # Preallocated storage behind the converted arrays
         self.n_trajectories = None
         self.class_association = {}
         self.trajectory_sample_association = {}
         self.time_normalization = 10.
         self.n_features_observation = 0
 
-    def scale_observation(self, state_unscaled):
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'trajectory_buffers' not in state:  # Pickled before the converted arrays were preallocated
+            self.trajectory_buffers = {array_name: getattr(self, array_name) for array_name in self.TRAJECTORY_ARRAYS
+                                       if getattr(self, array_name) is not None}
 
-        state_scaled = state_unscaled.copy()
-        if sum(state_unscaled['timestamp_s']) != 0:
-            state_scaled['timestamp_s'] = [state_unscaled['timestamp_s'][-1] - v for v in state_unscaled['timestamp_s']]
-            state_scaled['timestamp_s'] = [v / state_scaled['timestamp_s'][0] for v in
-                                           state_scaled[
-                                               'timestamp_s']]  # How far are we away from the current measurement
-        state_scaled['video_chunk_size_byte'] = [v * 1e-6 for v in state_unscaled['video_chunk_size_byte']]  # in mbyte
-        del state_scaled['current_level']  # This value in of itself doesn't mean anything
-        # encode that in mbyte to have the same scaling for all features
-        state_scaled['encoded_mbitrate'] = [v / 8.0 for v in
-                                            state_unscaled['encoded_mbitrate']]
-        state_scaled['single_mbitrate'] = [v / 8.0 for v in
-                                           state_unscaled['single_mbitrate']]
-
-        state_scaled['download_time_s'] = [v / self.time_normalization for v in
-                                           state_unscaled['download_time_s']]  # in mbyte
-        state_scaled['sleep_time_s'] = [v / self.time_normalization for v in
-                                        state_unscaled['sleep_time_s']]  # in mbyte
-        state_scaled['rebuffer_time_s'] = [v / self.time_normalization for v in
-                                           state_unscaled['rebuffer_time_s']]  # in mbyte
-        state_scaled['throughput_mbyte'] = [(size * 1e-6) / time_s if time_s > 0 else 0 for size, time_s in zip(
-            state_unscaled['video_chunk_size_byte'], state_unscaled['download_time_s'])]  # in mbyte
-        state_scaled['segment_length_s'] = [v / self.time_normalization for v in
-                                            state_unscaled['segment_length_s']]
-        state_scaled['vmaf'] = [v / 100. for v in
-                                state_unscaled['vmaf']]
-
-        for k, v in state_scaled.items():
-            if 'future_chunk_size_byte' in k:
-                state_scaled[k] = [v * 1e-6 for v in state_unscaled[k]]
-            if 'future_chunk_bitrate' in k:
-                state_scaled[k] = [v * 1.25e-7 for v in state_unscaled[k]]
+    def scaling_rules(self):
+        """
+        :return: the rules which scale_observation applies, the converted arrays are only valid for the same rules
+        """
+        return {'past_scale_multiplier': self.PAST_SCALE_MULTIPLIER, 'past_scale_divisor': self.PAST_SCALE_DIVISOR,
+                'time_normalized_features': self.TIME_NORMALIZED_FEATURES,
+                'time_normalization': self.time_normalization,
+                'future_scale_multiplier': self.FUTURE_SCALE_MULTIPLIER}
+
+    def scaled_past_columns(self, past_columns):
+        """
+        :param past_columns: names of the unscaled past measurements
+        :return: sorted names of the scaled past measurements
+        """
+        return sorted([k for k in past_columns if k != 'current_level'] + ['throughput_mbyte'])
+
+    def scale_factors(self, columns):
+        """
+        Every feature is scaled as feature * multiplier / divisor
+        :param columns: names of the features
+        :return: multiplier and divisor per feature
+        """
+        multiplier = np.ones(len(columns))
+        divisor = np.ones(len(columns))
+        for column_idx, k in enumerate(columns):
+            if 'future' in k:
+                for future_prefix, future_multiplier in self.FUTURE_SCALE_MULTIPLIER.items():
+                    if future_prefix in k:
+                        multiplier[column_idx] = future_multiplier
+            elif k in self.TIME_NORMALIZED_FEATURES:
+                divisor[column_idx] = self.time_normalization
+            else:
+                multiplier[column_idx] = self.PAST_SCALE_MULTIPLIER.get(k, 1.)
+                divisor[column_idx] = self.PAST_SCALE_DIVISOR.get(k, 1.)
+        return multiplier, divisor
+
+    def scale_past_batch(self, past_tensor, past_columns):
+        """
+        Scale the past measurements of a batch of observations at once
+        :param past_tensor: [n_samples, lookback, features] unscaled past measurements
+        :param past_columns: names of the features in the last axis of past_tensor
+        :return: [n_samples, lookback, features] scaled past measurements ordered as scaled_past_columns(past_columns)
+        """
+        past_tensor = np.asarray(past_tensor, dtype=float)
+        column_idx = {k: idx for idx, k in enumerate(past_columns)}
+        scaled_columns = self.scaled_past_columns(past_columns)
+        kept_columns = [k for k in scaled_columns if k != 'throughput_mbyte']
+        multiplier, divisor = self.scale_factors(kept_columns)
+        past_scaled = np.empty(past_tensor.shape[:2] + (len(scaled_columns),))
+        kept_scaled_idx = [scaled_columns.index(k) for k in kept_columns]
+        kept_unscaled_idx = [column_idx[k] for k in kept_columns]
+        past_scaled[..., kept_scaled_idx] = past_tensor[..., kept_unscaled_idx] * multiplier / divisor
+
+        # How far are we away from the current measurement
+        timestamp_s = past_tensor[..., column_idx['timestamp_s']]
+        timestamp_relative = timestamp_s[:, -1:] - timestamp_s
+        with np.errstate(divide='ignore', invalid='ignore'):
+            timestamp_relative = timestamp_relative / timestamp_relative[:, :1]
+        past_scaled[..., scaled_columns.index('timestamp_s')] = np.where(
+            timestamp_s.sum(axis=1, keepdims=True) != 0, timestamp_relative, timestamp_s)
+
+        video_chunk_size_byte = past_tensor[..., column_idx['video_chunk_size_byte']]
+        download_time_s = past_tensor[..., column_idx['download_time_s']]
+        past_scaled[..., scaled_columns.index('throughput_mbyte')] = np.where(
+            download_time_s > 0, (video_chunk_size_byte * 1e-6) / np.where(download_time_s > 0, download_time_s, 1.),
+            0.)  # in mbyte
+        return past_scaled
+
+    def scale_future_batch(self, future_tensor, future_columns):
+        """
+        Scale the future chunk information of a batch of observations at once
+        :param future_tensor: [n_samples, lookahead, features]
+        :param future_columns: names of the features in the last axis of future_tensor
+        :return:
+        """
+        multiplier, divisor = self.scale_factors(future_columns)
+        return np.asarray(future_tensor, dtype=float) * multiplier / divisor
+
+    def stack_observations(self, observation_list):
+        """
+        :param observation_list: unscaled observations which all contain the same features
+        :return: [n_samples, lookback, features] past measurements, their sorted names,
+        [n_samples, lookahead, features] future chunk information, their sorted names
+        """
+        past_columns = sorted([k for k in observation_list[0].keys() if
+                               'future' not in k and k != 'streaming_environment'])
+        future_columns = sorted([k for k in observation_list[0].keys() if 'future' in k])
+        past_tensor = np.array([[observation[k] for k in past_columns] for observation in observation_list],
+                               dtype=float).transpose(0, 2, 1)
+        future_tensor = np.array([[observation[k] for k in future_columns] for observation in observation_list],
+                                 dtype=float).transpose(0, 2, 1)
+        return past_tensor, past_columns, future_tensor, future_columns
+
+    def scale_observation_batch(self, observation_list):
+        """
+        Scale a batch of observations into the network input
+        :param observation_list: unscaled observations which all contain the same features
+        :return: [n_samples, lookback, features] scaled past measurements, [n_samples, lookahead, features] scaled
+        future chunk information, both with the features in sorted order as in observation_to_past_arr and
+        observation_to_future_arr of the scaled observations
+        """
+        past_tensor, past_columns, future_tensor, future_columns = self.stack_observations(observation_list)
+        return self.scale_past_batch(past_tensor, past_columns), self.scale_future_batch(future_tensor,
+                                                                                         future_columns)
+
+    def scale_observation(self, state_unscaled):
+        """
+        Scale a single observation with the same kernel as scale_observation_batch
+        :param state_unscaled: observation dictionary
+        :return: scaled observation dictionary, current_level is replaced with throughput_mbyte
+        """
+        past_tensor, past_columns, future_tensor, future_columns = self.stack_observations([state_unscaled])
+        state_scaled_features = dict(zip(self.scaled_past_columns(past_columns),
+                                         self.scale_past_batch(past_tensor, past_columns)[0].T))
+        state_scaled_features.update(zip(future_columns, self.scale_future_batch(future_tensor, future_columns)[0].T))
+        state_scaled = {k: state_scaled_features.get(k, v) for k, v in state_unscaled.items() if k != 'current_level'}
+        state_scaled['throughput_mbyte'] = state_scaled_features['throughput_mbyte']
         return state_scaled
 
-    def add_trajectory(self, other):
+    def is_fully_converted(self):
+        return self.trajectory_action_t_arr is not None and len(self.trajectory_action_t_arr) == len(
+            self.trajectory_list)
 
+    def append_converted(self, other):
+        """
+        Append the converted arrays and class association of other behind the converted samples of self
+        :param other: fully converted trajectory with the same columns
+        :return:
+        """
+        sample_offset = len(self.trajectory_action_t_arr)
+        for array_name in self.TRAJECTORY_ARRAYS:
+            self.write_converted_samples(array_name, sample_offset, getattr(other, array_name))
+            setattr(self, array_name, self.trajectory_buffers[array_name][:sample_offset + len(other.trajectory_list)])
+        for action, sample_indices in other.class_association.items():
+            sample_indices = [sample_idx + sample_offset for sample_idx in sample_indices]
+            if action in self.class_association:
+                self.class_association[action] += sample_indices
+            else:
+                self.class_association[action] = sample_indices
+
+    def add_trajectory(self, other):
+        """
+        Append other to this trajectory. If both are converted the converted arrays of other are appended as they
+        are, otherwise only the new samples are converted
+        :param other:
+        :return:
+        """
+        if self.trajectory_action_t_arr is not None:
+            self.convert_list()
         other_trajectory_sample_association = other.trajectory_sample_association.copy()
         for k in other_trajectory_sample_association.keys():
             other_trajectory_sample_association[k] = [v + len(self.trajectory_list) for v in
@@ -637,76 +1288,153 @@ class Trajectory:
         self.likelihood_list += other.likelihood_list
         self.n_trajectories = len(self.trajectory_list)
         if self.trajectory_action_t_arr is not None:
-            self.trajectory_state_t_arr = None
-            self.trajectory_state_t_future = None  # Contains the future chunk sizes
-            self.trajectory_state_t_1_arr = None
-            self.trajectory_state_t_1_future = None  # Contains the future chunk sizes
-            self.trajectory_action_t_arr = None
-            self.trajectory_likelihood = None
-            self.trajectory_column = None
-            self.class_association = {}
-            self.trajectory_sample_association = {}
-            self.convert_list()
+            if other.is_fully_converted() and other.trajectory_column == self.trajectory_column:
+                self.append_converted(other)
+            else:
+                self.convert_list()
 
-    def extract_trajectory(self, trace_video_pair_list):
+    @staticmethod
+    def merge(trajectory_list):
+        """
+        k-way merge of trajectories, e.g. the per session results of create_trajectories. The sample lists and, if
+        all trajectories are converted, the converted arrays are concatenated once
+        :param trajectory_list:
+        :return: merged trajectory
+        """
+        merged_trajectory = Trajectory()
+        for trajectory in trajectory_list:
+            for trace_video_pair_name, sample_indices in trajectory.trajectory_sample_association.items():
+                merged_trajectory.trajectory_sample_association[trace_video_pair_name] = [
+                    sample_idx + len(merged_trajectory.trajectory_list) for sample_idx in sample_indices]
+            merged_trajectory.trajectory_list += trajectory.trajectory_list
+            merged_trajectory.likelihood_list += trajectory.likelihood_list
+            merged_trajectory.n_trajectories = len(merged_trajectory.trajectory_list)
+            merged_trajectory.n_features_observation = max(merged_trajectory.n_features_observation,
+                                                           trajectory.n_features_observation)
+        if len(trajectory_list) > 0 and all([trajectory.is_fully_converted() and trajectory.trajectory_column ==
+                                             trajectory_list[0].trajectory_column for trajectory in trajectory_list]):
+            merged_trajectory.trajectory_column = list(trajectory_list[0].trajectory_column)
+            for array_name in Trajectory.TRAJECTORY_ARRAYS:
+                merged_trajectory.trajectory_buffers[array_name] = np.concatenate(
+                    [getattr(trajectory, array_name) for trajectory in trajectory_list])
+                setattr(merged_trajectory, array_name, merged_trajectory.trajectory_buffers[array_name])
+            sample_offset = 0
+            for trajectory in trajectory_list:
+                for action, sample_indices in trajectory.class_association.items():
+                    sample_indices = [sample_idx + sample_offset for sample_idx in sample_indices]
+                    if action in merged_trajectory.class_association:
+                        merged_trajectory.class_association[action] += sample_indices
+                    else:
+                        merged_trajectory.class_association[action] = sample_indices
+                sample_offset += len(trajectory.trajectory_list)
+        return merged_trajectory
 
+    def extract_trajectory(self, trace_video_pair_list):
+        """
+        Trajectory of the given trace video pairs. The samples aren't copied, the extracted trajectory refers to the
+        samples of this trajectory by index until it is mutated. If this trajectory is converted, the converted arrays
+        are sliced instead of converted again.
+        :param trace_video_pair_list: trace video pair names or (trace video pair name, expected number of samples)
+        :return:
+        """
         extraced_trajectory = Trajectory()
-        try:
-            for trace_video_pair_name, target_length in trace_video_pair_list:
-                extraced_trajectory.new_trace_video_pair_name(trace_video_pair_name=trace_video_pair_name)
-                indices = self.trajectory_sample_association[trace_video_pair_name]
-                assert len(indices) > 0, "Didn't find any indices for extract trajectory"
-                assert target_length == len(indices), 'We didnt find all samples %d != %d %s' % (
+        sample_indices = []
+        for trace_video_pair in trace_video_pair_list:
+            if isinstance(trace_video_pair, (tuple, list)):
+                trace_video_pair_name, target_length = trace_video_pair
+            else:
+                trace_video_pair_name, target_length = trace_video_pair, None
+            indices = self.trajectory_sample_association[trace_video_pair_name]
+            assert len(indices) > 0, "Didn't find any indices for extract trajectory"
+            assert target_length is None or target_length == len(indices), 'We didnt find all samples %d != %d %s' % (
                 target_length, len(indices), trace_video_pair_name)
-                for i in indices:
-                    observation, observation_new, current_quality = self.trajectory_list[i]
-                    likelihood, is_random = self.likelihood_list[i]
-                    extraced_trajectory.add_trajectory_triple(observation, observation_new, current_quality)
-                    extraced_trajectory.add_likelihood(likelihood, is_random)
-        except:
-            for trace_video_pair_name in trace_video_pair_list:
-                extraced_trajectory.new_trace_video_pair_name(trace_video_pair_name=trace_video_pair_name)
-                indices = self.trajectory_sample_association[trace_video_pair_name]
-                assert len(indices) > 0, "Didn't find any indices for extract trajectory"
-                # assert target_length == len(indices),'We didnt find all samples %d != %d %s' % (target_length,len(indices),trace_video_pair_name)
-                for i in indices:
-                    observation, observation_new, current_quality = self.trajectory_list[i]
-                    likelihood, is_random = self.likelihood_list[i]
-                    extraced_trajectory.add_trajectory_triple(observation, observation_new, current_quality)
-                    extraced_trajectory.add_likelihood(likelihood, is_random)
+            extraced_trajectory.new_trace_video_pair_name(trace_video_pair_name=trace_video_pair_name)
+            extracted_indices = list(range(len(sample_indices), len(sample_indices) + len(indices)))
+            if trace_video_pair_name in extraced_trajectory.trajectory_sample_association:
+                extraced_trajectory.trajectory_sample_association[trace_video_pair_name] += extracted_indices
+            else:
+                extraced_trajectory.trajectory_sample_association[trace_video_pair_name] = extracted_indices
+            sample_indices += indices
+        sample_indices = np.array(sample_indices, dtype=int)
+        extraced_trajectory.trajectory_list = LazySampleList(self.trajectory_list.__getitem__, sample_indices)
+        extraced_trajectory.likelihood_list = LazySampleList(self.likelihood_list.__getitem__, sample_indices)
+        extraced_trajectory.n_trajectories = len(sample_indices)
+        if len(sample_indices) > 0:
+            observation, _, _ = self.trajectory_list[sample_indices[-1]]
+            extraced_trajectory.n_features_observation = sum([len(v) for k, v in sorted(observation.items())])
+        if len(sample_indices) > 0 and self.is_fully_converted():
+            extraced_trajectory.set_converted({array_name: getattr(self, array_name) for array_name in
+                                               self.TRAJECTORY_ARRAYS}, sample_indices, self.trajectory_column)
         return extraced_trajectory
 
+    def set_converted(self, converted_arrays, sample_indices, trajectory_column):
+        """
+        Take the samples sample_indices of already converted arrays, contiguous samples are sliced without a copy.
+        The class association is derived from the actions
+        :param converted_arrays: dictionary with an array for every name in TRAJECTORY_ARRAYS
+        :param sample_indices:
+        :param trajectory_column:
+        :return:
+        """
+        is_contiguous = np.all(np.diff(sample_indices) == 1)
+        for array_name in self.TRAJECTORY_ARRAYS:
+            if is_contiguous:
+                converted_array = converted_arrays[array_name][sample_indices[0]:sample_indices[-1] + 1]
+            else:
+                converted_array = converted_arrays[array_name][sample_indices]
+            setattr(self, array_name, converted_array)
+            self.trajectory_buffers[array_name] = converted_array
+        self.trajectory_column = list(trajectory_column)
+        actions = self.trajectory_action_t_arr.ravel()
+        self.class_association = {}
+        _, first_occurence = np.unique(actions, return_index=True)
+        for action in actions[np.sort(first_occurence)]:
+            self.class_association[action.item()] = np.flatnonzero(actions == action).tolist()
+
     def add_likelihood(self, likelihood, is_random):
         self.likelihood_list.append((likelihood, is_random))
 
-    def add_observation_to_past_arr(self, arr, trajectory):
+    def observation_to_past_arr(self, trajectory):
         trajectory = [v for k, v in sorted(
             trajectory.items()) if
                       'future' not in k]  # Needs to be sorted otherwise we don't know whether they are in the same order
-        trajectory = np.array(trajectory).T
-        trajectory = np.expand_dims(trajectory, axis=0)
-        if arr is None:
-            arr = trajectory
-        else:
-            arr = np.vstack([arr, trajectory])
-        return arr
+        return np.array(trajectory).T
 
-    def add_observation_to_future_arr(self, arr, trajectory):
+    def observation_to_future_arr(self, trajectory):
         trajectory = [v for k, v in sorted(
             trajectory.items()) if
                       'future' in k]  # Needs to be sorted otherwise we don't know whether they are in the same order
-        trajectory = np.array(trajectory).T
-        trajectory = np.expand_dims(trajectory, axis=0)
-        if arr is None:
-            arr = trajectory
+        return np.array(trajectory).T
+
+    def write_converted_samples(self, array_name, sample_idx, samples):
+        """
+        Write converted samples into the buffer behind array_name starting at sample_idx. The buffers are sized for
+        the current trajectory_list and grow by doubling if more samples are converted later on. The dtype is
+        promoted like np.vstack would
+        :param array_name: one of TRAJECTORY_ARRAYS
+        :param sample_idx:
+        :param samples: [n_samples, ...]
+        :return:
+        """
+        samples = np.asarray(samples)
+        sample_end = sample_idx + len(samples)
+        buffer = self.trajectory_buffers.get(array_name)
+        if buffer is None:
+            buffer = np.zeros((max(len(self.trajectory_list), sample_end),) + samples.shape[1:], dtype=samples.dtype)
         else:
-            arr = np.vstack([arr, trajectory])
-        return arr
+            if not np.can_cast(samples.dtype, buffer.dtype):
+                buffer = buffer.astype(np.result_type(buffer.dtype, samples.dtype))
+            if sample_end > len(buffer):
+                n_grow = max(len(self.trajectory_list), 2 * len(buffer), sample_end) - len(buffer)
+                buffer = np.concatenate([buffer, np.zeros((n_grow,) + buffer.shape[1:], dtype=buffer.dtype)])
+        buffer[sample_idx:sample_end] = samples
+        self.trajectory_buffers[array_name] = buffer
 
     def convert_list(self):
         if self.trajectory_column is None:
             self.trajectory_column = [k for k, v in sorted(
                 self.trajectory_list[0][0].items())]  # Sorted columns contained in the trajectory_arr
+            self.trajectory_buffers = {}
             n_samples_already_converted = 0
         else:
             n_samples_already_converted = len(
@@ -717,31 +1445,30 @@ class Trajectory:
             state_t = [k for k, v in sorted(state_t.items())]
             assert len(self.trajectory_column) == len(state_t), 'We have more features than we had in the beginning'
 
-        for trajectory_index, trajectory in enumerate(self.trajectory_list[n_samples_already_converted:]):
-            state_t, state_t_1, action = trajectory
-            state_t = self.scale_observation(state_t)
-            state_t_1 = self.scale_observation(
-                state_t_1)  # We need to do some scaling otherwise the GRU has problems to really learn from this
-            self.trajectory_state_t_arr = self.add_observation_to_past_arr(self.trajectory_state_t_arr, state_t)
-            self.trajectory_state_t_1_arr = self.add_observation_to_past_arr(self.trajectory_state_t_1_arr, state_t_1)
-            self.trajectory_state_t_future = self.add_observation_to_future_arr(self.trajectory_state_t_future, state_t)
-            self.trajectory_state_t_1_future = self.add_observation_to_future_arr(self.trajectory_state_t_1_future,
-                                                                                  state_t_1)
-            if self.trajectory_action_t_arr is None:
-                self.trajectory_action_t_arr = np.array([action])  # Start an array
-            else:
-                self.trajectory_action_t_arr = np.vstack([self.trajectory_action_t_arr, action])
-            likelihood_dist, _ = self.likelihood_list[trajectory_index]
-            if self.trajectory_likelihood is None:
-                self.trajectory_likelihood = likelihood_dist  # Start an array
-            else:
-                self.trajectory_likelihood = np.vstack([self.trajectory_likelihood, likelihood_dist])
-
-            sample_idx = trajectory_index + n_samples_already_converted
-            if action in self.class_association:
-                self.class_association[action].append(sample_idx)
-            else:
-                self.class_association[action] = [sample_idx]
+        for block_start in range(n_samples_already_converted, len(self.trajectory_list), self.CONVERT_BLOCK_SIZE):
+            trajectory_block = self.trajectory_list[block_start:block_start + self.CONVERT_BLOCK_SIZE]
+            # We need to do some scaling otherwise the GRU has problems to really learn from this
+            state_t_arr, state_t_future = self.scale_observation_batch([state_t for state_t, _, _ in trajectory_block])
+            state_t_1_arr, state_t_1_future = self.scale_observation_batch(
+                [state_t_1 for _, state_t_1, _ in trajectory_block])
+            likelihood_block = self.likelihood_list[block_start:block_start + len(trajectory_block)]
+            self.write_converted_samples('trajectory_state_t_arr', block_start, state_t_arr)
+            self.write_converted_samples('trajectory_state_t_1_arr', block_start, state_t_1_arr)
+            self.write_converted_samples('trajectory_state_t_future', block_start, state_t_future)
+            self.write_converted_samples('trajectory_state_t_1_future', block_start, state_t_1_future)
+            self.write_converted_samples('trajectory_action_t_arr', block_start,
+                                         [[action] for _, _, action in trajectory_block])
+            self.write_converted_samples('trajectory_likelihood', block_start,
+                                         [np.ravel(likelihood_dist) for likelihood_dist, _ in likelihood_block])
+
+            for trajectory_index, (_, _, action) in enumerate(trajectory_block):
+                sample_idx = trajectory_index + block_start
+                if action in self.class_association:
+                    self.class_association[action].append(sample_idx)
+                else:
+                    self.class_association[action] = [sample_idx]
+        for array_name in self.TRAJECTORY_ARRAYS:
+            setattr(self, array_name, self.trajectory_buffers[array_name][:len(self.trajectory_list)])
 
     def add_trajectory_triple(self, observation, observation_new, current_quality):
         self.trajectory_list.append((observation, observation_new, current_quality))
@@ -765,11 +1492,7 @@ class Trajectory:
     def sample_equal_weight(self, size):
         if self.trajectory_state_t_arr is None or len(self.trajectory_list) > len(self.trajectory_state_t_arr):
             self.convert_list()
-        indices_per_class = size // len(self.class_association)
-        indices = []
-        for k, v in self.class_association.items():
-            indices += list(np.random.choice(v, size=indices_per_class))
-        return self.return_from_indices(indices)
+        return self.return_from_indices(StratifiedSampler(self.class_association).sample(size))
 
     def sample(self, size):
         if self.trajectory_state_t_arr is None or len(self.trajectory_list) > len(self.trajectory_state_t_arr):
@@ -837,8 +1560,8 @@ class TrajectoryVideoStreaming:
             algo = self.abr_algorithm
         algo.reset()
         trajectory_obj = Trajectory()
-        video_id = video_information_path.split('/')[-1].replace('_video_info', '')
-        trace_video_pair_name = 'video_' + video_id + '_file_id_' + bw_trace_path.split('/')[-1]
+        video_id = file_name(video_information_path).replace('_video_info', '')
+        trace_video_pair_name = 'video_' + video_id + '_file_id_' + file_name(bw_trace_path)
         stream_env.set_new_enviroment(bw_trace_path, video_information_path)
         trajectory_obj.new_trace_video_pair_name(trace_video_pair_name)
         previous_quality = 0
@@ -903,7 +1626,6 @@ class TrajectoryVideoStreaming:
         :return:
         """
 
-        trajectory_obj = Trajectory()
         logging_list = []
         trajectory_zip = list(zip(self.trace_list, self.video_csv_list))  # We want to have an expected runtime
         if tqdm_activated:
@@ -920,5 +1642,5 @@ class TrajectoryVideoStreaming:
                                                    bw_trace_path, video_information_path in trajectory_zip)
         for sse, tr in results:
             logging_list += sse
-            trajectory_obj.add_trajectory(tr)
+        trajectory_obj = Trajectory.merge([tr for sse, tr in results])
         return np.array(logging_list).flatten(), trajectory_obj
@@ -0,0 +1,211 @@
+"""
+On disk store of trajectories.
+Every array of a trajectory is written as its own .npy file which is memory mapped on loading, so that single
+(trace, video) pairs can be sliced out without unpickling the whole trajectory.
+
+Store layout:
+    index.json | observation_past.npy | observation_future.npy | observation_new_past.npy |
+    observation_new_future.npy | action.npy | is_random.npy | one .npy file per Trajectory.TRAJECTORY_ARRAYS
+The samples are ordered by session, every session is a contiguous range of samples in the index.
+The index carries the store version, the observation columns and the scaling rules which were used for the converted
+arrays. If the scaling rules have changed since, the converted arrays are rebuilt from the stored observations.
+"""
+import json
+import os
+
+import numpy as np
+
+from SimulationEnviroment.SimulatorEnviroment import LazySampleList, Trajectory
+
+TRAJECTORY_STORE_VERSION = 1
+TRAJECTORY_STORE_INDEX = 'index.json'
+OBSERVATION_ARRAYS = ['observation_past', 'observation_future', 'observation_new_past', 'observation_new_future']
+STORE_BLOCK_SIZE = 4096  # Number of samples which are written at once
+
+opened_stores = {}
+
+
+def json_normalize(value):
+    return json.loads(json.dumps(value))
+
+
+def save_trajectory_store(store_path, trajectory):
+    """
+    Write the trajectory into a trajectory store
+    :param store_path: folder of the store, is created if it doesn't exist
+    :param trajectory:
+    :return: TrajectoryStore opened on the new store
+    """
+    if len(trajectory.trajectory_list) == 0:
+        raise ValueError('Trajectory is empty, nothing to store')
+    trajectory.convert_list()
+    sample_order = []
+    sessions = []
+    for trace_video_pair_name, sample_indices in trajectory.trajectory_sample_association.items():
+        sessions.append([trace_video_pair_name, len(sample_order), len(sample_order) + len(sample_indices)])
+        sample_order += sample_indices
+    sample_order = np.array(sample_order, dtype=int)
+    if len(sample_order) != len(trajectory.trajectory_list) or len(np.unique(sample_order)) != len(sample_order):
+        raise ValueError('Every sample has to belong to exactly one trace video pair')
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
+    elif os.path.exists(os.path.join(store_path, TRAJECTORY_STORE_INDEX)):
+        os.remove(os.path.join(store_path, TRAJECTORY_STORE_INDEX))
+
+    observation_t, _, _ = trajectory.trajectory_list[0]
+    past_tensor, past_columns, future_tensor, future_columns = trajectory.stack_observations([observation_t])
+    index = {'version': TRAJECTORY_STORE_VERSION,
+             'n_samples': len(sample_order),
+             'sessions': sessions,
+             'trajectory_column': list(trajectory.trajectory_column),
+             'past_columns': past_columns,
+             'past_dtypes': [np.asarray(observation_t[k]).dtype.str for k in past_columns],
+             'future_columns': future_columns,
+             'future_dtypes': [np.asarray(observation_t[k]).dtype.str for k in future_columns],
+             'scaling_rules': trajectory.scaling_rules()}
+
+    def open_store_array(array_name, shape, dtype):
+        return np.lib.format.open_memmap(os.path.join(store_path, array_name + '.npy'), mode='w+', dtype=dtype,
+                                         shape=(len(sample_order),) + tuple(shape))
+
+    store_arrays = {'observation_past': open_store_array('observation_past', past_tensor.shape[1:], float),
+                    'observation_future': open_store_array('observation_future', future_tensor.shape[1:], float),
+                    'observation_new_past': open_store_array('observation_new_past', past_tensor.shape[1:], float),
+                    'observation_new_future': open_store_array('observation_new_future', future_tensor.shape[1:],
+                                                               float),
+                    'is_random': open_store_array('is_random', (), bool)}
+    for array_name in Trajectory.TRAJECTORY_ARRAYS:
+        converted_array = getattr(trajectory, array_name)
+        store_arrays[array_name] = open_store_array(array_name, converted_array.shape[1:], converted_array.dtype)
+    store_arrays['action'] = open_store_array('action', (), trajectory.trajectory_action_t_arr.dtype)
+
+    for block_start in range(0, len(sample_order), STORE_BLOCK_SIZE):
+        block_order = sample_order[block_start:block_start + STORE_BLOCK_SIZE]
+        block_end = block_start + len(block_order)
+        trajectory_block = [trajectory.trajectory_list[sample_idx] for sample_idx in block_order]
+        for (past_name, future_name), state_idx in zip([('observation_past', 'observation_future'),
+                                                        ('observation_new_past', 'observation_new_future')], [0, 1]):
+            past_tensor, _, future_tensor, _ = trajectory.stack_observations(
+                [sample[state_idx] for sample in trajectory_block])
+            store_arrays[past_name][block_start:block_end] = past_tensor
+            store_arrays[future_name][block_start:block_end] = future_tensor
+        store_arrays['is_random'][block_start:block_end] = [trajectory.likelihood_list[sample_idx][1] for
+                                                            sample_idx in block_order]
+        for array_name in Trajectory.TRAJECTORY_ARRAYS:
+            store_arrays[array_name][block_start:block_end] = getattr(trajectory, array_name)[block_order]
+        store_arrays['action'][block_start:block_end] = trajectory.trajectory_action_t_arr[block_order].ravel()
+    for store_array in store_arrays.values():
+        store_array.flush()
+    del store_arrays
+
+    # The index is written last, a store without index wasn't written completely
+    with open(os.path.join(store_path, TRAJECTORY_STORE_INDEX), 'w') as index_file:
+        json.dump(index, index_file)
+    return open_trajectory_store(store_path)
+
+
+def open_trajectory_store(store_path, obs_names=None):
+    """
+    Memory map the store once per process
+    :param store_path:
+    :param obs_names: if given, the store has to contain exactly these observations (see get_obs_names)
+    :return:
+    """
+    index_path = os.path.join(store_path, TRAJECTORY_STORE_INDEX)
+    store_key = (os.path.abspath(store_path), os.path.getmtime(index_path))
+    if store_key not in opened_stores:
+        opened_stores[store_key] = TrajectoryStore(store_path)
+    trajectory_store = opened_stores[store_key]
+    if obs_names is not None:
+        obs_names = sorted([k for k in obs_names if k != 'streaming_environment'])
+        if obs_names != trajectory_store.index['trajectory_column']:
+            raise ValueError('%s contains the observations %s, expected %s' % (
+                store_path, trajectory_store.index['trajectory_column'], obs_names))
+    return trajectory_store
+
+
+class TrajectoryStore:
+    def __init__(self, store_path):
+        """
+        Read only view on a store written by save_trajectory_store
+        :param store_path:
+        """
+        self.store_path = store_path
+        with open(os.path.join(store_path, TRAJECTORY_STORE_INDEX), 'r') as index_file:
+            self.index = json.load(index_file)
+        if self.index['version'] != TRAJECTORY_STORE_VERSION:
+            raise ValueError('%s has trajectory store version %d, expected %d' % (store_path, self.index['version'],
+                                                                                  TRAJECTORY_STORE_VERSION))
+        self.store_arrays = {}
+        for array_name in OBSERVATION_ARRAYS + Trajectory.TRAJECTORY_ARRAYS + ['action', 'is_random']:
+            self.store_arrays[array_name] = np.load(os.path.join(store_path, array_name + '.npy'), mmap_mode='r')
+        self.sessions = {trace_video_pair_name: (session_start, session_end) for
+                         trace_video_pair_name, session_start, session_end in self.index['sessions']}
+
+    def session_names(self):
+        return list(self.sessions.keys())
+
+    def __len__(self):
+        return self.index['n_samples']
+
+    def has_current_scaling(self):
+        """
+        :return: whether the converted arrays were scaled with the current scaling rules of Trajectory
+        """
+        return json_normalize(Trajectory().scaling_rules()) == self.index['scaling_rules']
+
+    def get_observation(self, past_name, future_name, sample_idx):
+        observation = {}
+        for column_idx, (k, dtype) in enumerate(zip(self.index['past_columns'], self.index['past_dtypes'])):
+            observation[k] = self.store_arrays[past_name][sample_idx, :, column_idx].astype(dtype, copy=False)
+        for column_idx, (k, dtype) in enumerate(zip(self.index['future_columns'], self.index['future_dtypes'])):
+            observation[k] = self.store_arrays[future_name][sample_idx, :, column_idx].astype(dtype, copy=False)
+        return observation
+
+    def get_sample(self, sample_idx):
+        """
+        :param sample_idx:
+        :return: (observation, observation_new, action) as in Trajectory.trajectory_list
+        """
+        return (self.get_observation('observation_past', 'observation_future', sample_idx),
+                self.get_observation('observation_new_past', 'observation_new_future', sample_idx),
+                self.store_arrays['action'][sample_idx].item())
+
+    def get_likelihood(self, sample_idx):
+        """
+        :param sample_idx:
+        :return: (likelihood, is_random) as in Trajectory.likelihood_list
+        """
+        return self.store_arrays['trajectory_likelihood'][sample_idx], bool(self.store_arrays['is_random'][sample_idx])
+
+    def load_trajectory(self, trace_video_pair_names=None):
+        """
+        Trajectory of the given sessions. The samples are created lazily and the converted arrays are slices of the
+        mapped files if the sessions are stored next to each other.
+        :param trace_video_pair_names: defaults to all sessions in the store
+        :return:
+        """
+        if trace_video_pair_names is None:
+            trace_video_pair_names = self.session_names()
+        trajectory = Trajectory()
+        sample_indices = [np.zeros(0, dtype=int)]
+        n_samples = 0
+        for trace_video_pair_name in trace_video_pair_names:
+            session_start, session_end = self.sessions[trace_video_pair_name]
+            trajectory.trajectory_sample_association[trace_video_pair_name] = list(
+                range(n_samples, n_samples + session_end - session_start))
+            trajectory.new_trace_video_pair_name(trace_video_pair_name)
+            sample_indices.append(np.arange(session_start, session_end))
+            n_samples += session_end - session_start
+        sample_indices = np.concatenate(sample_indices)
+        trajectory.trajectory_list = LazySampleList(self.get_sample, sample_indices)
+        trajectory.likelihood_list = LazySampleList(self.get_likelihood, sample_indices)
+        trajectory.n_trajectories = len(sample_indices)
+        trajectory.n_features_observation = len(self.index['past_columns']) * self.store_arrays[
+            'observation_past'].shape[1] + len(self.index['future_columns']) * self.store_arrays[
+                                                'observation_future'].shape[1]
+        if len(sample_indices) == 0 or not self.has_current_scaling():
+            return trajectory  # Converted on first use
+
+        trajectory.set_converted(self.store_arrays, sample_indices, self.index['trajectory_column'])
+        return trajectory
@@ -0,0 +1,249 @@
+"""
+Parity of the chunk kernel with the sample by sample download loop of the original OfflineStreaming.get_video_chunk.
+The compiled functions and their python versions (.py_func, the functions themselves if numba isn't installed) are
+checked on synthetic traces with zero bandwidth samples, trace wrap-around and drain sleeps.
+"""
+import unittest
+
+import numpy as np
+
+from SimulationEnviroment import ChunkKernel
+
+MILLISECONDS_IN_SECOND = 1000.0
+B_IN_MB = 1000000.0
+BITS_IN_BYTE = 8.0
+PACKET_PAYLOAD_PORTION = 0.95
+LINK_RTT_MS = 200.
+DRAIN_BUFFER_SLEEP_MS = 500.
+
+
+def python_function(function):
+    return getattr(function, 'py_func', function)
+
+
+def reference_download(cooked_time, cooked_bw, mahimahi_ptr, last_mahimahi_time, video_chunk_size):
+    """
+    Download loop of https://github.com/hongzimao/pensieve as it was used by OfflineStreaming.get_video_chunk
+    :return: same values as ChunkKernel.download_trace
+    """
+    downloadtime_s = 0.0
+    video_chunk_counter_sent = 0
+    while True:
+        throughput = cooked_bw[mahimahi_ptr] * B_IN_MB / BITS_IN_BYTE
+        duration = cooked_time[mahimahi_ptr] - last_mahimahi_time
+        packet_payload = throughput * duration * PACKET_PAYLOAD_PORTION
+        if video_chunk_counter_sent + packet_payload > video_chunk_size:
+            fractional_time = (video_chunk_size - video_chunk_counter_sent) / throughput / PACKET_PAYLOAD_PORTION
+            downloadtime_s += fractional_time
+            last_mahimahi_time += fractional_time
+            break
+        video_chunk_counter_sent += packet_payload
+        downloadtime_s += duration
+        last_mahimahi_time = cooked_time[mahimahi_ptr]
+        mahimahi_ptr += 1
+        if mahimahi_ptr >= len(cooked_bw):
+            mahimahi_ptr = 1
+            last_mahimahi_time = 0
+    return downloadtime_s, mahimahi_ptr, last_mahimahi_time
+
+
+def reference_sleep(cooked_time, mahimahi_ptr, last_mahimahi_time, sleep_time_ms):
+    """
+    Drain sleep loop of the original OfflineStreaming.get_video_chunk
+    :return: same values as ChunkKernel.sleep_trace
+    """
+    while True:
+        duration = cooked_time[mahimahi_ptr] - last_mahimahi_time
+        if duration > sleep_time_ms / MILLISECONDS_IN_SECOND:
+            last_mahimahi_time += sleep_time_ms / MILLISECONDS_IN_SECOND
+            break
+        sleep_time_ms -= duration * MILLISECONDS_IN_SECOND
+        last_mahimahi_time = cooked_time[mahimahi_ptr]
+        mahimahi_ptr += 1
+        if mahimahi_ptr >= len(cooked_time):
+            mahimahi_ptr = 1
+            last_mahimahi_time = 0
+    return sleep_time_ms, mahimahi_ptr, last_mahimahi_time
+
+
+def reference_chunk_dynamics(cooked_time, cooked_bw, mahimahi_ptr, last_mahimahi_time, buffer_size_ms,
+                             video_chunk_size, segment_length_ms, buffer_threshold_ms):
+    """
+    :return: same values as ChunkKernel.chunk_dynamics
+    """
+    downloadtime_s, mahimahi_ptr, last_mahimahi_time = reference_download(cooked_time, cooked_bw, mahimahi_ptr,
+                                                                          last_mahimahi_time, video_chunk_size)
+    downloadtime_ms = downloadtime_s * MILLISECONDS_IN_SECOND + LINK_RTT_MS
+    rebuffer_time_ms = max(downloadtime_ms - buffer_size_ms, 0.0)
+    buffer_size_ms = max(buffer_size_ms - downloadtime_ms, 0.0)
+    buffer_size_ms += segment_length_ms
+    sleep_time_ms = 0.0
+    if buffer_size_ms > buffer_threshold_ms:
+        drain_buffer_time = buffer_size_ms - buffer_threshold_ms
+        sleep_time_ms = np.ceil(drain_buffer_time / DRAIN_BUFFER_SLEEP_MS) * DRAIN_BUFFER_SLEEP_MS
+        buffer_size_ms -= sleep_time_ms
+        sleep_time_ms, mahimahi_ptr, last_mahimahi_time = reference_sleep(cooked_time, mahimahi_ptr,
+                                                                          last_mahimahi_time, sleep_time_ms)
+    return downloadtime_ms, rebuffer_time_ms, sleep_time_ms, buffer_size_ms, mahimahi_ptr, last_mahimahi_time
+
+
+def synthetic_trace(rng, n_sample, zero_fraction):
+    """
+    :return: cooked_time, cooked_bw, cumulative_time, cumulative_byte as built by
+    StreamingEnviroment.build_cumulative_trace
+    """
+    cooked_time = np.concatenate([[0.], np.cumsum(rng.uniform(0.2, 2., n_sample - 1))])
+    cooked_bw = rng.lognormal(0., 1., n_sample)
+    cooked_bw[rng.random(n_sample) < zero_fraction] = 0.
+    cooked_bw[1] = max(cooked_bw[1], 0.5)  # Every trace can download something
+    cumulative_time = cooked_time.copy()
+    cumulative_time[0] = 0
+    sample_byte = cooked_bw * B_IN_MB / BITS_IN_BYTE * np.diff(cumulative_time, prepend=0.)
+    sample_byte[0] = 0
+    return cooked_time, cooked_bw, cumulative_time, np.cumsum(sample_byte)
+
+
+class ChunkKernelParityTest(unittest.TestCase):
+    """
+    Every case is (n_sample, zero_fraction, chunk size range in bytes, buffer_threshold_ms). Short traces with large
+    chunks wrap around several times per chunk, small thresholds sleep after almost every chunk
+    """
+    TRACE_CASES = [(200, 0., (1e4, 2e6), 60000.),
+                   (50, 0.3, (1e4, 2e6), 60000.),
+                   (6, 0.2, (5e5, 8e6), 60000.),
+                   (30, 0.2, (1e3, 1e5), 4000.),
+                   (5, 0., (1e3, 5e4), 4000.)]
+    N_CHUNK = 60
+    SEGMENT_LENGTH_MS = 4000.
+
+    def session_cases(self):
+        rng = np.random.default_rng(42)
+        for n_sample, zero_fraction, chunk_size_range, buffer_threshold_ms in self.TRACE_CASES:
+            trace = synthetic_trace(rng, n_sample, zero_fraction)
+            video_chunk_size = rng.uniform(*chunk_size_range, size=self.N_CHUNK)
+            yield trace, video_chunk_size, buffer_threshold_ms
+
+    def reference_session(self, trace, video_chunk_size, buffer_threshold_ms):
+        cooked_time, cooked_bw, _, _ = trace
+        mahimahi_ptr, last_mahimahi_time, buffer_size_ms = 1, cooked_time[0], 0.
+        chunk_results = []
+        for chunk_size in video_chunk_size:
+            chunk_result = reference_chunk_dynamics(cooked_time, cooked_bw, mahimahi_ptr, last_mahimahi_time,
+                                                    buffer_size_ms, chunk_size, self.SEGMENT_LENGTH_MS,
+                                                    buffer_threshold_ms)
+            _, _, _, buffer_size_ms, mahimahi_ptr, last_mahimahi_time = chunk_result
+            chunk_results.append(chunk_result)
+        return chunk_results
+
+    def assert_chunk_equal(self, reference_result, kernel_result):
+        np.testing.assert_allclose(np.delete(kernel_result, 4), np.delete(reference_result, 4), rtol=1e-9,
+                                   atol=1e-6)
+        self.assertEqual(int(kernel_result[4]), reference_result[4])
+
+    def check_chunk_dynamics(self, chunk_dynamics):
+        for trace, video_chunk_size, buffer_threshold_ms in self.session_cases():
+            mahimahi_ptr, last_mahimahi_time, buffer_size_ms = 1, trace[0][0], 0.
+            for chunk_size, reference_result in zip(video_chunk_size,
+                                                    self.reference_session(trace, video_chunk_size,
+                                                                           buffer_threshold_ms)):
+                kernel_result = chunk_dynamics(*trace, mahimahi_ptr, last_mahimahi_time, buffer_size_ms, chunk_size,
+                                               self.SEGMENT_LENGTH_MS, PACKET_PAYLOAD_PORTION, LINK_RTT_MS,
+                                               buffer_threshold_ms, DRAIN_BUFFER_SLEEP_MS)
+                self.assert_chunk_equal(reference_result, kernel_result)
+                # Continue from the reference state, so that differences don't add up over the session
+                _, _, _, buffer_size_ms, mahimahi_ptr, last_mahimahi_time = reference_result
+
+    def check_session_dynamics(self, session_dynamics):
+        for trace, video_chunk_size, buffer_threshold_ms in self.session_cases():
+            reference_results = self.reference_session(trace, video_chunk_size, buffer_threshold_ms)
+            (downloadtime_ms, rebuffer_time_ms, sleep_time_ms, buffer_size_ms, mahimahi_ptr,
+             last_mahimahi_time) = session_dynamics(*trace, 1, trace[0][0], 0., video_chunk_size,
+                                                    np.full(self.N_CHUNK, self.SEGMENT_LENGTH_MS),
+                                                    PACKET_PAYLOAD_PORTION, LINK_RTT_MS, buffer_threshold_ms,
+                                                    DRAIN_BUFFER_SLEEP_MS)
+            reference_arr = np.array([reference_result[:4] for reference_result in reference_results])
+            np.testing.assert_allclose(np.column_stack([downloadtime_ms, rebuffer_time_ms, sleep_time_ms,
+                                                        buffer_size_ms]), reference_arr, rtol=1e-9, atol=1e-6)
+            self.assertEqual(int(mahimahi_ptr), reference_results[-1][4])
+            self.assertAlmostEqual(last_mahimahi_time, reference_results[-1][5], places=6)
+
+    def test_cases_cover_edge_cases(self):
+        wrapped = slept = crossed_zero = False
+        for trace, video_chunk_size, buffer_threshold_ms in self.session_cases():
+            cooked_time, cooked_bw, _, _ = trace
+            previous_ptr = 1
+            for downloadtime_ms, _, sleep_time_ms, _, mahimahi_ptr, _ in self.reference_session(
+                    trace, video_chunk_size, buffer_threshold_ms):
+                wrapped = wrapped or mahimahi_ptr < previous_ptr
+                slept = slept or sleep_time_ms > 0
+                crossed_zero = crossed_zero or (cooked_bw[previous_ptr:mahimahi_ptr] == 0).any()
+                previous_ptr = mahimahi_ptr
+        self.assertTrue(wrapped and slept and crossed_zero)
+
+    def test_chunk_dynamics(self):
+        self.check_chunk_dynamics(ChunkKernel.chunk_dynamics)
+
+    def test_chunk_dynamics_python(self):
+        self.check_chunk_dynamics(python_function(ChunkKernel.chunk_dynamics))
+
+    def test_session_dynamics(self):
+        self.check_session_dynamics(ChunkKernel.session_dynamics)
+
+    def test_session_dynamics_python(self):
+        self.check_session_dynamics(python_function(ChunkKernel.session_dynamics))
+
+    def test_trace_functions_python(self):
+        download_trace = python_function(ChunkKernel.download_trace)
+        sleep_trace = python_function(ChunkKernel.sleep_trace)
+        for trace, video_chunk_size, _ in self.session_cases():
+            cooked_time, cooked_bw, cumulative_time, cumulative_byte = trace
+            mahimahi_ptr, last_mahimahi_time = 1, cooked_time[0]
+            for chunk_size in video_chunk_size:
+                reference_result = reference_download(cooked_time, cooked_bw, mahimahi_ptr, last_mahimahi_time,
+                                                      chunk_size)
+                kernel_result = download_trace(cooked_time, cooked_bw, cumulative_time, cumulative_byte,
+                                               mahimahi_ptr, last_mahimahi_time, chunk_size, PACKET_PAYLOAD_PORTION)
+                np.testing.assert_allclose(kernel_result, reference_result, rtol=1e-9, atol=1e-9)
+                self.assertEqual(int(kernel_result[1]), reference_result[1])
+                _, mahimahi_ptr, last_mahimahi_time = reference_result
+                # Long enough to wrap around the short traces
+                sleep_time_ms = DRAIN_BUFFER_SLEEP_MS * (1 + int(chunk_size) % 40)
+                reference_result = reference_sleep(cooked_time, mahimahi_ptr, last_mahimahi_time, sleep_time_ms)
+                kernel_result = sleep_trace(cooked_time, cumulative_time, mahimahi_ptr, last_mahimahi_time,
+                                            sleep_time_ms)
+                np.testing.assert_allclose(kernel_result, reference_result, rtol=1e-9, atol=1e-6)
+                self.assertEqual(int(kernel_result[1]), reference_result[1])
+                _, mahimahi_ptr, last_mahimahi_time = reference_result
+
+    def test_batch_chunk_dynamics(self):
+        """
+        All sessions advance in lockstep, every session on its own trace of the padded trace table
+        """
+        session_cases = list(self.session_cases())
+        reference_sessions = [self.reference_session(*session_case) for session_case in session_cases]
+        trace_len = np.array([len(trace[0]) for trace, _, _ in session_cases], dtype=np.int64)
+        trace_table = np.zeros((4, len(session_cases), trace_len.max()))
+        for trace_idx, (trace, _, _) in enumerate(session_cases):
+            trace_table[:, trace_idx, :trace_len[trace_idx]] = trace
+        trace_idx = np.arange(len(session_cases), dtype=np.int64)
+        buffer_threshold_ms = np.array([buffer_threshold_ms for _, _, buffer_threshold_ms in session_cases])
+        for buffer_threshold_value in np.unique(buffer_threshold_ms):
+            # The threshold is shared by all states of a call
+            session_idx = trace_idx[buffer_threshold_ms == buffer_threshold_value]
+            mahimahi_ptr = np.ones(len(session_idx), dtype=np.int64)
+            last_mahimahi_time = trace_table[0, session_idx, 0]
+            buffer_size_ms = np.zeros(len(session_idx))
+            for chunk_idx in range(self.N_CHUNK):
+                kernel_result = ChunkKernel.batch_chunk_dynamics(
+                    *trace_table, trace_len, session_idx, mahimahi_ptr, last_mahimahi_time, buffer_size_ms,
+                    np.array([session_cases[session][1][chunk_idx] for session in session_idx]),
+                    np.full(len(session_idx), self.SEGMENT_LENGTH_MS), PACKET_PAYLOAD_PORTION, LINK_RTT_MS,
+                    buffer_threshold_value, DRAIN_BUFFER_SLEEP_MS)
+                for state_idx, session in enumerate(session_idx):
+                    self.assert_chunk_equal(reference_sessions[session][chunk_idx],
+                                            [kernel_value[state_idx] for kernel_value in kernel_result])
+                _, _, _, buffer_size_ms, mahimahi_ptr, last_mahimahi_time = kernel_result
+
+
+if __name__ == '__main__':
+    unittest.main()
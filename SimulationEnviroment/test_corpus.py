@@ -0,0 +1,79 @@
+"""
+Sessions streamed from a corpus reference have to carry the same name as the sessions streamed from the original files,
+the names are parsed again to find the trace and video of a logged session.
+"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from ABRPolicies.SimpleABRPolicy import RebufferingMinimizer
+from SimulationEnviroment.Corpus import corpus_reference, create_corpus, file_name
+from SimulationEnviroment.Rewards import ClassicPerceptualReward
+from SimulationEnviroment.SimulatorEnviroment import OfflineStreaming, TrajectoryVideoStreaming
+
+RESOLUTIONS = ['256x144', '426x240', '640x360']
+
+
+class CorpusNamingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_folder = tempfile.TemporaryDirectory()
+        random_state = np.random.RandomState(0)
+        os.makedirs(os.path.join(self.data_folder.name, 'Traces', 'norway'))
+        os.makedirs(os.path.join(self.data_folder.name, 'Video_Info'))
+        self.trace_path = os.path.join(self.data_folder.name, 'Traces', 'norway', 'report_bus_0001.log')
+        with open(self.trace_path, 'w') as trace_file:
+            for time_s, mbit in zip(np.arange(60.), random_state.uniform(0.5, 3., size=60)):
+                trace_file.write('%.6f %.6f\n' % (time_s, mbit))
+        self.video_path = os.path.join(self.data_folder.name, 'Video_Info', '62092214_video_info')
+        video_information = {'seg_len_s': np.full(6, 4.)}
+        for level, resolution in enumerate(RESOLUTIONS):
+            video_information[resolution + '_bitrate'] = np.full(6, 300e3 * (level + 1))
+            video_information[resolution + '_byte'] = video_information[resolution + '_bitrate'] * 4. / 8.
+            video_information[resolution + '_vmaf'] = np.full(6, 30. + 20 * level)
+        pd.DataFrame(video_information).to_csv(self.video_path)
+        self.corpus_path = os.path.join(self.data_folder.name, 'corpus.bin')
+        self.corpus = create_corpus(self.corpus_path, [self.trace_path], [self.video_path])
+        self.flat_corpus_path = os.path.join(self.data_folder.name, 'flat_corpus.bin')
+        self.flat_corpus = create_corpus(self.flat_corpus_path, [self.trace_path], [],
+                                         root_path=os.path.dirname(self.trace_path))
+
+    def tearDown(self):
+        self.data_folder.cleanup()
+
+    def session_name(self, bw_trace_path, video_information_path):
+        streaming_enviroment = OfflineStreaming(bw_trace_path, video_information_path, ClassicPerceptualReward(),
+                                                max_lookback=5, max_lookahead=2, max_switch_allowed=1,
+                                                buffer_threshold_ms=15000.)
+        trajectory_generator = TrajectoryVideoStreaming(RebufferingMinimizer(), streaming_enviroment,
+                                                        [bw_trace_path], [video_information_path])
+        evaluation, trajectory = trajectory_generator.run_experiment(bw_trace_path, video_information_path, 0.,
+                                                                     is_parallel=False)
+        self.assertEqual(evaluation[0].name, trajectory.trace_video_pair_identifier)
+        return evaluation[0].name
+
+    def test_file_name(self):
+        trace_reference = corpus_reference(self.corpus_path, self.corpus.trace_ids()[0])
+        video_reference = corpus_reference(self.corpus_path, self.corpus.video_ids()[0])
+        self.assertEqual(file_name(trace_reference), 'report_bus_0001.log')
+        self.assertEqual(file_name(video_reference), '62092214_video_info')
+        self.assertEqual(file_name(self.trace_path), 'report_bus_0001.log')
+        self.assertEqual(file_name(self.flat_corpus.trace_references()[0]), 'report_bus_0001.log')
+
+    def test_session_name_round_trip(self):
+        file_session_name = self.session_name(self.trace_path, self.video_path)
+        self.assertEqual(file_session_name, 'video_62092214_file_id_report_bus_0001.log')
+        for trace_reference, video_reference in zip(self.corpus.trace_references(), self.corpus.video_references()):
+            self.assertEqual(self.session_name(trace_reference, video_reference), file_session_name)
+        self.assertEqual(self.session_name(self.flat_corpus.trace_references()[0], self.video_path), file_session_name)
+        trace_id = file_session_name.split('_file_id_')[-1]
+        video_id = file_session_name.split('_file_id_')[0].replace('video_', '')
+        self.assertEqual(trace_id, os.path.basename(self.trace_path))
+        self.assertEqual(video_id + '_video_info', os.path.basename(self.video_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -56,6 +56,47 @@ class LegacyTransformer(OfflineStreaming):
     def reset(self):
         super().reset()
 
+    def replay_quality_progression(self, quality_level_progression_list, trace_video_pair_name):
+        """
+        Replays the measured quality progression in one pass. The first chunk is downloaded in the lowest quality,
+        every following chunk in the quality closest to the measured one we can reach within max_switch_allowed
+        :param quality_level_progression_list: measured quality level per chunk
+        :param trace_video_pair_name:
+        :return: logging list, trajectory
+        """
+        n_chunk = min(self.n_video_chunk, len(quality_level_progression_list) + 1)
+        quality_sequence = [0]
+        for measured_quality in quality_level_progression_list[:n_chunk - 1]:
+            # Should we actually map this. I probaly should map the quality progression to the closes mapping of the quality switches
+            switch = int(np.clip(measured_quality - quality_sequence[-1], a_min=-self.max_switch_allowed,
+                                 a_max=self.max_switch_allowed))
+            quality_sequence.append(quality_sequence[-1] + switch)
+        observation_list, _ = self.replay(quality_sequence)
+        for observation in observation_list:
+            del observation['streaming_environment']  # We can't make use of this in the trajectory
+
+        trajectory_object = Trajectory()
+        trajectory_object.new_trace_video_pair_name(trace_video_pair_name)
+        previous_quality = 0
+        previous_likelihood = np.zeros((1, len(self.quality_change_arr)))
+        previous_likelihood[0, len(previous_likelihood) // 2 + 1] = 1.
+        for chunk_idx, current_quality in enumerate(quality_sequence):
+            action_idx = self.map_switch_idx(current_quality - previous_quality)
+            trajectory_object.add_trajectory_triple(observation_list[chunk_idx], observation_list[chunk_idx + 1],
+                                                    action_idx)
+            trajectory_object.add_likelihood(previous_likelihood, False)
+            previous_likelihood = np.zeros((1, len(self.quality_change_arr)))
+            previous_likelihood[0, action_idx] = 1.
+            previous_quality = current_quality
+
+        streaming_session_evaluation = pd.DataFrame(self.return_log_state(),
+                                                    columns=self.get_logging_columns())
+        logging_list = [StreamingSessionEvaluation(streaming_session_evaluation=streaming_session_evaluation,
+                                                   name=trace_video_pair_name,
+                                                   max_buffer_length_s=self.buffer_threshold_ms / 1000.,
+                                                   max_switch_allowed=self.max_switch_allowed)]
+        return logging_list, trajectory_object
+
     def transform_csv(self, to_transform_path):
         """
         Main transformation method
@@ -94,54 +135,7 @@ class LegacyTransformer(OfflineStreaming):
                 break
             quality_level_progression_list.append(client_logger_file['current_level'].iloc[client_logger_index])
 
-        trajectory_object = Trajectory()
-        trajectory_object.new_trace_video_pair_name(trace_video_pair_name)
-        previous_quality = 0
-        current_quality = 0
-        previous_observation = self.generate_observation_dictionary()
-        previous_likelihood = np.zeros((1, len(self.quality_change_arr)))
-        previous_likelihood[0, len(previous_likelihood) // 2 + 1] = 1.
-        del previous_observation['streaming_environment']  # We can't make use of this in the trajectory
-        video_finished = False
-        quality_iteration_idx = 0
-        logging_list = []
-        while not video_finished:
-            observation, reward, video_finished, info = self.get_video_chunk(
-                current_quality)
-            switch = current_quality - previous_quality
-            action_idx = self.map_switch_idx(switch)
-            previous_quality = current_quality
-            if video_finished or quality_iteration_idx >= len(quality_level_progression_list):
-                # Add the last observation
-                del observation['streaming_environment']  # We can't make use of this in the trajectory
-                trajectory_object.add_trajectory_triple(previous_observation, observation,
-                                                        action_idx)
-                trajectory_object.add_likelihood(previous_likelihood, False)
-                break
-            # We actually need to map this
-            # which is the closest quality to the played we can reach
-            current_quality = quality_level_progression_list[quality_iteration_idx]
-            # Should we actually map this. I probaly should map the quality progression to the closes mapping of the quality switches
-            switch = int(np.clip(current_quality - previous_quality, a_min=-self.max_switch_allowed,
-                                 a_max=self.max_switch_allowed))
-            current_quality = previous_quality + switch
-            del observation['streaming_environment']  # We can't make use of this in the trajectory
-            trajectory_object.add_trajectory_triple(previous_observation, observation,
-                                                    action_idx)
-            trajectory_object.add_likelihood(previous_likelihood, False)
-            previous_likelihood = np.zeros((1, len(self.quality_change_arr)))
-            previous_likelihood[0, action_idx] = 1.
-            previous_observation = observation
-            quality_iteration_idx += 1
-
-        streaming_session_evaluation = pd.DataFrame(self.return_log_state(),
-                                                    columns=self.get_logging_columns())
-        logging_list.append(StreamingSessionEvaluation(streaming_session_evaluation=streaming_session_evaluation,
-                                                       name=trace_video_pair_name,
-                                                       max_buffer_length_s=self.buffer_threshold_ms / 1000.,
-                                                       max_switch_allowed=self.max_switch_allowed))
-
-        return logging_list, trajectory_object
+        return self.replay_quality_progression(quality_level_progression_list, trace_video_pair_name)
 
 
 class EvaluationTransformer(LegacyTransformer):
@@ -155,49 +149,4 @@ class EvaluationTransformer(LegacyTransformer):
         trace_video_pair_name = to_transform_path.split('/')[-1]
         evaluation_dataframe = pd.read_csv(to_transform_path, index_col=0)
         quality_level_progression_list = evaluation_dataframe['quality_level_chosen'].values
-        trajectory_object = Trajectory()
-        trajectory_object.new_trace_video_pair_name(trace_video_pair_name)
-        previous_quality = 0
-        current_quality = 0
-        previous_observation = self.generate_observation_dictionary()
-        previous_likelihood = np.zeros((1, len(self.quality_change_arr)))
-        previous_likelihood[0, len(previous_likelihood) // 2 + 1] = 1.
-        del previous_observation['streaming_environment']  # We can't make use of this in the trajectory
-        video_finished = False
-        quality_iteration_idx = 0
-        logging_list = []
-        while not video_finished:
-            observation, reward, video_finished, info = self.get_video_chunk(
-                current_quality)
-            switch = current_quality - previous_quality
-            action_idx = self.map_switch_idx(switch)
-            previous_quality = current_quality
-            if video_finished or quality_iteration_idx >= len(quality_level_progression_list):
-                # Add the last observation
-                del observation['streaming_environment']  # We can't make use of this in the trajectory
-                trajectory_object.add_trajectory_triple(previous_observation, observation,
-                                                        action_idx)
-                trajectory_object.add_likelihood(previous_likelihood, False)
-                break
-            current_quality = quality_level_progression_list[quality_iteration_idx]
-            # Should we actually map this. I probaly should map the quality progression to the closes mapping of the quality switches
-            switch = int(np.clip(current_quality - previous_quality, a_min=-self.max_switch_allowed,
-                                 a_max=self.max_switch_allowed))
-            current_quality = previous_quality + switch
-            del observation['streaming_environment']  # We can't make use of this in the trajectory
-            trajectory_object.add_trajectory_triple(previous_observation, observation,
-                                                    action_idx)
-            trajectory_object.add_likelihood(previous_likelihood, False)
-            previous_likelihood = np.zeros((1, len(self.quality_change_arr)))
-            previous_likelihood[0, action_idx] = 1.
-            previous_observation = observation
-            quality_iteration_idx += 1
-
-        streaming_session_evaluation = pd.DataFrame(self.return_log_state(),
-                                                    columns=self.get_logging_columns())
-        logging_list.append(StreamingSessionEvaluation(streaming_session_evaluation=streaming_session_evaluation,
-                                                       name=trace_video_pair_name,
-                                                       max_buffer_length_s=self.buffer_threshold_ms / 1000.,
-                                                       max_switch_allowed=self.max_switch_allowed))
-
-        return logging_list, trajectory_object
+        return self.replay_quality_progression(quality_level_progression_list, trace_video_pair_name)
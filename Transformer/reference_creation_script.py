@@ -2,12 +2,11 @@ import os
 import pickle
 
 import numpy as np
-from scipy.stats import hmean
 
 from ABRPolicies.ComplexABRPolicy import MPC, PensieveMultiNN
 from ABRPolicies.OptimalABRPolicy import Optimal
 from ABRPolicies.SimpleABRPolicy import Rate
-from ABRPolicies.ThroughputEstimator import StepEstimator
+from ABRPolicies.ThroughputEstimator import StepEstimator, generate_hmean
 from SimulationEnviroment.Rewards import ClassicPerceptualReward
 from SimulationEnviroment.SimulatorEnviroment import TrajectoryVideoStreaming, OfflineStreaming
 
@@ -64,7 +63,7 @@ def find_trace_file(path):
 Define Bandwidth estimator
 """
 future_bandwidth_estimator = StepEstimator(consider_last_n_steps=5,
-                                           predictor_function=hmean,
+                                           predictor_function=generate_hmean(),
                                            robust_estimate=True)
 
 """
@@ -6,6 +6,7 @@ import pandas as pd
 from tqdm import tqdm
 
 from SimulationEnviroment.Rewards import ClassicPerceptualReward
+from SimulationEnviroment.TrajectoryStore import save_trajectory_store
 from Transformer.LegacyTransformer import LegacyTransformer, EvaluationTransformer
 
 ##### Load all video and trace files
@@ -162,3 +163,4 @@ if __name__ == "__main__":
             pickle.dump(streaming_evaluation_dataframe_list, dump_file)
         with open(provider_folder + '/trajectory_list', 'wb') as dump_file:
             pickle.dump(trajectory_list, dump_file)
+        save_trajectory_store(provider_folder + '/trajectory_store', trajectory_list)  ### Memory mapped version